@@ -0,0 +1,253 @@
+"""
+Load generator: YCSB-style workloads against a KV cluster over KVClient.
+
+    python -m bench.load --nodes 3 --workload a --distribution zipfian --duration 10
+
+starts a local cluster the way cluster.sh does (one server.py process per
+node, in a temporary data directory), loads ``--records`` keys, runs the
+workload from ``--concurrency`` threads and prints a JSON report with the
+throughput and p50/p99/p999 latency per operation. ``--ports`` runs against
+a cluster that is already up instead.
+"""
+import argparse
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from client import KVClient, KVClientError  # noqa: E402
+from bench.workloads import (DEFAULT_DISTRIBUTION, WORKLOADS, Counter, OperationChooser, key_chooser,  # noqa: E402
+                             key_name, make_rng, random_value, summarize)
+
+
+class LocalCluster:
+    """``nodes`` server.py processes on consecutive ports, peered like cluster.sh does."""
+
+    def __init__(self, nodes=3, base_port=7000, server_args=(), data_dir=None):
+        self.ports = [base_port + i for i in range(nodes)]
+        self.server_args = list(server_args)
+        self.data_dir = data_dir or tempfile.mkdtemp(prefix="kv-bench-")
+        self.owns_data_dir = data_dir is None
+        self.processes = []
+
+    def start(self, timeout=30):
+        for port in self.ports:
+            peers = ",".join(str(p) for p in self.ports if p != port)
+            node_dir = os.path.join(self.data_dir, f"node_{port}")
+            os.makedirs(node_dir, exist_ok=True)
+            log = open(os.path.join(node_dir, "server.log"), "wb")
+            self.processes.append(subprocess.Popen(
+                [sys.executable, os.path.join(ROOT, "server.py"), "--port", str(port), "--peers", peers,
+                 "--data-dir", node_dir, *self.server_args],
+                stdout=log, stderr=subprocess.STDOUT, cwd=node_dir))
+        # Ready once a write commits, i.e. a leader is elected and a majority is up
+        client = KVClient(self.ports, host="127.0.0.1", max_retries=int(timeout / 0.2), backoff=0.05, max_backoff=0.2)
+        try:
+            client.put("bench:ready", "1")
+        finally:
+            client.close()
+        return self
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if self.owns_data_dir:
+            shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def make_client(args, ports):
+    return KVClient(ports, binary=args.binary, host=args.host, read_mode=args.read_mode,
+                    max_retries=args.max_retries, timeout=args.timeout)
+
+
+def load(client, args):
+    """Insert keys 0 .. records - 1 in pipelined batches; returns the summary of the load phase."""
+    rng = make_rng(args.seed, "load")
+    latencies = []
+    started = time.monotonic()
+    pipe = client.pipeline()
+    for start in range(0, args.records, args.load_batch):
+        stop = min(args.records, start + args.load_batch)
+        pipe.batch_put([(key_name(i), random_value(rng, args.value_size)) for i in range(start, stop)])
+        if len(pipe.commands) >= 16 or stop == args.records:
+            t = time.monotonic()
+            results = pipe.execute()
+            latencies.append(time.monotonic() - t)
+            if any(result != "OK" for result in results):
+                raise KVClientError(f"load failed: {results[0]}")
+    elapsed = time.monotonic() - started
+    return {"records": args.records, "seconds": round(elapsed, 3),
+            "records_per_sec": round(args.records / elapsed, 1) if elapsed else None}
+
+
+class Worker(threading.Thread):
+    def __init__(self, index, client, args, counter, deadline, remaining):
+        super().__init__(daemon=True)
+        self.client = client
+        self.args = args
+        self.counter = counter
+        self.deadline = deadline
+        self.remaining = remaining
+        self.rng = make_rng(args.seed, index)
+        self.operations = OperationChooser(WORKLOADS[args.workload], self.rng)
+        distribution = args.distribution or DEFAULT_DISTRIBUTION.get(args.workload, "zipfian")
+        self.keys = key_chooser(distribution, counter, self.rng, args.theta)
+        self.latencies = {}
+        self.errors = 0
+
+    def run(self):
+        while time.monotonic() < self.deadline and next(self.remaining, None) is not None:
+            op = self.operations.next()
+            started = time.monotonic()
+            try:
+                getattr(self, op)()
+            except KVClientError:
+                self.errors += 1
+                continue
+            self.latencies.setdefault(op, []).append(time.monotonic() - started)
+
+    def _keys(self):
+        return [key_name(self.keys.next()) for _ in range(self.args.batch_size)]
+
+    def _value(self):
+        return random_value(self.rng, self.args.value_size)
+
+    def read(self):
+        if self.args.batch_size > 1:
+            self.client.multi_get(self._keys())
+        else:
+            self.client.read(key_name(self.keys.next()))
+
+    def update(self):
+        if self.args.batch_size > 1:
+            self._check(self.client.batch_put([(key, self._value()) for key in self._keys()]))
+        else:
+            self._check(self.client.put(key_name(self.keys.next()), self._value()))
+
+    def insert(self):
+        if self.args.batch_size > 1:
+            items = [(key_name(self.counter.next()), self._value()) for _ in range(self.args.batch_size)]
+            self._check(self.client.batch_put(items))
+        else:
+            self._check(self.client.put(key_name(self.counter.next()), self._value()))
+
+    def scan(self):
+        start = self.keys.next()
+        length = self.rng.randint(1, self.args.scan_length)
+        entries = self.client.scan(key_name(start), key_name(start + length - 1), page_size=length)
+        for _ in itertools.islice(entries, length):
+            pass
+
+    def read_modify_write(self):
+        key = key_name(self.keys.next())
+        self.client.read(key)
+        self._check(self.client.put(key, self._value()))
+
+    @staticmethod
+    def _check(result):
+        if result != "OK":
+            raise KVClientError(result)
+
+
+def run(args, ports):
+    clients = [make_client(args, ports) for _ in range(args.clients)]
+    report = {"config": {k: v for k, v in vars(args).items() if k not in ("output",)}}
+    try:
+        if args.records:
+            report["load"] = load(clients[0], args)
+        counter = Counter(args.records)
+        remaining = iter(range(args.operations)) if args.operations else itertools.repeat(True)
+        workers = []
+        started = time.monotonic()
+        deadline = started + args.duration
+        for i in range(args.concurrency):
+            workers.append(Worker(i, clients[i % len(clients)], args, counter, deadline, remaining))
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.monotonic() - started
+    finally:
+        for client in clients:
+            client.close()
+
+    by_op = {}
+    for worker in workers:
+        for op, latencies in worker.latencies.items():
+            by_op.setdefault(op, []).extend(latencies)
+    all_latencies = [latency for latencies in by_op.values() for latency in latencies]
+    report["seconds"] = round(elapsed, 3)
+    report["overall"] = summarize(all_latencies, elapsed)
+    report["operations"] = {op: summarize(latencies, elapsed) for op, latencies in sorted(by_op.items())}
+    report["errors"] = sum(worker.errors for worker in workers)
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_argument_group("cluster")
+    target.add_argument("--ports", type=str, default="", help="run against these running nodes instead")
+    target.add_argument("--host", type=str, default="127.0.0.1")
+    target.add_argument("--nodes", type=int, default=3)
+    target.add_argument("--base-port", type=int, default=7000)
+    target.add_argument("--server-args", type=str, default="",
+                        help='extra server.py flags, e.g. "--fsync-policy interval --partitions 3"')
+    workload = parser.add_argument_group("workload")
+    workload.add_argument("--workload", choices=sorted(WORKLOADS), default="a")
+    workload.add_argument("--distribution", choices=["uniform", "zipfian", "latest"], default=None,
+                          help="key popularity (default: zipfian, latest for workload d)")
+    workload.add_argument("--theta", type=float, default=0.99, help="Zipfian skew")
+    workload.add_argument("--records", type=int, default=10000, help="keys loaded before the run")
+    workload.add_argument("--load-batch", type=int, default=100)
+    workload.add_argument("--value-size", type=int, default=100)
+    workload.add_argument("--batch-size", type=int, default=1, help="keys per read/update (MULTIGET/BATCHPUT)")
+    workload.add_argument("--scan-length", type=int, default=100, help="longest SCAN (workload e)")
+    workload.add_argument("--duration", type=float, default=10.0)
+    workload.add_argument("--operations", type=int, default=0, help="stop after this many (0: duration only)")
+    workload.add_argument("--seed", type=int, default=1)
+    client = parser.add_argument_group("client")
+    client.add_argument("--concurrency", type=int, default=16, help="worker threads")
+    client.add_argument("--clients", type=int, default=1, help="KVClient instances shared by the threads")
+    client.add_argument("--binary", action="store_true")
+    client.add_argument("--read-mode", choices=["leader-lease", "read-index", "stale-ok"], default=None)
+    client.add_argument("--max-retries", type=int, default=5)
+    client.add_argument("--timeout", type=float, default=5.0)
+    parser.add_argument("--output", type=str, default=None, help="also write the JSON report here")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.ports:
+        report = run(args, [int(p) for p in args.ports.split(",")])
+    else:
+        with LocalCluster(args.nodes, args.base_port, args.server_args.split()):
+            report = run(args, [args.base_port + i for i in range(args.nodes)])
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
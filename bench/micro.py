@@ -0,0 +1,162 @@
+"""
+Micro-benchmarks of the storage engine, without the network:
+
+    python -m bench.micro wal sstable-get compaction
+
+``wal`` times WriteAheadLog appends (one record at a time and from concurrent
+writers sharing group commits) and replay; ``sstable-get`` times point
+lookups on one SSTable, hits and misses, with and without the block cache;
+``compaction`` times compacting a set of overlapping L0 tables. Each prints
+a JSON report; all run in a temporary directory.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.workloads import ZipfianGenerator, key_name, make_rng, random_value, summarize  # noqa: E402
+from store.cache import Cache  # noqa: E402
+from store.kv import KeyValueStore  # noqa: E402
+from store.sstable import SSTable  # noqa: E402
+from store.wal import WriteAheadLog  # noqa: E402
+
+
+def timed(fn, count):
+    latencies = []
+    for i in range(count):
+        started = time.perf_counter()
+        fn(i)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def bench_wal(args, tmp):
+    rng = make_rng(args.seed)
+    values = [random_value(rng, args.value_size) for _ in range(256)]
+    report = {}
+    for policy in args.fsync_policies:
+        path = os.path.join(tmp, f"wal-{policy}.log")
+        wal = WriteAheadLog(path, path + ".snapshot", fsync_policy=policy)
+        started = time.perf_counter()
+        latencies = timed(lambda i: wal.append("PUT", key_name(i), values[i % 256]), args.count)
+        report[f"append_{policy}"] = summarize(latencies, time.perf_counter() - started)
+
+        # Concurrent writers: appends share group commits
+        latencies, threads = [], []
+        fsyncs = wal.stats["fsyncs"]
+        per_thread = args.count // args.threads
+        started = time.perf_counter()
+        for t in range(args.threads):
+            def write(offset=t * per_thread):
+                latencies.extend(timed(lambda i: wal.append("PUT", key_name(offset + i), values[i % 256]),
+                                       per_thread))
+            threads.append(threading.Thread(target=write))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        report[f"append_{policy}_{args.threads}_threads"] = dict(
+            summarize(latencies, time.perf_counter() - started), fsyncs=wal.stats["fsyncs"] - fsyncs)
+        wal.close()
+
+        wal = WriteAheadLog(path, path + ".snapshot", fsync_policy=policy)
+        started = time.perf_counter()
+        records = sum(1 for _ in wal.replay())
+        elapsed = time.perf_counter() - started
+        report[f"replay_{policy}"] = {"records": records, "seconds": round(elapsed, 4),
+                                      "records_per_sec": round(records / elapsed, 1)}
+        wal.close()
+    return report
+
+
+def bench_sstable_get(args, tmp):
+    rng = make_rng(args.seed)
+    filename = os.path.join(tmp, "sstable_000001.db")
+    SSTable.write(filename, ((key_name(i), random_value(rng, args.value_size)) for i in range(args.count)),
+                  args.count, compression=args.compression)
+    zipfian = ZipfianGenerator(args.count, rng)
+    hits = [key_name(zipfian.next()) for _ in range(args.lookups)]
+    misses = [key_name(i) + "x" for i in range(args.lookups)]
+    report = {"file_bytes": os.path.getsize(filename)}
+    for name, cache in (("uncached", None), ("block_cache", Cache(args.block_cache_mb * 1024 * 1024))):
+        table = SSTable(filename=filename, block_cache=cache)
+        for label, keys in (("hit", hits), ("miss", misses)):
+            started = time.perf_counter()
+            latencies = timed(lambda i: table.get(keys[i]), len(keys))
+            report[f"get_{label}_{name}"] = summarize(latencies, time.perf_counter() - started)
+        if cache is not None:
+            report["block_cache_hit_rate"] = round(cache.hit_rate(), 4)
+        table.close()
+    return report
+
+
+def bench_compaction(args, tmp):
+    rng = make_rng(args.seed)
+    store = KeyValueStore(os.path.join(tmp, "compaction"), fsync_policy="os", compression=args.compression,
+                          memtable_bytes=max(64 * 1024, args.count * args.value_size // args.tables))
+    store.compactor.stop()  # compact on demand below, not in the background
+    per_table = args.count // args.tables
+    for t in range(args.tables):
+        # Overlapping tables: every flush holds random keys from the whole keyspace
+        store.batch_put([(key_name(rng.randrange(args.count)), random_value(rng, args.value_size))
+                         for _ in range(per_table)])
+        store.flush_to_sstable()
+    tables = len(store.sstables)
+    started = time.perf_counter()
+    store.compact_sstables()
+    elapsed = time.perf_counter() - started
+    stats = dict(store.compactor.stats)
+    report = {"input_tables": tables, "output_tables": len(store.sstables), "seconds": round(elapsed, 4),
+              "mb_per_sec": round(stats["bytes_read"] / elapsed / 1e6, 2) if elapsed else None, **stats}
+    store.close()
+    return report
+
+
+BENCHMARKS = {"wal": bench_wal, "sstable-get": bench_sstable_get, "compaction": bench_compaction}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmarks", nargs="*", help=f"any of {', '.join(sorted(BENCHMARKS))} (default: all)")
+    parser.add_argument("--count", type=int, default=20000, help="records written / keys per table")
+    parser.add_argument("--lookups", type=int, default=20000)
+    parser.add_argument("--value-size", type=int, default=100)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--tables", type=int, default=8, help="L0 tables to compact")
+    parser.add_argument("--block-cache-mb", type=int, default=8)
+    parser.add_argument("--fsync-policies", type=lambda s: s.split(","), default=["always", "os"])
+    parser.add_argument("--compression", choices=["none", "zlib", "lzma"], default="none",
+                        help="codec for the sstable-get and compaction tables")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args(argv)
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name!r}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = {"config": {k: v for k, v in vars(args).items() if k != "output"}}
+    tmp = tempfile.mkdtemp(prefix="kv-micro-")
+    try:
+        for name in args.benchmarks or sorted(BENCHMARKS):
+            report[name] = BENCHMARKS[name](args, tmp)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+Key choosers, YCSB operation mixes and latency summaries shared by the
+load generator (bench/load.py) and the micro-benchmarks (bench/micro.py).
+"""
+import bisect
+import random
+import threading
+
+# YCSB core workloads: operation -> proportion
+WORKLOADS = {
+    "a": {"read": 0.5, "update": 0.5},                 # update heavy
+    "b": {"read": 0.95, "update": 0.05},               # read mostly
+    "c": {"read": 1.0},                                # read only
+    "d": {"read": 0.95, "insert": 0.05},               # read latest
+    "e": {"scan": 0.95, "insert": 0.05},               # short ranges
+    "f": {"read": 0.5, "read_modify_write": 0.5},
+    "w": {"update": 1.0},                              # write only (not in YCSB)
+}
+DEFAULT_DISTRIBUTION = {"d": "latest"}
+
+
+def key_name(index):
+    # Zero padded so key order matches index order, which SCAN relies on
+    return f"user{index:010d}"
+
+
+class UniformGenerator:
+    def __init__(self, items, rng):
+        self.items = items
+        self.rng = rng
+
+    def next(self):
+        return self.rng.randrange(self.items)
+
+
+class ZipfianGenerator:
+    """
+    Zipfian over [0, items) with skew ``theta`` (YCSB's 0.99 by default), using
+    the Gray et al. rejection-free method that YCSB uses. Popular items are the
+    low indices; ScrambledZipfian spreads them over the keyspace.
+    """
+
+    def __init__(self, items, rng, theta=0.99):
+        self.items = items
+        self.rng = rng
+        self.theta = theta
+        self.zeta2 = self._zeta(2)
+        self.alpha = 1.0 / (1.0 - theta)
+        self.zetan, self.counted = self._zeta(items), items
+        self._set_eta()
+
+    def _zeta(self, n, start=1):
+        return sum(1.0 / (i ** self.theta) for i in range(start, n + 1))
+
+    def _set_eta(self):
+        self.eta = (1 - (2.0 / self.items) ** (1 - self.theta)) / (1 - self.zeta2 / self.zetan)
+
+    def _grow(self, items):
+        # zeta(n) is O(n): extend it incrementally as inserts grow the keyspace
+        self.zetan += self._zeta(items, self.counted + 1)
+        self.items = self.counted = items
+        self._set_eta()
+
+    def next(self, items=None):
+        if items is not None and items > self.counted:
+            self._grow(items)
+        u = self.rng.random()
+        uz = u * self.zetan
+        if uz < 1.0:
+            return 0
+        if uz < 1.0 + 0.5 ** self.theta:
+            return 1
+        return int(self.items * (self.eta * u - self.eta + 1) ** self.alpha)
+
+
+class ScrambledZipfianGenerator(ZipfianGenerator):
+    """Zipfian popularity with the hot items hashed across the whole keyspace."""
+
+    def next(self, items=None):
+        return hash((super().next(items), 0x5BD1E995)) % self.items
+
+
+class LatestGenerator:
+    """Skewed towards the most recently inserted keys (YCSB workload D)."""
+
+    def __init__(self, counter, rng, theta=0.99):
+        self.counter = counter
+        self.zipfian = ZipfianGenerator(counter.value, rng, theta)
+
+    def next(self):
+        newest = self.counter.value
+        return max(0, newest - 1 - self.zipfian.next(newest))
+
+
+class Counter:
+    """Number of keys loaded or inserted so far, shared by the worker threads."""
+
+    def __init__(self, value):
+        self.value = value
+        self._lock = threading.Lock()
+
+    def next(self):
+        with self._lock:
+            self.value += 1
+            return self.value - 1
+
+
+def key_chooser(distribution, counter, rng, theta=0.99):
+    if distribution == "uniform":
+        return UniformGenerator(counter.value, rng)
+    if distribution == "zipfian":
+        return ScrambledZipfianGenerator(counter.value, rng, theta)
+    if distribution == "latest":
+        return LatestGenerator(counter, rng, theta)
+    raise ValueError(f"unknown key distribution {distribution!r}")
+
+
+class OperationChooser:
+    def __init__(self, mix, rng):
+        self.operations = list(mix)
+        self.cumulative = []
+        total = 0.0
+        for op in self.operations:
+            total += mix[op]
+            self.cumulative.append(total)
+        self.rng = rng
+
+    def next(self):
+        point = self.rng.random() * self.cumulative[-1]
+        return self.operations[min(bisect.bisect_right(self.cumulative, point), len(self.operations) - 1)]
+
+
+def random_value(rng, size):
+    # Printable and space-free so values survive the text protocol
+    return "".join(rng.choices("abcdefghijklmnopqrstuvwxyz0123456789", k=size))
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def summarize(latencies, elapsed=None):
+    """Count, throughput and latency percentiles (milliseconds) of a list of latencies in seconds."""
+    values = sorted(latencies)
+    summary = {"count": len(values)}
+    if elapsed:
+        summary["ops_per_sec"] = round(len(values) / elapsed, 1)
+    if values:
+        summary.update({
+            "mean_ms": round(sum(values) / len(values) * 1000, 3),
+            "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+            "p999_ms": round(percentile(values, 0.999) * 1000, 3),
+            "max_ms": round(values[-1] * 1000, 3),
+        })
+    return summary
+
+
+def make_rng(seed, stream=0):
+    return random.Random(f"{seed}/{stream}")
@@ -1,22 +1,456 @@
+import ast
+import asyncio
+import collections
+import heapq
+import itertools
+import random
 import socket
-import json
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
 import requests
+import protocol
+
+
+class KVClientError(Exception):
+    pass
+
+
+WatchEvent = collections.namedtuple("WatchEvent", "index op key value")  # op PUT or DELETE (value None)
+
+
+class BinaryConnection:
+    """
+    One binary-protocol connection. Requests are tagged with ids and a reader
+    thread matches responses back to them, so any number of threads can keep
+    requests outstanding on the same socket.
+    """
+
+    def __init__(self, host, port, timeout=5):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.sendall(protocol.PREFACE)
+        try:
+            reply = protocol.recv_exactly(self.sock, len(protocol.PREFACE))
+        except (ConnectionError, socket.timeout):
+            reply = b""
+        if reply != protocol.PREFACE:
+            self.sock.close()
+            raise protocol.ProtocolError(f"node {port} does not speak the binary protocol")
+        self.sock.settimeout(None)
+        self.ids = itertools.count(1)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.closed = False
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    def submit(self, opcode, *fields):
+        """Send a request without waiting; returns a Future of (status, fields)."""
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise ConnectionError("connection closed")
+            request_id = next(self.ids)
+            self.pending[request_id] = future
+            self.sock.sendall(protocol.encode_frame(request_id, opcode, fields))
+        return future
+
+    def request(self, opcode, *fields, timeout=None):
+        return self.submit(opcode, *fields).result(timeout)
+
+    def _read_loop(self):
+        try:
+            while True:
+                request_id, status, fields = protocol.recv_frame(self.sock)
+                with self.lock:
+                    future = self.pending.pop(request_id, None)
+                if future is not None:
+                    future.set_result((status, fields))
+        except Exception as e:
+            self._fail_pending(e)
+
+    def _fail_pending(self, error):
+        with self.lock:
+            self.closed = True
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(ConnectionError(f"connection lost: {error}"))
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class TextConnection:
+    """
+    One persistent text-protocol connection. The server answers commands in
+    the order they were sent, so each command queues a Future and a reader
+    thread resolves them first-in first-out; commands from many threads
+    pipeline on the same socket.
+    """
+
+    def __init__(self, host, port, timeout=5):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(None)
+        self.reader = self.sock.makefile("rb")
+        self.pending = collections.deque()
+        self.lock = threading.Lock()
+        self.closed = False
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    def submit(self, command):
+        """Send one command line without waiting; returns a Future of the reply line."""
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise ConnectionError("connection closed")
+            self.pending.append(future)
+            self.sock.sendall(protocol.to_bytes(command) + b"\n")
+        return future
+
+    def request(self, command, timeout=None):
+        return self.submit(command).result(timeout)
+
+    def _read_loop(self):
+        try:
+            while True:
+                line = self.reader.readline()
+                if not line:
+                    raise ConnectionError("connection closed")
+                with self.lock:
+                    future = self.pending.popleft()
+                future.set_result(protocol.to_str(line).rstrip("\r\n"))
+        except Exception as e:
+            self._fail_pending(e)
+
+    def _fail_pending(self, error):
+        with self.lock:
+            self.closed = True
+            pending, self.pending = self.pending, collections.deque()
+        for future in pending:
+            future.set_exception(ConnectionError(f"connection lost: {error}"))
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class Command:
+    """A client operation in both wire forms."""
+
+    def __init__(self, text, opcode, *fields, partition=None):
+        self.text = text
+        self.opcode = opcode
+        self.fields = fields
+        self.partition = partition  # set when the command targets one partition regardless of its keys
+
+    @classmethod
+    def put(cls, key, value, ttl=None):
+        if ttl is None:
+            return cls(f"PUT {key} {value}", protocol.PUT, key, value)
+        return cls(f"PUT {key} {value} EX {int(ttl)}", protocol.PUT, key, value, str(int(ttl)))
+
+    @classmethod
+    def read(cls, key):
+        return cls(f"READ {key}", protocol.READ, key)
+
+    @classmethod
+    def delete(cls, key):
+        return cls(f"DELETE {key}", protocol.DELETE, key)
+
+    @classmethod
+    def batch_put(cls, kv_pairs):
+        batch_str = " ".join([f"{k}:{v}" for k, v in kv_pairs])
+        fields = [item for pair in kv_pairs for item in pair]
+        return cls(f"BATCHPUT {batch_str}", protocol.BATCHPUT, *fields)
+
+    @classmethod
+    def multi_get(cls, keys):
+        return cls(" ".join(["MULTIGET", *keys]), protocol.MULTIGET, *keys)
+
+    @classmethod
+    def range_read(cls, start_key, end_key, partition=None):
+        if partition is None:
+            return cls(f"RANGE {start_key} {end_key}", protocol.RANGE, start_key, end_key)
+        return cls(f"RANGE {start_key} {end_key} {partition}", protocol.RANGE, start_key, end_key, str(partition),
+                   partition=partition)
+
+    @classmethod
+    def scan(cls, start_key, end_key, limit, cursor=None, partition=None):
+        # The cursor is the next key to read, so the start key stands in for "no cursor yet"
+        fields = [start_key, end_key, str(limit), cursor or start_key]
+        if partition is not None:
+            fields.append(str(partition))
+        return cls(" ".join(["SCAN", *fields]), protocol.SCAN, *fields, partition=partition)
+
+    @classmethod
+    def watch(cls, prefix, after=None, limit=None, partition=None):
+        # The server drops one trailing "*", so a prefix ending in "*" survives
+        fields = [f"{prefix}*", "now" if after is None else str(after), str(limit or WATCH_BATCH)]
+        if partition is not None:
+            fields.append(str(partition))
+        return cls(" ".join(["WATCH", *fields]), protocol.WATCH, *fields, partition=partition)
+
+    @classmethod
+    def routes(cls):
+        return cls("ROUTES", protocol.ROUTES, partition=0)
+
+    @classmethod
+    def read_mode(cls, mode, max_staleness_ms=None):
+        fields = [mode] if max_staleness_ms is None else [mode, str(max_staleness_ms)]
+        return cls(" ".join(["READMODE", *fields]), protocol.READMODE, *fields)
+
+    @property
+    def is_read(self):
+        return self.opcode in READ_OPCODES
+
+
+DICT_REPLIES = (protocol.RANGE, protocol.MULTIGET, protocol.ROUTES)
+PAGED_REPLIES = (protocol.SCAN, protocol.WATCH)  # (items, cursor) tuples
+KEYED_OPCODES = (protocol.PUT, protocol.READ, protocol.DELETE)
+READ_OPCODES = (protocol.READ, protocol.MULTIGET, protocol.RANGE, protocol.SCAN)
+SCAN_PAGE = 1000  # entries fetched per SCAN round trip
+WATCH_BATCH = 1000  # events fetched per WATCH round trip
+# Read modes that any caught-up node can serve; reads in these modes are spread over all nodes
+SPREAD_READ_MODES = ("read-index", "stale-ok")
+NO_LEADER_REPLY = f"ERR {protocol.NO_LEADER}"
+
+
+def render_binary(opcode, status, values):
+    """Render a binary reply like its text-protocol equivalent."""
+    values = [protocol.to_str(v) for v in values]
+    if status == protocol.OK:
+        if opcode in DICT_REPLIES:
+            return dict(zip(values[::2], values[1::2]))
+        if opcode == protocol.SCAN:
+            cursor = values.pop() if len(values) % 2 else None
+            return list(zip(values[::2], values[1::2])), cursor
+        if opcode == protocol.WATCH:
+            next_index = values.pop()
+            return list(zip(values[::4], values[1::4], values[2::4], values[3::4])), next_index
+        return values[0] if values else "OK"
+    if status == protocol.NOT_FOUND:
+        return "NOT_FOUND"
+    if status == protocol.REDIRECT:
+        return f"REDIRECT {values[0]}"
+    return f"ERR {values[0] if values else ''}"
+
+
+def render_text(opcode, line):
+    if opcode in DICT_REPLIES and line.startswith("{") or opcode in PAGED_REPLIES and line.startswith("("):
+        return ast.literal_eval(line)
+    return line
+
+
+def command_partition(command, partitions):
+    """The partition a (single-partition) command goes to."""
+    if command.partition is not None:
+        return command.partition
+    if command.opcode in KEYED_OPCODES:
+        return protocol.partition_for(command.fields[0], partitions)
+    if command.opcode in (protocol.BATCHPUT, protocol.MULTIGET) and command.fields:
+        return protocol.partition_for(command.fields[0], partitions)
+    return 0
+
+
+def split_command(command, partitions):
+    """
+    Split a multi-key command into one command per partition it touches; RANGE
+    goes to every partition. Other commands are returned as they are.
+    """
+    if partitions == 1 or command.partition is not None:
+        return [command]
+    if command.opcode == protocol.RANGE:
+        return [Command.range_read(command.fields[0], command.fields[1], partition=p) for p in range(partitions)]
+    if command.opcode == protocol.BATCHPUT:
+        groups = collections.defaultdict(list)
+        for pair in zip(command.fields[::2], command.fields[1::2]):
+            groups[protocol.partition_for(pair[0], partitions)].append(pair)
+        return [Command.batch_put(pairs) for pairs in groups.values()]
+    if command.opcode == protocol.MULTIGET:
+        groups = collections.defaultdict(list)
+        for key in command.fields:
+            groups[protocol.partition_for(key, partitions)].append(key)
+        return [Command.multi_get(keys) for keys in groups.values()]
+    return [command]
+
+
+def merge_replies(results):
+    """Combine the replies of a split command: the first failure, else the merged dicts, else OK."""
+    if len(results) == 1:
+        return results[0]
+    for result in results:
+        if not isinstance(result, dict) and result != "OK":
+            return result
+    if any(isinstance(result, dict) for result in results):
+        merged = {}
+        for result in results:
+            merged.update(result)
+        return dict(sorted(merged.items()))
+    return "OK"
+
+
+def scan_page(result):
+    """(items, cursor) from a SCAN reply; anything else is a failure."""
+    if not isinstance(result, tuple):
+        raise KVClientError(f"SCAN failed: {result}")
+    return result
+
+
+def watch_batch(result):
+    """([WatchEvent], index to resume after) from a WATCH reply; anything else is a failure."""
+    if not isinstance(result, tuple):
+        raise KVClientError(f"WATCH failed: {result}")
+    events, next_index = result
+    return [WatchEvent(int(index), op, key, None if op == "DELETE" else value)
+            for index, op, key, value in events], int(next_index)
+
+
+def parse_routes(result):
+    """(partition count, {partition: leader port}) from a ROUTES reply; old nodes have one partition."""
+    if not isinstance(result, dict):
+        return 1, {}
+    routes = dict(result)
+    partitions = int(routes.pop("partitions", 1))
+    return partitions, {int(p): int(port) for p, port in routes.items() if port}
+
+
+def redirect_port(result):
+    """The leader port named by a REDIRECT reply, or None."""
+    if isinstance(result, str) and result.startswith("REDIRECT "):
+        try:
+            return int(result.split()[1])
+        except ValueError:
+            return None
+    return None
+
+
+class Pipeline:
+    """
+    Queue commands and send them back to back on one connection, then collect
+    every reply: one round trip for the whole batch.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def put(self, key, value, ttl=None):
+        self.commands.append(Command.put(key, value, ttl))
+        return self
+
+    def read(self, key):
+        self.commands.append(Command.read(key))
+        return self
+
+    def delete(self, key):
+        self.commands.append(Command.delete(key))
+        return self
+
+    def batch_put(self, kv_pairs):
+        self.commands.append(Command.batch_put(kv_pairs))
+        return self
+
+    def multi_get(self, keys):
+        self.commands.append(Command.multi_get(keys))
+        return self
+
+    def range_read(self, start_key, end_key):
+        self.commands.append(Command.range_read(start_key, end_key))
+        return self
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return self.client._execute_many(commands)
+
+
+class AsyncPipeline(Pipeline):
+    """Pipeline of an AsyncKVClient: the same queueing methods, and ``await pipe.execute()``."""
+
+    async def execute(self):
+        commands, self.commands = self.commands, []
+        return await self.client._execute_many(commands)
+
 
 class KVClient:
-    def __init__(self, nodes):
+    def __init__(self, nodes, binary=False, host="localhost", max_retries=5, backoff=0.05,
+                 max_backoff=1.0, timeout=5, read_mode=None, max_staleness_ms=None, partitions=None):
         """
         nodes: List of node base ports. Example: [5000, 5001, 5002]
+        binary: Use the length-prefixed binary protocol (negotiated per node,
+                falling back to text for nodes that do not support it).
+        max_retries: Failed attempts (unreachable node, timeout) tolerated per
+                command before giving up; waits grow exponentially from
+                ``backoff`` up to ``max_backoff`` seconds.
+        read_mode: Consistency of reads: None (whichever node is asked answers
+                from its own store), "leader-lease", "read-index" or "stale-ok"
+                (at most ``max_staleness_ms`` behind the leader). read-index and
+                stale-ok reads are spread over all nodes.
+        partitions: Number of hash partitions in the cluster; None asks a node
+                (ROUTES) before the first command.
+
+        One persistent connection is kept per node and shared by all threads.
+        Each partition's leader is remembered (the routing table) and REDIRECT
+        replies are followed directly. Multi-key commands are split by
+        partition; RANGE gathers every partition.
         """
         self.nodes = nodes
-        self.leader_port = None
+        self.host = host
+        self.partitions = partitions
+        self.leaders = {}  # partition -> leader port
+        self.binary = binary
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.read_mode = read_mode
+        self.max_staleness_ms = max_staleness_ms
+        self._conns = {}
+        self._text_only = set()
+        self._conns_lock = threading.Lock()
+        self._next_node = 0
+
+    @property
+    def leader_port(self):
+        """Leader of partition 0 (the only one when the cluster is not partitioned)."""
+        return self.leaders.get(0)
+
+    @leader_port.setter
+    def leader_port(self, port):
+        # Setting None forgets every cached leader
+        if port is None:
+            self.leaders.clear()
+        else:
+            self.leaders[0] = port
+
+    def refresh_routes(self):
+        """Fetch the partition count and every partition's leader from any node."""
+        self.partitions, leaders = parse_routes(self._execute(Command.routes()))
+        self.leaders = leaders
+
+    def _partition_count(self):
+        if self.partitions is None:
+            self.refresh_routes()
+        return self.partitions
+
+    def _partition(self, command):
+        return command.partition if command.partition is not None else command_partition(
+            command, self._partition_count())
 
     def _discover_leader(self):
         """Find leader from any available node."""
         for port in self.nodes:
             try:
-                resp = requests.get(f"http://localhost:{port+100}/health", timeout=1)
+                resp = requests.get(f"http://{self.host}:{port+100}/health", timeout=1)
                 if resp.status_code == 200:
-                    data = json.loads(resp.text.replace("'", '"'))
+                    data = resp.json()
                     if data.get("role") == "leader":
                         self.leader_port = data["leader"]
                         return
@@ -25,66 +459,557 @@ class KVClient:
                         return
             except Exception:
                 continue
-        raise Exception("No available leader found!")
-
-    def _send_command(self, port, command):
-        """Send a command to a specific node."""
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(("localhost", port))
-        s.sendall((command + "\n").encode())
-        data = s.recv(4096).decode().strip()
-        s.close()
-        return data
-
-    def _ensure_leader(self):
-        if not self.leader_port:
-            self._discover_leader()
-
-    def put(self, key, value):
-        self._ensure_leader()
-        try:
-            return self._send_command(self.leader_port, f"PUT {key} {value}")
-        except Exception:
-            self.leader_port = None
-            self._ensure_leader()
-            return self.put(key, value)
+        raise KVClientError("No available leader found!")
+
+    def _connection(self, port):
+        with self._conns_lock:
+            conn = self._conns.get(port)
+            if conn is not None and not conn.closed:
+                return conn
+            if self.binary and port not in self._text_only:
+                try:
+                    conn = BinaryConnection(self.host, port, self.timeout)
+                except protocol.ProtocolError:
+                    self._text_only.add(port)
+            if conn is None or conn.closed:
+                conn = TextConnection(self.host, port, self.timeout)
+            if self.read_mode:
+                self._set_read_mode(conn)
+            self._conns[port] = conn
+            return conn
+
+    def _set_read_mode(self, conn):
+        command = Command.read_mode(self.read_mode, self.max_staleness_ms)
+        if isinstance(conn, BinaryConnection):
+            reply = render_binary(command.opcode, *conn.request(command.opcode, *command.fields, timeout=self.timeout))
+        else:
+            reply = conn.request(command.text, timeout=self.timeout)
+        if reply != "OK":
+            conn.close()
+            raise KVClientError(f"node rejected read mode {self.read_mode!r}: {reply}")
+
+    def _drop_connection(self, port):
+        with self._conns_lock:
+            conn = self._conns.pop(port, None)
+        if conn is not None:
+            conn.close()
+
+    def _submit(self, port, command):
+        """Send ``command`` to ``port``; returns a callable that waits for the rendered reply."""
+        conn = self._connection(port)
+        if isinstance(conn, BinaryConnection):
+            future = conn.submit(command.opcode, *command.fields)
+            return lambda: render_binary(command.opcode, *future.result(self.timeout))
+        future = conn.submit(command.text)
+        return lambda: render_text(command.opcode, future.result(self.timeout))
+
+    def _spread(self, command):
+        return command.is_read and self.read_mode in SPREAD_READ_MODES
+
+    def _target(self, spread=False, partition=0):
+        leader = self.leaders.get(partition)
+        if leader and not spread:
+            return leader
+        port = self.nodes[self._next_node % len(self.nodes)]
+        self._next_node += 1
+        return port
+
+    def _backoff_delay(self, failures):
+        delay = min(self.max_backoff, self.backoff * (2 ** (failures - 1)))
+        return delay * random.uniform(0.5, 1.0)
+
+    def _execute(self, command, port=None):
+        spread, partition = self._spread(command), self._partition(command)
+        port = port or self._target(spread, partition)
+        failures = redirects = 0
+        while True:
+            try:
+                result = self._submit(port, command)()
+                if result == NO_LEADER_REPLY:
+                    raise KVClientError(protocol.NO_LEADER)
+            except (OSError, FutureTimeout, KVClientError) as e:
+                if not isinstance(e, KVClientError):
+                    self._drop_connection(port)
+                failures += 1
+                if failures > self.max_retries:
+                    raise KVClientError(f"{command.text.split()[0]} failed after {failures} attempts: {e}") from e
+                if self.leaders.get(partition) == port:
+                    del self.leaders[partition]
+                time.sleep(self._backoff_delay(failures))
+                port = self._target(spread, partition)
+                continue
+            leader = redirect_port(result)
+            if leader is None:
+                if not spread:
+                    self.leaders[partition] = port
+                return result
+            redirects += 1
+            if redirects > len(self.nodes):
+                raise KVClientError(f"redirect loop while sending {command.text.split()[0]}")
+            self.leaders[partition] = port = leader
+
+    def _run(self, command):
+        """Execute a command that may span partitions, merging the per-partition replies."""
+        commands = split_command(command, self._partition_count())
+        if len(commands) == 1:
+            return self._execute(commands[0])
+        return merge_replies(self._send_all(commands))
+
+    def _execute_many(self, commands):
+        count = self._partition_count() if commands else 1
+        parts = [split_command(command, count) for command in commands]
+        results = iter(self._send_all([sub for subs in parts for sub in subs]))
+        return [merge_replies([next(results) for _ in subs]) for subs in parts]
+
+    def _send_all(self, commands):
+        # Pipeline every command to its target node, then resend whatever failed one by one
+        sent = []
+        for command in commands:
+            port = self._target(self._spread(command), self._partition(command))
+            try:
+                sent.append((port, self._submit(port, command)))
+            except OSError:
+                self._drop_connection(port)
+                sent.append((port, None))
+        results = []
+        for command, (port, wait) in zip(commands, sent):
+            try:
+                result = wait() if wait is not None else None
+            except (OSError, FutureTimeout):
+                result = None
+            if result is None or result == NO_LEADER_REPLY or redirect_port(result) is not None:
+                # Resend whatever the connection lost or the node bounced on its own
+                result = self._execute(command, redirect_port(result) if result else None)
+            elif not self._spread(command):
+                self.leaders[self._partition(command)] = port
+            results.append(result)
+        return results
+
+    def pipeline(self):
+        return Pipeline(self)
+
+    def put(self, key, value, ttl=None):
+        """Write ``key``; with ``ttl`` (whole seconds) it expires that long after the leader accepts the write."""
+        return self._execute(Command.put(key, value, ttl))
 
     def read(self, key):
-        self._ensure_leader()
-        try:
-            return self._send_command(self.leader_port, f"READ {key}")
-        except Exception:
-            self.leader_port = None
-            self._ensure_leader()
-            return self.read(key)
+        return self._execute(Command.read(key))
 
     def delete(self, key):
-        self._ensure_leader()
-        try:
-            return self._send_command(self.leader_port, f"DELETE {key}")
-        except Exception:
-            self.leader_port = None
-            self._ensure_leader()
-            return self.delete(key)
+        return self._execute(Command.delete(key))
 
     def batch_put(self, kv_pairs):
         """
-        kv_pairs: List of tuples [(k1, v1), (k2, v2)]
+        kv_pairs: List of tuples [(k1, v1), (k2, v2)], written atomically
+        (within each partition, when the cluster is partitioned).
         """
-        self._ensure_leader()
-        batch_str = " ".join([f"{k}:{v}" for k, v in kv_pairs])
-        try:
-            return self._send_command(self.leader_port, f"BATCHPUT {batch_str}")
-        except Exception:
-            self.leader_port = None
-            self._ensure_leader()
-            return self.batch_put(kv_pairs)
+        return self._run(Command.batch_put(kv_pairs))
+
+    def multi_get(self, keys):
+        """Returns {key: value} for the keys that exist."""
+        return self._run(Command.multi_get(keys))
 
     def range_read(self, start_key, end_key):
-        self._ensure_leader()
+        return self._run(Command.range_read(start_key, end_key))
+
+    def scan(self, start_key, end_key, page_size=SCAN_PAGE):
+        """
+        Yield (key, value) from start_key to end_key inclusive in key order. The
+        range is fetched ``page_size`` entries at a time, each page resuming from
+        the cursor of the previous one, so ranges of any size can be read. With
+        partitions, every partition is paged through and the streams are merged.
+        """
+        partitions = self._partition_count()
+        if partitions == 1:
+            yield from self._scan_partition(start_key, end_key, page_size, None)
+        else:
+            yield from heapq.merge(*(self._scan_partition(start_key, end_key, page_size, p)
+                                     for p in range(partitions)))
+
+    def _scan_partition(self, start_key, end_key, page_size, partition):
+        cursor = None
+        while True:
+            items, cursor = scan_page(self._execute(Command.scan(start_key, end_key, page_size, cursor, partition)))
+            yield from items
+            if cursor is None:
+                return
+
+    def watch(self, prefix, from_index=None, partition=None, batch_size=WATCH_BATCH):
+        """
+        Yield a WatchEvent(index, op, key, value) for every committed PUT and DELETE of
+        a key starting with ``prefix`` ("" for every key), in log order, blocking for
+        more once caught up. ``from_index`` resumes after that log index; None starts
+        from now. The events of one log entry (a batch) share its index and arrive
+        together, so resume from the index of the last entry fully handled. Each
+        partition has its own log: a partitioned cluster is watched one ``partition``
+        at a time.
+
+        The watch gets connections of its own, so waiting for changes holds up no
+        other command. Events come ``batch_size`` at a time and the next batch is only
+        asked for once this one is consumed, so a slow consumer holds the feed back
+        instead of events piling up. Lost connections and leader changes are retried
+        from the last index; once that index has left the nodes' logs (a consumer
+        far behind) KVClientError is raised and the consumer must resync with scan().
+        """
+        if partition is None and self._partition_count() > 1:
+            raise KVClientError("watch() needs a partition on a partitioned cluster")
+        client = KVClient(self.nodes, binary=self.binary, host=self.host, max_retries=self.max_retries,
+                          backoff=self.backoff, max_backoff=self.max_backoff, timeout=self.timeout,
+                          partitions=self.partitions)
+        client.leaders = dict(self.leaders)
+        try:
+            while True:
+                events, from_index = watch_batch(
+                    client._execute(Command.watch(prefix, from_index, batch_size, partition)))
+                yield from events
+        finally:
+            client.close()
+
+    def close(self):
+        with self._conns_lock:
+            conns, self._conns = self._conns, {}
+        for conn in conns.values():
+            conn.close()
+
+
+class AsyncTextConnection:
+    """asyncio counterpart of TextConnection: replies resolve queued futures in order."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = collections.deque()
+        self.closed = False
+        self.task = asyncio.get_running_loop().create_task(self._read_loop())
+
+    @classmethod
+    async def open(cls, host, port, timeout=5):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        return cls(reader, writer)
+
+    async def submit(self, command):
+        if self.closed:
+            raise ConnectionError("connection closed")
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(future)
+        self.writer.write(protocol.to_bytes(command) + b"\n")
+        await self.writer.drain()
+        return future
+
+    async def _read_loop(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    raise ConnectionError("connection closed")
+                future = self.pending.popleft()
+                if not future.done():
+                    future.set_result(protocol.to_str(line).rstrip("\r\n"))
+        except Exception as e:
+            self._fail_pending(e)
+
+    def _fail_pending(self, error):
+        self.closed = True
+        pending, self.pending = self.pending, collections.deque()
+        for future in pending:
+            if not future.done():
+                future.set_exception(ConnectionError(f"connection lost: {error}"))
+
+    async def close(self):
+        self.closed = True
+        self.task.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (OSError, asyncio.CancelledError):
+            pass
+
+
+class AsyncBinaryConnection(AsyncTextConnection):
+    """asyncio counterpart of BinaryConnection: replies resolve futures by request id."""
+
+    def __init__(self, reader, writer):
+        self.ids = itertools.count(1)
+        super().__init__(reader, writer)
+        self.pending = {}
+
+    @classmethod
+    async def open(cls, host, port, timeout=5):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        writer.write(protocol.PREFACE)
+        try:
+            reply = await asyncio.wait_for(reader.readexactly(len(protocol.PREFACE)), timeout)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+            reply = b""
+        if reply != protocol.PREFACE:
+            writer.close()
+            raise protocol.ProtocolError(f"node {port} does not speak the binary protocol")
+        return cls(reader, writer)
+
+    async def submit(self, opcode, *fields):
+        if self.closed:
+            raise ConnectionError("connection closed")
+        future = asyncio.get_running_loop().create_future()
+        request_id = next(self.ids)
+        self.pending[request_id] = future
+        self.writer.write(protocol.encode_frame(request_id, opcode, fields))
+        await self.writer.drain()
+        return future
+
+    async def _read_loop(self):
         try:
-            return self._send_command(self.leader_port, f"RANGE {start_key} {end_key}")
-        except Exception:
-            self.leader_port = None
-            self._ensure_leader()
-            return self.range_read(start_key, end_key)
+            while True:
+                request_id, status, fields = await protocol.read_frame(self.reader)
+                future = self.pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result((status, fields))
+        except Exception as e:
+            self._fail_pending(e)
+
+    def _fail_pending(self, error):
+        self.closed = True
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"connection lost: {error}"))
+
+
+class AsyncKVClient:
+    """
+    asyncio version of KVClient with the same methods as coroutines. Concurrent
+    calls share one connection per node and pipeline on it; pipeline() queues
+    commands to send back to back like KVClient's, in order.
+    """
+
+    def __init__(self, nodes, binary=False, host="localhost", max_retries=5, backoff=0.05,
+                 max_backoff=1.0, timeout=5, read_mode=None, max_staleness_ms=None, partitions=None):
+        self.nodes = nodes
+        self.host = host
+        self.partitions = partitions
+        self.leaders = {}
+        self.binary = binary
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.read_mode = read_mode
+        self.max_staleness_ms = max_staleness_ms
+        self._conns = {}
+        self._connecting = {}
+        self._text_only = set()
+        self._next_node = 0
+
+    _target = KVClient._target
+    _spread = KVClient._spread
+    leader_port = KVClient.leader_port
+
+    async def refresh_routes(self):
+        self.partitions, leaders = parse_routes(await self._execute(Command.routes()))
+        self.leaders = leaders
+
+    async def _partition_count(self):
+        if self.partitions is None:
+            await self.refresh_routes()
+        return self.partitions
+
+    async def _partition(self, command):
+        if command.partition is not None:
+            return command.partition
+        return command_partition(command, await self._partition_count())
+    _backoff_delay = KVClient._backoff_delay
+
+    async def _connection(self, port):
+        conn = self._conns.get(port)
+        if conn is not None and not conn.closed:
+            return conn
+        # Concurrent callers wait on the same connection attempt
+        opening = self._connecting.get(port)
+        if opening is None:
+            opening = asyncio.ensure_future(self._open(port))
+            self._connecting[port] = opening
+            opening.add_done_callback(lambda _: self._connecting.pop(port, None))
+        return await asyncio.shield(opening)
+
+    async def _open(self, port):
+        conn = None
+        if self.binary and port not in self._text_only:
+            try:
+                conn = await AsyncBinaryConnection.open(self.host, port, self.timeout)
+            except protocol.ProtocolError:
+                self._text_only.add(port)
+        if conn is None:
+            conn = await AsyncTextConnection.open(self.host, port, self.timeout)
+        if self.read_mode:
+            reply = await self._send(conn, Command.read_mode(self.read_mode, self.max_staleness_ms))
+            if reply != "OK":
+                await conn.close()
+                raise KVClientError(f"node rejected read mode {self.read_mode!r}: {reply}")
+        self._conns[port] = conn
+        return conn
+
+    async def _drop_connection(self, port):
+        conn = self._conns.pop(port, None)
+        if conn is not None:
+            await conn.close()
+
+    async def _request(self, port, command):
+        return await self._send(await self._connection(port), command)
+
+    async def _send(self, conn, command):
+        return await (await self._submit_on(conn, command))
+
+    async def _submit(self, port, command):
+        return await self._submit_on(await self._connection(port), command)
+
+    async def _submit_on(self, conn, command):
+        """Send ``command`` without waiting for the reply; returns a coroutine of the rendered reply."""
+        if isinstance(conn, AsyncBinaryConnection):
+            future = await conn.submit(command.opcode, *command.fields)
+            return self._reply(future, lambda reply: render_binary(command.opcode, *reply))
+        future = await conn.submit(command.text)
+        return self._reply(future, lambda line: render_text(command.opcode, line))
+
+    async def _reply(self, future, render):
+        return render(await asyncio.wait_for(future, self.timeout))
+
+    async def _execute(self, command):
+        spread, partition = self._spread(command), await self._partition(command)
+        port = self._target(spread, partition)
+        failures = redirects = 0
+        while True:
+            try:
+                result = await self._request(port, command)
+                if result == NO_LEADER_REPLY:
+                    raise KVClientError(protocol.NO_LEADER)
+            except (OSError, asyncio.TimeoutError, KVClientError) as e:
+                if not isinstance(e, KVClientError):
+                    await self._drop_connection(port)
+                failures += 1
+                if failures > self.max_retries:
+                    raise KVClientError(f"{command.text.split()[0]} failed after {failures} attempts: {e}") from e
+                if self.leaders.get(partition) == port:
+                    del self.leaders[partition]
+                await asyncio.sleep(self._backoff_delay(failures))
+                port = self._target(spread, partition)
+                continue
+            leader = redirect_port(result)
+            if leader is None:
+                if not spread:
+                    self.leaders[partition] = port
+                return result
+            redirects += 1
+            if redirects > len(self.nodes):
+                raise KVClientError(f"redirect loop while sending {command.text.split()[0]}")
+            self.leaders[partition] = port = leader
+
+    async def _run(self, command):
+        commands = split_command(command, await self._partition_count())
+        if len(commands) == 1:
+            return await self._execute(commands[0])
+        return merge_replies(await asyncio.gather(*(self._execute(c) for c in commands)))
+
+    async def _execute_many(self, commands):
+        count = await self._partition_count() if commands else 1
+        parts = [split_command(command, count) for command in commands]
+        results = iter(await self._send_all([sub for subs in parts for sub in subs]))
+        return [merge_replies([next(results) for _ in subs]) for subs in parts]
+
+    async def _send_all(self, commands):
+        # Pipeline every command to its target node, then resend whatever failed one by one
+        sent = []
+        for command in commands:
+            partition = await self._partition(command)
+            port = self._target(self._spread(command), partition)
+            try:
+                sent.append((port, partition, await self._submit(port, command)))
+            except OSError:
+                await self._drop_connection(port)
+                sent.append((port, partition, None))
+        results = []
+        for command, (port, partition, reply) in zip(commands, sent):
+            try:
+                result = await reply if reply is not None else None
+            except (OSError, asyncio.TimeoutError):
+                result = None
+            if result is None or result == NO_LEADER_REPLY or redirect_port(result) is not None:
+                # Resend whatever the connection lost or the node bounced on its own
+                if redirect_port(result) is not None:
+                    self.leaders[partition] = redirect_port(result)
+                result = await self._execute(command)
+            elif not self._spread(command):
+                self.leaders[partition] = port
+            results.append(result)
+        return results
+
+    def pipeline(self):
+        return AsyncPipeline(self)
+
+    async def put(self, key, value, ttl=None):
+        return await self._execute(Command.put(key, value, ttl))
+
+    async def read(self, key):
+        return await self._execute(Command.read(key))
+
+    async def delete(self, key):
+        return await self._execute(Command.delete(key))
+
+    async def batch_put(self, kv_pairs):
+        return await self._run(Command.batch_put(kv_pairs))
+
+    async def multi_get(self, keys):
+        return await self._run(Command.multi_get(keys))
+
+    async def range_read(self, start_key, end_key):
+        return await self._run(Command.range_read(start_key, end_key))
+
+    async def scan(self, start_key, end_key, page_size=SCAN_PAGE):
+        """Async generator counterpart of KVClient.scan."""
+        partitions = await self._partition_count()
+        streams = [self._scan_partition(start_key, end_key, page_size, None if partitions == 1 else p)
+                   for p in range(partitions)]
+        heads = []
+        for index, stream in enumerate(streams):
+            async for item in stream:
+                heads.append((item, index))
+                break
+        heapq.heapify(heads)
+        while heads:
+            item, index = heads[0]
+            yield item
+            async for item in streams[index]:
+                heapq.heapreplace(heads, (item, index))
+                break
+            else:
+                heapq.heappop(heads)
+
+    async def _scan_partition(self, start_key, end_key, page_size, partition):
+        cursor = None
+        while True:
+            command = Command.scan(start_key, end_key, page_size, cursor, partition)
+            items, cursor = scan_page(await self._execute(command))
+            for item in items:
+                yield item
+            if cursor is None:
+                return
+
+    async def watch(self, prefix, from_index=None, partition=None, batch_size=WATCH_BATCH):
+        """Async generator counterpart of KVClient.watch."""
+        if partition is None and await self._partition_count() > 1:
+            raise KVClientError("watch() needs a partition on a partitioned cluster")
+        client = AsyncKVClient(self.nodes, binary=self.binary, host=self.host, max_retries=self.max_retries,
+                               backoff=self.backoff, max_backoff=self.max_backoff, timeout=self.timeout,
+                               partitions=self.partitions)
+        client.leaders = dict(self.leaders)
+        try:
+            while True:
+                events, from_index = watch_batch(
+                    await client._execute(Command.watch(prefix, from_index, batch_size, partition)))
+                for event in events:
+                    yield event
+        finally:
+            await client.close()
+
+    async def close(self):
+        conns, self._conns = self._conns, {}
+        for conn in conns.values():
+            await conn.close()
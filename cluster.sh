@@ -9,6 +9,7 @@
 VENV=".venv"
 PORT_BASE=6000
 NUM_NODES=3
+PARTITIONS=${PARTITIONS:-1}   # hash partitions (Raft groups) per node
 PYTHON="$VENV/bin/python3"
 
 # ---------------------------
@@ -48,7 +49,7 @@ start_cluster() {
     for ((i=0; i<$NUM_NODES; i++)); do
         local port=$((PORT_BASE+i))
         local peers=$(get_peers $port)
-        $PYTHON server.py --port $port --peers $peers > "node_$port.log" 2>&1 &
+        $PYTHON server.py --port $port --peers $peers --data-dir "data/node_$port" --partitions $PARTITIONS > "node_$port.log" 2>&1 &
         sleep 1
         echo "KV Store running on port $port..."
     done
@@ -83,14 +84,14 @@ check_health() {
     echo "=== CLUSTER HEALTH CHECK ==="
     for ((i=0; i<$NUM_NODES; i++)); do
         local port=$((PORT_BASE+i))
-        STATUS=$(curl -s "http://localhost:$port/health" || echo "")
+        STATUS=$(curl -s "http://localhost:$((port + 100))/health" || echo "")
         ROLE=$(echo "$STATUS" | grep -o '"role":"[^"]*' | cut -d'"' -f4)
 
         if [[ -z "$ROLE" ]]; then
             echo "Node $port: ❌ Down. Restarting..."
             pkill -f "server.py --port $port" || true
             peers=$(get_peers $port)
-            $PYTHON server.py --port $port --peers $peers > "node_$port.log" 2>&1 &
+            $PYTHON server.py --port $port --peers $peers --data-dir "data/node_$port" --partitions $PARTITIONS > "node_$port.log" 2>&1 &
             echo "✅ Node $port restarted successfully."
         else
             echo "Node $port: ✅ $ROLE"
@@ -1,3 +1,4 @@
+import argparse
 import os
 import time
 from client import KVClient
@@ -5,28 +6,33 @@ from client import KVClient
 def kill_leader(port):
     print(f"\n[FAILOVER] Killing leader on port {port}...")
     os.system(f"lsof -ti :{port} | xargs kill -9 || true")
-    time.sleep(2)
 
 if __name__ == "__main__":
-    client = KVClient([5000, 5001, 5002])
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ports", type=str, default="5000,5001,5002")
+    args = parser.parse_args()
+    # Retry quickly and for long enough to ride out an election
+    client = KVClient([int(p) for p in args.ports.split(",")], max_retries=100, backoff=0.01, max_backoff=0.1)
 
     print("\n[STEP 1] Writing initial data...")
     print(client.put("user", "Mukesh"))
     print(client.read("user"))
 
-    # Identify current leader
-    client._discover_leader()
+    # The client remembers the leader that accepted the write
     current_leader = client.leader_port
     print(f"\n[INFO] Current leader is on port {current_leader}")
 
     # Kill the leader
     kill_leader(current_leader)
+    killed_at = time.monotonic()
 
     print("\n[STEP 2] Writing after failover...")
     print(client.put("city", "Pune"))  # Should auto-redirect to new leader
+    failover_seconds = time.monotonic() - killed_at
+    print(f"[INFO] New leader {client.leader_port} accepted a write {failover_seconds * 1000:.0f} ms after the kill")
     print(client.read("city"))
 
     print("\n[STEP 3] Verifying previous data is still available...")
     print(client.read("user"))
 
-    print("\n✅ Failover successful! Client automatically redirected to new leader.")
+    print(f"\n✅ Failover successful in {failover_seconds:.2f}s! Client automatically redirected to new leader.")
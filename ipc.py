@@ -0,0 +1,42 @@
+"""
+Framing for the channel between ``server.py --workers`` processes and the
+process that owns the stores and Raft state (a Unix socket).
+
+Every message is  u32 length | marshal payload. Both ends are the same
+interpreter, which marshal requires, and payloads are plain tuples, lists,
+dicts and strings, so encoding is a single C call each way. Writers batch all
+frames produced in one event loop iteration into one socket write.
+"""
+import marshal
+import struct
+
+LENGTH = struct.Struct("<I")
+
+
+def encode(message):
+    data = marshal.dumps(message)
+    return LENGTH.pack(len(data)) + data
+
+
+async def read_message(reader):
+    (length,) = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+    return marshal.loads(await reader.readexactly(length))
+
+
+class Outbox:
+    """Collects encoded frames and writes them with one call, once per loop iteration."""
+
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+        self.frames = []
+
+    def send(self, message):
+        self.frames.append(encode(message))
+        if len(self.frames) == 1:
+            self.loop.call_soon(self.flush)
+
+    def flush(self):
+        frames, self.frames = self.frames, []
+        if frames and not self.writer.is_closing():
+            self.writer.write(b"".join(frames))
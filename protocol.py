@@ -0,0 +1,133 @@
+"""
+Binary client protocol.
+
+A client opts in by sending PREFACE as the very first bytes of a connection;
+the server echoes it back. Text-protocol commands never start with a NUL
+byte, so both protocols share the node's port.
+
+Every frame is  u32 frame length | u32 request id | u8 code | fields
+where code is the opcode (requests) or status (responses) and fields is a
+sequence of u32-length-prefixed byte strings. Request ids let a client keep
+many requests outstanding on one connection; responses may arrive in any order.
+"""
+import struct
+import zlib
+
+PREFACE = b"\x00KVB\x01"
+FRAME_HEADER = struct.Struct("<IIB")  # length of the rest of the frame, request id, opcode/status
+FIELD_LEN = struct.Struct("<I")
+HEADER_AFTER_LENGTH = FRAME_HEADER.size - 4  # the frame length counts request id + code + fields
+MAX_FRAME_BYTES = 64 * 1024 * 1024
+
+# Opcodes
+PUT = 1
+READ = 2
+DELETE = 3
+BATCHPUT = 4
+RANGE = 5
+PING = 6
+MULTIGET = 7
+READMODE = 8
+ROUTES = 9
+SCAN = 10
+WATCH = 11
+
+OPCODE_NAMES = {PUT: "PUT", READ: "READ", DELETE: "DELETE", BATCHPUT: "BATCHPUT", RANGE: "RANGE", PING: "PING",
+                MULTIGET: "MULTIGET", READMODE: "READMODE", ROUTES: "ROUTES", SCAN: "SCAN", WATCH: "WATCH"}
+OPCODES = {name: code for code, name in OPCODE_NAMES.items()}
+
+# Statuses
+OK = 0
+NOT_FOUND = 1
+REDIRECT = 2
+ERROR = 3
+
+NO_LEADER = "no leader elected"  # ERROR message while an election is under way; worth retrying
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def to_bytes(item):
+    if isinstance(item, (bytes, bytearray, memoryview)):
+        return bytes(item)
+    return str(item).encode("utf-8", "surrogateescape")
+
+
+def partition_for(key, partitions):
+    """The hash partition (0 .. partitions - 1) that owns ``key``."""
+    return zlib.crc32(to_bytes(key)) % partitions if partitions > 1 else 0
+
+
+def to_str(data):
+    # surrogateescape lets arbitrary (non UTF-8) bytes round-trip through the str-based store
+    return bytes(data).decode("utf-8", "surrogateescape")
+
+
+def encode_frame(request_id, code, fields=()):
+    return b"".join(frame_parts(request_id, code, fields))
+
+
+def frame_parts(request_id, code, fields=()):
+    """
+    A frame as a list of buffers for writelines() (a gathered sendmsg where the
+    transport supports it): bytes and memoryview fields are passed through as
+    they are instead of being copied into one frame body.
+    """
+    parts, length = [None], HEADER_AFTER_LENGTH
+    for field in fields:
+        if not isinstance(field, (bytes, memoryview)):
+            field = to_bytes(field)
+        parts.append(FIELD_LEN.pack(len(field)))
+        parts.append(field)
+        length += FIELD_LEN.size + len(field)
+    parts[0] = FRAME_HEADER.pack(length, request_id, code)
+    return parts
+
+
+def decode_fields(body):
+    fields, offset = [], 0
+    while offset < len(body):
+        if offset + FIELD_LEN.size > len(body):
+            raise ProtocolError("truncated field header")
+        (length,) = FIELD_LEN.unpack_from(body, offset)
+        offset += FIELD_LEN.size
+        if offset + length > len(body):
+            raise ProtocolError("truncated field")
+        fields.append(bytes(body[offset:offset + length]))
+        offset += length
+    return fields
+
+
+def split_frame_header(header):
+    """Return (body length, request id, code) for the FRAME_HEADER bytes of a frame."""
+    length, request_id, code = FRAME_HEADER.unpack(header)
+    body_length = length - HEADER_AFTER_LENGTH
+    if body_length < 0 or body_length > MAX_FRAME_BYTES:
+        raise ProtocolError(f"bad frame length {length}")
+    return body_length, request_id, code
+
+
+async def read_frame(reader):
+    """Read one frame from an asyncio StreamReader; returns (request id, code, fields)."""
+    body_length, request_id, code = split_frame_header(await reader.readexactly(FRAME_HEADER.size))
+    body = await reader.readexactly(body_length) if body_length else b""
+    return request_id, code, decode_fields(body)
+
+
+def recv_exactly(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return bytes(data)
+
+
+def recv_frame(sock):
+    """Blocking counterpart of read_frame for plain sockets."""
+    body_length, request_id, code = split_frame_header(recv_exactly(sock, FRAME_HEADER.size))
+    body = recv_exactly(sock, body_length) if body_length else b""
+    return request_id, code, decode_fields(body)
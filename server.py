@@ -1,150 +1,886 @@
-import socket
+import asyncio
+import heapq
+import json
 import threading
 import argparse
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor
+import ipc
+import protocol
+from store import metrics
 from store.kv import KeyValueStore
-from store.raft import RaftNode
+from store.raft import READ_MODES, LogCompactedError, NotLeaderError, RaftNode
+from store.ttl import deadline
 from http.server import BaseHTTPRequestHandler, HTTPServer
-import threading
 
-def handle_client(conn, store, raft_node):
-    with conn:
+MAX_LINE_BYTES = 16 * 1024 * 1024  # longest command line a client may send
+MAX_IN_FLIGHT = 128                # pipelined commands per connection before we stop reading
+WRITE_COMMANDS = ("PUT", "DELETE", "BATCHPUT")
+SINGLE_KEY_COMMANDS = ("PUT", "DELETE", "READ")
+MULTI_KEY_COMMANDS = ("BATCHPUT", "MULTIGET")
+READ_COMMANDS = ("READ", "MULTIGET", "RANGE", "SCAN")
+ARITY = {"PUT": 2, "DELETE": 1, "READ": 1, "BATCHPUT": 1, "MULTIGET": 1, "RANGE": 2, "PING": 0, "READMODE": 1,
+         "ROUTES": 0, "SCAN": 2, "WATCH": 1}
+SCAN_PAGE = 1000       # SCAN entries per reply when no limit is given
+MAX_SCAN_PAGE = 10000
+WATCH_BATCH = 1000     # WATCH events per reply when no limit is given
+MAX_WATCH_BATCH = 10000
+WATCH_WAIT = 1.0       # seconds a WATCH waits for a matching change before replying with none
+
+
+class Partitions:
+    """
+    The hash partitions a node serves: one (KeyValueStore, RaftNode) pair per
+    partition, each replicated by its own Raft group. Keys map to partitions
+    with protocol.partition_for, on the server and in KVClient alike.
+    """
+
+    def __init__(self, members):
+        self.members = list(members)
+
+    def __len__(self):
+        return len(self.members)
+
+    def __getitem__(self, index):
+        return self.members[index]
+
+    def for_key(self, key):
+        return self.members[protocol.partition_for(key, len(self.members))]
+
+    def group(self, items, key=lambda item: item):
+        """Split ``items`` into {partition index: [items]} by ``key(item)``."""
+        groups = {}
+        for item in items:
+            groups.setdefault(protocol.partition_for(key(item), len(self.members)), []).append(item)
+        return groups
+
+    def routes(self):
+        """{"partitions": count, "<index>": leader port or ""} as strings, for ROUTES."""
+        routes = {"partitions": str(len(self.members))}
+        for index, (_, raft_node) in enumerate(self.members):
+            routes[str(index)] = str(raft_node.leader or "")
+        return routes
+
+
+def execute_routed(cmd, args, partitions, read_mode=None):
+    """
+    Run a command against the partitions it touches. Single-key commands go to
+    their key's partition. BATCHPUT and MULTIGET are split by partition, so a
+    batch is atomic within each partition only. RANGE gathers every partition,
+    or only the one named by its optional third argument; SCAN likewise, with
+    the partition as its optional fifth argument.
+    """
+    if cmd == "ROUTES":
+        return protocol.OK, partitions.routes()
+    if len(partitions) == 1:
+        return execute(cmd, args, *partitions[0], read_mode)
+    if cmd in SINGLE_KEY_COMMANDS and args:
+        return execute(cmd, args, *partitions.for_key(args[0]), read_mode)
+    if cmd in MULTI_KEY_COMMANDS and args and args[0]:
+        groups = partitions.group(args[0], key=(lambda item: item[0]) if cmd == "BATCHPUT" else (lambda k: k))
+        return _gather([execute(cmd, [items], *partitions[index], read_mode) for index, items in groups.items()])
+    if cmd == "RANGE" and len(args) > 2:
+        try:
+            store, raft_node = partitions[int(args[2])]
+        except (ValueError, IndexError):
+            return protocol.ERROR, f"no partition {args[2]!r}"
+        return execute(cmd, args, store, raft_node, read_mode)
+    if cmd == "RANGE":
+        status, result = _gather([execute(cmd, args, store, raft_node, read_mode) for store, raft_node in partitions])
+        return (status, dict(sorted(result.items()))) if status == protocol.OK else (status, result)
+    if cmd == "SCAN" and len(args) > 4:
+        try:
+            store, raft_node = partitions[int(args[4])]
+        except (ValueError, IndexError):
+            return protocol.ERROR, f"no partition {args[4]!r}"
+        return execute(cmd, args, store, raft_node, read_mode)
+    if cmd == "SCAN":
+        pages = [execute(cmd, args, store, raft_node, read_mode) for store, raft_node in partitions]
+        failed = [(status, result) for status, result in pages if status != protocol.OK]
+        if failed:
+            return failed[0]
+        return protocol.OK, merge_scan_pages([page for _, page in pages], parse_scan_args(args)[2])
+    return execute(cmd, args, *partitions[0], read_mode)
+
+
+def _gather(responses):
+    # The first failure wins; otherwise dict results are merged
+    merged = None
+    for status, result in responses:
+        if status != protocol.OK:
+            return status, result
+        if isinstance(result, dict):
+            merged = {**(merged or {}), **result}
+    return protocol.OK, merged
+
+
+def execute(cmd, args, store, raft_node, read_mode=None):
+    """
+    Run one parsed command and return (status, result) using the protocol status
+    codes: OK with None, a value or a dict (RANGE, MULTIGET); NOT_FOUND; REDIRECT
+    with the leader; ERROR with a message.
+
+    Writes are applied to ``store`` by the Raft log once committed. Reads with a
+    ``read_mode`` of (mode, max staleness) first pass the node's read barrier.
+    """
+    if cmd not in ARITY:
+        return protocol.ERROR, f"unknown command {cmd}"
+    if len(args) < ARITY[cmd]:
+        return protocol.ERROR, f"wrong number of arguments for {cmd}"
+
+    if cmd in WRITE_COMMANDS and raft_node.state != "leader":
+        return not_leader_response(raft_node.leader)
+
+    try:
+        if read_mode is not None and cmd in READ_COMMANDS:
+            raft_node.read_barrier(*read_mode)
+        if cmd == "PUT":
+            key, value = args[0], args[1]
+            if len(args) > 2 and args[2]:
+                # The deadline is fixed here, once, so every replica expires the key at the same time
+                raft_node.replicate_log(("PUTEX", key, [value, deadline(args[2])]))
+            else:
+                raft_node.replicate_log(("PUT", key, value))
+            return protocol.OK, None
+        elif cmd == "DELETE":
+            key = args[0]
+            raft_node.replicate_log(("DEL", key, None))
+            return protocol.OK, None
+        elif cmd == "READ":
+            value = store.read(args[0])
+            return (protocol.NOT_FOUND, None) if value is None else (protocol.OK, value)
+        elif cmd == "BATCHPUT":
+            items = args[0]
+            if not items:
+                return protocol.ERROR, "BATCHPUT needs at least one key/value pair"
+            # The whole batch is one replicated entry and one WAL record
+            raft_node.replicate_log(("BATCH", [("PUT", k, v) for k, v in items], None))
+            return protocol.OK, None
+        elif cmd == "MULTIGET":
+            return protocol.OK, store.multi_get(args[0])
+        elif cmd == "RANGE":
+            start, end = args[0], args[1]
+            return protocol.OK, store.read_key_range(start, end)
+        elif cmd == "SCAN":
+            return protocol.OK, scan_page(store, *parse_scan_args(args))
+        elif cmd == "PING":
+            return protocol.OK, "PONG"
+        elif cmd == "READMODE":
+            parse_read_mode(args)  # per-connection state lives in CommandScheduler
+            return protocol.OK, None
+    except NotLeaderError as e:
+        return not_leader_response(e.leader)
+    except Exception as e:
+        return protocol.ERROR, str(e)
+
+
+def not_leader_response(leader):
+    if leader:
+        return protocol.REDIRECT, leader
+    return protocol.ERROR, protocol.NO_LEADER
+
+
+def parse_read_mode(args):
+    """READMODE arguments: a mode from READ_MODES and, for stale-ok, the bound in milliseconds."""
+    mode = args[0].lower()
+    if mode not in READ_MODES:
+        raise ValueError(f"unknown read mode {args[0]!r}, expected one of {', '.join(READ_MODES)}")
+    max_staleness = int(args[1]) / 1000.0 if len(args) > 1 and args[1] else None
+    return mode, max_staleness
+
+
+def parse_scan_args(args):
+    """SCAN arguments: start, end, then optionally the page size and the cursor to resume from."""
+    start, end = args[0], args[1]
+    limit = int(args[2]) if len(args) > 2 and args[2] else SCAN_PAGE
+    if not 0 < limit <= MAX_SCAN_PAGE:
+        raise ValueError(f"SCAN limit must be between 1 and {MAX_SCAN_PAGE}")
+    cursor = args[3] if len(args) > 3 and args[3] else None
+    return start, end, limit, cursor
+
+
+def parse_watch_args(args):
+    """
+    WATCH arguments: the key prefix ("*" for every key, a trailing "*" is optional),
+    then optionally the log index to resume after ("now" for the current position,
+    the default), the batch size and the partition.
+    """
+    prefix = args[0][:-1] if args[0].endswith("*") else args[0]
+    after = int(args[1]) if len(args) > 1 and args[1] and args[1] != "now" else None
+    limit = int(args[2]) if len(args) > 2 and args[2] else WATCH_BATCH
+    if not 0 < limit <= MAX_WATCH_BATCH:
+        raise ValueError(f"WATCH limit must be between 1 and {MAX_WATCH_BATCH}")
+    partition = int(args[3]) if len(args) > 3 and args[3] else None
+    return prefix, after, limit, partition
+
+
+async def watch_changes(raft_node, executor, prefix, after, limit, wait=WATCH_WAIT):
+    """
+    Long-poll ``raft_node.changes``: return (events, next index) as soon as there
+    are committed changes under ``prefix`` after ``after``, or no events once
+    ``wait`` seconds pass without any. Waiting holds no thread: the node wakes us
+    through a watcher callback whenever its applied position moves.
+    """
+    loop = asyncio.get_running_loop()
+    woken = asyncio.Event()
+
+    def wake():
+        loop.call_soon_threadsafe(woken.set)
+
+    raft_node.add_watcher(wake)
+    try:
+        until = loop.time() + wait
         while True:
-            data = conn.recv(1024).decode()
-            if not data: break
-            parts = data.strip().split(" ", 2)
-            cmd = parts[0].upper()
-
-            if cmd in ["PUT", "DELETE", "BATCHPUT"] and raft_node.state != "leader":
-                leader = raft_node.leader
-                if leader:
-                    conn.sendall(f"REDIRECT {leader}\n".encode())
+            woken.clear()
+            # changes() takes the node's lock, which log appends hold across an fsync
+            events, next_index = await loop.run_in_executor(executor, raft_node.changes, after, prefix, limit)
+            if events or after is None:
+                return events, next_index
+            if next_index > after:
+                after = next_index  # entries with no matching key: look further right away
+                continue
+            remaining = until - loop.time()
+            if remaining <= 0:
+                return events, next_index
+            try:
+                await asyncio.wait_for(woken.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        raft_node.remove_watcher(wake)
+
+
+async def watch(args, partitions, executor):
+    """Run a WATCH: (OK, ([(index, op, key, value)], next index)); DELETE events carry an empty value."""
+    if len(args) < ARITY["WATCH"]:
+        return protocol.ERROR, "wrong number of arguments for WATCH"
+    try:
+        prefix, after, limit, partition = parse_watch_args(args)
+        if partition is None and len(partitions) > 1:
+            raise ValueError(f"WATCH needs a partition (0-{len(partitions) - 1}): each has its own log")
+        try:
+            _, raft_node = partitions[partition or 0]
+        except IndexError:
+            raise ValueError(f"no partition {partition!r}") from None
+        events, next_index = await watch_changes(raft_node, executor, prefix, after, limit)
+    except (ValueError, LogCompactedError) as e:
+        return protocol.ERROR, str(e)
+    return protocol.OK, ([(i, op, k, "" if v is None else v) for i, op, k, v in events], next_index)
+
+
+def scan_page(store, start, end, limit, cursor=None):
+    """
+    One page of a SCAN: ([(key, value)] of at most ``limit`` entries, cursor). The
+    cursor is the next key of the range, which the following SCAN resumes from,
+    or None once the range is exhausted.
+    """
+    if cursor is not None:
+        start = max(start, cursor)
+    items = list(itertools.islice(store.scan(start, end), limit + 1))
+    cursor = items.pop()[0] if len(items) > limit else None
+    return items, cursor
+
+
+def merge_scan_pages(pages, limit):
+    """
+    Combine one SCAN page per partition into a page of the whole keyspace. Every
+    partition has returned all of its keys below its own cursor, so the merged
+    page may only run up to the smallest of those cursors.
+    """
+    cursors = [cursor for _, cursor in pages if cursor is not None]
+    bound = min(cursors) if cursors else None
+    items = [item for item in heapq.merge(*(items for items, _ in pages)) if bound is None or item[0] < bound]
+    if len(items) > limit:
+        return items[:limit], items[limit][0]
+    return items, bound
+
+
+def parse_text_command(line):
+    parts = line.strip().split(" ", 2)
+    cmd = parts[0].upper()
+    args = parts[1:]
+    if cmd == "PUT" and len(args) == 2:
+        args = [args[0], *parse_put_value(args[1])]
+    elif cmd in ("RANGE", "SCAN", "WATCH"):
+        args = line.split()[1:]
+    elif cmd == "BATCHPUT":
+        args = [parse_batch_items(line.split()[1:])]
+    elif cmd == "MULTIGET":
+        args = [line.split()[1:]]
+    return cmd, args
+
+
+def parse_put_value(text):
+    """
+    Split the rest of a text PUT into [value] or, when it ends with ``EX <seconds>``,
+    [value, seconds]. The value itself may contain spaces.
+    """
+    parts = text.rsplit(" ", 2)
+    if len(parts) == 3 and parts[1].upper() == "EX" and parts[2].isdigit():
+        return [parts[0], parts[2]]
+    return [text]
+
+
+def parse_batch_items(tokens):
+    """Parse BATCHPUT's ``key:value`` tokens; the key ends at the first colon."""
+    items = []
+    for token in tokens:
+        key, sep, value = token.partition(":")
+        if not sep or not key:
+            raise ValueError(f"BATCHPUT items must be key:value, got {token!r}")
+        items.append((key, value))
+    return items
+
+
+def format_text_response(status, result):
+    if status == protocol.OK:
+        return "OK" if result is None else str(result)
+    if status == protocol.NOT_FOUND:
+        return "NOT_FOUND"
+    if status == protocol.REDIRECT:
+        return f"REDIRECT {result}"
+    return f"ERR {result}"
+
+
+def execute_command(line, store, raft_node):
+    """Run one text-protocol command and return the response line (without newline)."""
+    try:
+        cmd, args = parse_text_command(line)
+    except Exception as e:
+        return format_text_response(protocol.ERROR, e)
+    return format_text_response(*execute(cmd, args, store, raft_node))
+
+
+def parse_binary_command(opcode, fields):
+    cmd = protocol.OPCODE_NAMES.get(opcode, f"OPCODE_{opcode}")
+    args = [protocol.to_str(f) for f in fields]
+    if cmd == "BATCHPUT":
+        if len(args) % 2:
+            raise protocol.ProtocolError("BATCHPUT needs key/value pairs")
+        args = [list(zip(args[::2], args[1::2]))]
+    elif cmd == "MULTIGET":
+        args = [args]
+    return cmd, args
+
+
+def command_keys(cmd, args):
+    """Keys a parsed command touches, or None when it may touch any key."""
+    if cmd in SINGLE_KEY_COMMANDS and args:
+        return [args[0]]
+    if cmd in MULTI_KEY_COMMANDS and args:
+        return [k for k, _ in args[0]] if cmd == "BATCHPUT" else list(args[0])
+    return None
+
+
+def binary_response_fields(status, result):
+    if result is None:
+        return []
+    if isinstance(result, dict):
+        return [item for pair in result.items() for item in pair]
+    if isinstance(result, tuple):
+        # A SCAN page (key/value pairs, then the cursor when there is more to read) or a
+        # WATCH batch (index/op/key/value events, then the index to resume after)
+        items, cursor = result
+        return [item for pair in items for item in pair] + ([cursor] if cursor is not None else [])
+    return [result]
+
+
+class CommandScheduler:
+    """
+    Per-connection command ordering. A command waits for earlier in-flight
+    commands on the keys it touches. One that may touch any key (RANGE, SCAN)
+    waits for everything in flight and is a barrier every later command waits
+    for. So pipelined clients always observe their own writes and never a later
+    one, while commands on different keys run concurrently in the executor and
+    share group commits.
+    """
+
+    def __init__(self, executor, partitions):
+        self.loop = asyncio.get_running_loop()
+        self.executor = executor
+        self.partitions = partitions
+        self.in_flight = {}  # key -> future of the newest command touching it
+        self.barrier = None  # future of the newest in-flight command that may touch any key
+        self.last_peer = None
+        self.read_mode = None  # (mode, max staleness) set by READMODE
+
+    def submit(self, cmd, args):
+        """Schedule a parsed command; returns a future of (status, result)."""
+        if cmd == "READMODE":
+            try:
+                self.read_mode = parse_read_mode(args)
+            except (IndexError, ValueError) as e:
+                return _done(self.loop, (protocol.ERROR, str(e)))
+            return _done(self.loop, (protocol.OK, None))
+        if cmd == "WATCH":
+            # A long poll: it waits on the event loop, not in the executor, and orders after nothing
+            return asyncio.ensure_future(watch(args, self.partitions, self.executor))
+        keys = command_keys(cmd, args)
+        if keys is not None:
+            deps = {self.in_flight[k] for k in keys if k in self.in_flight}
+        else:
+            deps = set(self.in_flight.values())
+        if self.barrier is not None:
+            deps.add(self.barrier)
+        deps = list(deps)
+        if cmd == "READ" and not deps and args:
+            store, raft_node = self.partitions.for_key(args[0])
+            if self.read_mode is None or raft_node.local_read_ok(*self.read_mode):
+                # A read served from memory is answered inline; one that needs an SSTable
+                # goes to the executor like any other command
+                found, value = store.read_cached(args[0])
+                if found:
+                    return _done(self.loop, (protocol.NOT_FOUND, None) if value is None else (protocol.OK, value))
+        pending = asyncio.ensure_future(
+            self._run_after(deps, execute_routed, cmd, args, self.partitions, self.read_mode))
+        if keys is None:
+            self.barrier = pending
+            pending.add_done_callback(self._clear_barrier)
+            return pending
+        for k in keys:
+            self.in_flight[k] = pending
+        pending.add_done_callback(lambda f: [self.in_flight.pop(k) for k in keys if self.in_flight.get(k) is f])
+        return pending
+
+    def _clear_barrier(self, future):
+        if self.barrier is future:
+            self.barrier = None
+
+    def submit_peer(self, line):
+        """Raft peer messages on a connection are handled one at a time, in arrival order."""
+        deps = [self.last_peer] if self.last_peer is not None and not self.last_peer.done() else []
+        self.last_peer = asyncio.ensure_future(self._run_after(deps, _handle_peer_message, line, self.partitions))
+        return self.last_peer
+
+    async def _run_after(self, deps, fn, *args):
+        if deps:
+            await asyncio.wait(deps)
+        return await self.loop.run_in_executor(self.executor, fn, *args)
+
+    def close(self):
+        pass
+
+
+class OwnerLink:
+    """
+    A worker process's connection to the storage owner. Requests from all of the
+    worker's client connections are multiplexed over it as (request id, session,
+    kind, payload) messages, batched per loop iteration by ipc.Outbox.
+    """
+
+    def __init__(self, reader, writer):
+        self.loop = asyncio.get_running_loop()
+        self.outbox = ipc.Outbox(self.loop, writer)
+        self.writer = writer
+        self.pending = {}
+        self.ids = itertools.count(1)
+        self.sessions = itertools.count(1)
+        self.closed = self.loop.create_future()
+        self.reader_task = asyncio.ensure_future(self._read_loop(reader))
+
+    @classmethod
+    async def connect(cls, path):
+        reader, writer = await asyncio.open_unix_connection(path, limit=MAX_LINE_BYTES)
+        return cls(reader, writer)
+
+    def request(self, session, kind, payload=None):
+        future = self.loop.create_future()
+        if self.closed.done():
+            future.set_result((protocol.ERROR, "storage owner unavailable"))
+            return future
+        request_id = next(self.ids)
+        self.pending[request_id] = future
+        self.outbox.send((request_id, session, kind, payload))
+        return future
+
+    def notify(self, session, kind):
+        if not self.closed.done():
+            self.outbox.send((0, session, kind, None))
+
+    async def _read_loop(self, reader):
+        try:
+            while True:
+                request_id, response = await ipc.read_message(reader)
+                future = self.pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(tuple(response))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        self.closed.set_result(None)
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_result((protocol.ERROR, "storage owner unavailable"))
+
+    def close(self):
+        self.writer.close()
+
+
+class RemoteScheduler:
+    """
+    CommandScheduler stand-in used by worker processes: commands and peer
+    messages go to the storage owner, which orders them with a
+    CommandScheduler of its own for this session (one per client connection).
+    """
+
+    def __init__(self, link):
+        self.link = link
+        self.loop = link.loop
+        self.session = next(link.sessions)
+
+    def submit(self, cmd, args):
+        return self.link.request(self.session, "cmd", (cmd, args))
+
+    def submit_peer(self, line):
+        return self.link.request(self.session, "peer", line)
+
+    def close(self):
+        self.link.notify(self.session, "close")
+
+
+async def handle_connection(reader, writer, make_scheduler):
+    """Negotiate the protocol from the first byte of the connection, then serve it."""
+    scheduler = make_scheduler()
+    try:
+        first = await reader.read(1)
+        if first == protocol.PREFACE[:1]:
+            if await reader.readexactly(len(protocol.PREFACE) - 1) != protocol.PREFACE[1:]:
+                writer.close()
+                return
+            await handle_binary_client(reader, writer, scheduler)
+        elif first:
+            await handle_client(reader, writer, scheduler, prefix=first)
+        else:
+            writer.close()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        writer.close()
+    finally:
+        scheduler.close()
+
+
+async def handle_client(reader, writer, scheduler, prefix=b""):
+    """
+    Serve a text-protocol connection. Commands are read as they arrive and run
+    through the scheduler; responses are written back in request order. Once
+    MAX_IN_FLIGHT commands are outstanding we stop reading, so a client that
+    pipelines faster than we commit is pushed back on through TCP flow control.
+    """
+    loop = asyncio.get_running_loop()
+    responses = asyncio.Queue(maxsize=MAX_IN_FLIGHT)
+
+    async def send_responses():
+        while True:
+            pending = await responses.get()
+            if pending is None:
+                return
+            writer.write(protocol.to_bytes(format_text_response(*(await pending))) + b"\n")
+            await writer.drain()
+
+    sender = asyncio.create_task(send_responses())
+    try:
+        while True:
+            try:
+                line = prefix + await reader.readline()
+            except ValueError:
+                await responses.put(_done(loop, (protocol.ERROR, "line too long")))
+                break
+            prefix = b""
+            if not line:
+                break
+            line = protocol.to_str(line)
+            if line.startswith("{"):
+                # Raft peer message sharing the client port
+                pending = scheduler.submit_peer(line)
+            else:
+                try:
+                    pending = scheduler.submit(*parse_text_command(line))
+                except Exception as e:
+                    pending = _done(loop, (protocol.ERROR, str(e)))
+            await responses.put(pending)
+    except ConnectionError:
+        pass
+    finally:
+        await responses.put(None)
+        try:
+            await sender
+        except ConnectionError:
+            pass
+        writer.close()
+
+
+async def handle_binary_client(reader, writer, scheduler):
+    """
+    Serve a binary-protocol connection. Every frame is scheduled as soon as it
+    is read and answered as soon as it completes, tagged with its request id,
+    so slow requests do not hold up fast ones on the same connection.
+    """
+    writer.write(protocol.PREFACE)
+    slots = asyncio.Semaphore(MAX_IN_FLIGHT)
+    responders = set()
+
+    async def respond(request_id, pending):
+        try:
+            status, result = await pending
+            writer.writelines(protocol.frame_parts(request_id, status, binary_response_fields(status, result)))
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            slots.release()
+
+    try:
+        while True:
+            try:
+                request_id, opcode, fields = await protocol.read_frame(reader)
+            except asyncio.IncompleteReadError:
+                break
+            await slots.acquire()
+            try:
+                pending = scheduler.submit(*parse_binary_command(opcode, fields))
+            except protocol.ProtocolError as e:
+                pending = _done(scheduler.loop, (protocol.ERROR, str(e)))
+            task = asyncio.create_task(respond(request_id, pending))
+            responders.add(task)
+            task.add_done_callback(responders.discard)
+    except (ConnectionError, protocol.ProtocolError):
+        pass
+    finally:
+        if responders:
+            await asyncio.wait(responders)
+        writer.close()
+
+
+def _done(loop, response):
+    future = loop.create_future()
+    future.set_result(response)
+    return future
+
+
+def _handle_peer_message(line, partitions):
+    msg = json.loads(line)
+    try:
+        _, raft_node = partitions[msg.get("partition", 0)]
+    except (IndexError, TypeError):
+        return protocol.ERROR, f"no partition {msg.get('partition')!r}"
+    return protocol.OK, raft_node.handle_message(msg) or "ok"
+
+
+async def start_server(store, raft_node, host, port, executor=None):
+    return await start_partitioned_server(Partitions([(store, raft_node)]), host, port, executor)
+
+
+async def start_partitioned_server(partitions, host, port, executor=None):
+    executor = executor or ThreadPoolExecutor(max_workers=64, thread_name_prefix="kv-worker")
+    return await asyncio.start_server(
+        lambda reader, writer: handle_connection(reader, writer, lambda: CommandScheduler(executor, partitions)),
+        host, port, limit=MAX_LINE_BYTES, reuse_address=True, backlog=1024)
+
+
+async def start_owner(partitions, path, executor=None):
+    """
+    Serve the worker processes' operations on the Unix socket ``path``. Each
+    worker session (one of its client connections) gets its own CommandScheduler,
+    so per-connection ordering and READMODE behave as in single-process mode.
+    """
+    executor = executor or ThreadPoolExecutor(max_workers=64, thread_name_prefix="kv-worker")
+
+    async def serve_worker(reader, writer):
+        loop = asyncio.get_running_loop()
+        outbox = ipc.Outbox(loop, writer)
+        sessions = {}
+
+        def reply(request_id, future):
+            try:
+                response = future.result()
+            except Exception as e:
+                response = (protocol.ERROR, str(e))
+            outbox.send((request_id, response))
+
+        try:
+            while True:
+                request_id, session, kind, payload = await ipc.read_message(reader)
+                if kind == "close":
+                    sessions.pop(session, None)
                     continue
+                scheduler = sessions.get(session)
+                if scheduler is None:
+                    scheduler = sessions[session] = CommandScheduler(executor, partitions)
+                if kind == "peer":
+                    pending = scheduler.submit_peer(payload)
+                else:
+                    try:
+                        pending = scheduler.submit(*payload)
+                    except Exception as e:
+                        pending = _done(loop, (protocol.ERROR, str(e)))
+                pending.add_done_callback(lambda f, request_id=request_id: reply(request_id, f))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
 
-            if cmd == "PUT":
-                key, value = parts[1], parts[2]
-                raft_node.replicate_log(("PUT", key, value))
-                store.put(key, value)
-                conn.sendall(b"OK\n")
-            elif cmd == "DELETE":
-                key = parts[1]
-                raft_node.replicate_log(("DEL", key, None))
-                store.delete(key)
-                conn.sendall(b"OK\n")
-            elif cmd == "READ":
-                value = store.read(parts[1])
-                conn.sendall((value or "NOT_FOUND").encode() + b"\n")
-            elif cmd == "BATCHPUT":
-                items = eval(parts[1])
-                for k, v in items:
-                    raft_node.replicate_log(("PUT", k, v))
-                store.batch_put(items)
-                conn.sendall(b"OK\n")
-            elif cmd == "RANGE":
-                start, end = parts[1], parts[2]
-                result = store.read_key_range(start, end)
-                conn.sendall((str(result) + "\n").encode())
-
-# def run_server(port, peers):
-#     store = KeyValueStore()
-#     raft_node = RaftNode(port, peers, store)
-#     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-#     s.bind(("0.0.0.0", port))
-#     s.listen(5)
-#     print(f"KV Store running on port {port}...")
-#     while True:
-#         conn, _ = s.accept()
-#         threading.Thread(target=handle_client, args=(conn, store, raft_node)).start()
-    
-def run_server(port, peers):
-    store = KeyValueStore()
-    store.set_config(port, peers)
-    store.monitor_election()
-
-    def health_server():
-        def handler(*args, **kwargs):
-            HealthCheckHandler(store, peers, *args, **kwargs)
-        httpd = HTTPServer(("0.0.0.0", port + 100), handler)
-        httpd.port = port
-        print(f"Health endpoint running on port {port + 100}...")
-        httpd.serve_forever()
-
-    threading.Thread(target=health_server, daemon=True).start()
-
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.bind(("0.0.0.0", port))
-    s.listen(5)
-    print(f"KV Store running on port {port}...")
+    if os.path.exists(path):
+        os.remove(path)
+    server = await asyncio.start_unix_server(serve_worker, path, limit=MAX_LINE_BYTES)
+    os.chmod(path, 0o600)
+    return server
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--port", type=int, required=True)
-    parser.add_argument("--peers", type=str, default="")
-    args = parser.parse_args()
-    peers = [( "127.0.0.1", int(p)) for p in args.peers.split(",") if p]
-    run_server(args.port, peers)
 
-class HealthCheckHandler(BaseHTTPRequestHandler):
-    def __init__(self, store, peers, *args, **kwargs):
-        self.store = store
-        self.peers = peers
-        super().__init__(*args, **kwargs)
+async def start_worker(host, port, owner_path):
+    """
+    Accept client connections on ``port`` alongside the other workers
+    (SO_REUSEPORT: the kernel spreads new connections over them) and forward
+    their operations to the storage owner. Returns (server, link).
+    """
+    link = await OwnerLink.connect(owner_path)
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_connection(reader, writer, lambda: RemoteScheduler(link)),
+        host, port, limit=MAX_LINE_BYTES, reuse_port=True, backlog=1024)
+    return server, link
 
-    def do_POST(self):
-        length = int(self.headers.get("Content-Length", 0))
-        data = self.rfile.read(length)
-        data = json.loads(data.decode())
 
-        if self.path == "/heartbeat":
-            self.store.receive_heartbeat(data.get("leader"), data.get("term"))
-            self.send_response(200)
-            self.end_headers()
+def run_worker(host, port, owner_path):
+    async def serve():
+        server, link = await start_worker(host, port, owner_path)
+        async with server:
+            await link.closed  # the owner is gone: so are we
+    asyncio.run(serve())
 
-        elif self.path == "/vote":
-            vote_granted = self.store.handle_vote_request(data.get("candidate"), data.get("term"))
-            self.send_response(200)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            self.wfile.write(json.dumps({"vote_granted": vote_granted}).encode())
 
+def run_server(port, peers, data_dir=".", fsync_policy="always", fsync_interval_ms=10, memtable_mb=4,
+               compaction="leveled", compaction_rate_mb=None, snapshot_wal_mb=16, raft_snapshot_entries=None,
+               partitions=1, workers=0, block_cache_mb=8, row_cache_mb=0, cache_policy="lru", compression="none",
+               expiry_compaction_delay=60.0):
+    members = []
+    cluster_ports = sorted([port] + [p for _, p in peers])
+
+    def open_store(index):
+        # Each partition has its own store, WAL directory and Raft group
+        return KeyValueStore(data_dir if partitions == 1 else os.path.join(data_dir, f"partition_{index}"),
+                             fsync_policy=fsync_policy, fsync_interval_ms=fsync_interval_ms,
+                             memtable_bytes=memtable_mb * 1024 * 1024, compaction=compaction,
+                             compaction_rate_limit=compaction_rate_mb * 1024 * 1024 if compaction_rate_mb else None,
+                             snapshot_wal_bytes=snapshot_wal_mb * 1024 * 1024,
+                             block_cache_bytes=block_cache_mb * 1024 * 1024,
+                             row_cache_bytes=row_cache_mb * 1024 * 1024, cache_policy=cache_policy,
+                             compression=compression, expiry_compaction_delay=expiry_compaction_delay)
+
+    # Partitions recover side by side: a restarted node is back as soon as its slowest one is
+    with ThreadPoolExecutor(max_workers=partitions) as pool:
+        stores = list(pool.map(open_store, range(partitions)))
+    for index, store in enumerate(stores):
+        node = RaftNode(port, peers, store, partition=index)
+        if raft_snapshot_entries:
+            node.snapshot_entries = raft_snapshot_entries
+        if partitions > 1:
+            # Spread the groups' leaders over the cluster
+            node.preferred_leader = cluster_ports[index % len(cluster_ports)]
+        members.append((store, node))
+    start_health_server(Partitions(members), port)
+
+    async def serve():
+        if workers:
+            # This process only owns the stores and Raft state; workers own the port
+            owner_path = os.path.join(data_dir, f"owner_{port}.sock")
+            server = await start_owner(Partitions(members), owner_path)
+            context = multiprocessing.get_context("spawn")
+            for _ in range(workers):
+                context.Process(target=run_worker, args=("0.0.0.0", port, owner_path), daemon=True).start()
+            print(f"KV Store running on port {port} with {partitions} partition(s) and {workers} workers...")
         else:
-            self.send_response(404)
-            self.end_headers()
+            server = await start_partitioned_server(Partitions(members), "0.0.0.0", port)
+            print(f"KV Store running on port {port} with {partitions} partition(s)...")
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+class HealthCheckHandler(BaseHTTPRequestHandler):
+    """
+    /health: this node's role and leader (of partition 0) as JSON.
+    /status: Raft progress of every partition, with follower lag on leaders.
+    /metrics: Prometheus text exposition (store.metrics.collect).
+    """
+
+    def __init__(self, partitions, *args, **kwargs):
+        self.partitions = partitions
+        self.raft_node = partitions[0][1]
+        super().__init__(*args, **kwargs)
 
     def do_GET(self):
         if self.path == "/health":
-            if self.store.is_leader:
-                status = {
-                    "status": "ok",
-                    "port": self.server.port,
-                    "role": "leader",
-                    "leader": self.server.port,
-                    "redirect": None
-                }
-            elif self.path == "/status":
-                self.send_response(200)
-                self.send_header("Content-Type", "application/json")
-                self.end_headers()
-                self.wfile.write(json.dumps({
-                    "role": self.store.state,
-                    "leader": self.store.leader_port,
-                    "term": self.store.current_term
-                }).encode())
-            else:
-                status = {
-                    "status": "ok",
-                    "port": self.server.port,
-                    "role": "follower",
-                    "leader": self.store.leader_port,
-                    "redirect": f"http://localhost:{self.store.leader_port+100}/health" if self.store.leader_port else None
-                }
-
-            self.send_response(200)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            self.wfile.write(str(status).encode())
+            leader = self.raft_node.leader
+            self._send_json({
+                "status": "ok",
+                "port": self.server.port,
+                "role": "leader" if self.raft_node.state == "leader" else "follower",
+                "leader": leader,
+                "redirect": f"http://localhost:{leader + 100}/health"
+                if leader and self.raft_node.state != "leader" else None,
+            })
+        elif self.path == "/status":
+            self._send_json({
+                "port": self.server.port,
+                "role": self.raft_node.state,
+                "leader": self.raft_node.leader,
+                "term": self.raft_node.current_term,
+                "partitions": [raft_node.replication_status() for _, raft_node in self.partitions],
+            })
+        elif self.path == "/metrics":
+            body = metrics.collect(self.partitions).render().encode()
+            self._send(body, "text/plain; version=0.0.4; charset=utf-8")
         else:
             self.send_response(404)
             self.end_headers()
 
-    
+    def _send_json(self, data):
+        self._send(json.dumps(data, separators=(",", ":")).encode(), "application/json")  # cluster.sh greps "role":"…"
+
+    def _send(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # health checks and scrapes arrive every few seconds
+
+
+def start_health_server(partitions, port, http_port=None):
+    """Serve HealthCheckHandler on ``http_port`` (default: port + 100) from a daemon thread."""
+    httpd = HTTPServer(("0.0.0.0", port + 100 if http_port is None else http_port),
+                       lambda *args, **kwargs: HealthCheckHandler(partitions, *args, **kwargs))
+    httpd.port = port
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    print(f"Health endpoint running on port {httpd.server_address[1]}...")
+    return httpd
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--peers", type=str, default="")
+    parser.add_argument("--data-dir", type=str, default=".")
+    parser.add_argument("--memtable-mb", type=int, default=4)
+    parser.add_argument("--compaction", choices=["leveled", "tiered"], default="leveled")
+    parser.add_argument("--compaction-rate-mb", type=int, default=None)
+    parser.add_argument("--snapshot-wal-mb", type=int, default=16)
+    parser.add_argument("--fsync-policy", choices=["always", "interval", "os"], default="always")
+    parser.add_argument("--fsync-interval-ms", type=int, default=10)
+    parser.add_argument("--raft-snapshot-entries", type=int, default=None)
+    parser.add_argument("--partitions", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--block-cache-mb", type=int, default=8)
+    parser.add_argument("--row-cache-mb", type=int, default=0)
+    parser.add_argument("--cache-policy", choices=["lru", "tinylfu"], default="lru")
+    parser.add_argument("--compression", choices=["none", "zlib", "lzma"], default="none")
+    parser.add_argument("--expiry-compaction-delay", type=float, default=60.0)
+    args = parser.parse_args()
+    peers = [( "127.0.0.1", int(p)) for p in args.peers.split(",") if p]
+    run_server(args.port, peers, args.data_dir, args.fsync_policy, args.fsync_interval_ms, args.memtable_mb,
+               args.compaction, args.compaction_rate_mb, args.snapshot_wal_mb, args.raft_snapshot_entries,
+               args.partitions, args.workers, args.block_cache_mb, args.row_cache_mb, args.cache_policy,
+               args.compression, args.expiry_compaction_delay)
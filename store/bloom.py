@@ -0,0 +1,49 @@
+import hashlib
+import math
+import struct
+
+HEADER = struct.Struct("<IB")  # number of bits, number of hash functions
+
+
+class BloomFilter:
+    def __init__(self, num_bits, num_hashes, bits=None):
+        self.num_bits = max(8, num_bits)
+        self.num_hashes = max(1, num_hashes)
+        self.bits = bits if bits is not None else bytearray((self.num_bits + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, false_positive_rate=0.01):
+        capacity = max(1, capacity)
+        num_bits = int(-capacity * math.log(false_positive_rate) / (math.log(2) ** 2))
+        num_hashes = int(round(num_bits / capacity * math.log(2)))
+        return cls(num_bits, num_hashes)
+
+    def _positions(self, key):
+        if isinstance(key, str):
+            key = key.encode("utf-8", "surrogateescape")
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def might_contain(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def to_bytes(self):
+        return HEADER.pack(self.num_bits, self.num_hashes) + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data, copy=True):
+        """With copy=False the filter reads its bits from ``data`` (e.g. a view of a mapped file) in place."""
+        num_bits, num_hashes = HEADER.unpack_from(data)
+        bits = data[HEADER.size:]
+        return cls(num_bits, num_hashes, bytearray(bits) if copy else bits)
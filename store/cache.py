@@ -0,0 +1,155 @@
+import threading
+from collections import OrderedDict
+
+POLICIES = ("lru", "tinylfu")
+STATS = ("hits", "misses", "inserts", "evictions", "rejections")
+
+
+class FrequencySketch:
+    """
+    Count-min sketch of recent access frequencies (4 rows of small counters). All
+    counters are halved every ``sample_size`` increments, so old popularity fades.
+    """
+
+    def __init__(self, width=4096, sample_size=None):
+        self.width = width
+        self.rows = [[0] * width for _ in range(4)]
+        self.seeds = (0x9E3779B1, 0x85EBCA77, 0xC2B2AE3D, 0x27D4EB2F)
+        self.sample_size = sample_size or 10 * width
+        self.additions = 0
+
+    def _slots(self, key):
+        h = hash(key)
+        return [((h ^ seed) * 0x01000193 >> 7) % self.width for seed in self.seeds]
+
+    def increment(self, key):
+        for row, slot in zip(self.rows, self._slots(key)):
+            if row[slot] < 15:
+                row[slot] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            for row in self.rows:
+                row[:] = [count >> 1 for count in row]
+            self.additions //= 2
+
+    def estimate(self, key):
+        return min(row[slot] for row, slot in zip(self.rows, self._slots(key)))
+
+
+class _Shard:
+    def __init__(self, capacity, admission):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (value, size), least recently used first
+        self.capacity = capacity
+        self.bytes = 0
+        self.sketch = FrequencySketch() if admission else None
+        self.generation = 0  # bumped by every invalidation, see Cache.token()
+        self.stats = dict.fromkeys(STATS, 0)  # updated under self.lock
+
+
+class Cache:
+    """
+    Byte-bounded cache split into independently locked shards, so concurrent
+    readers rarely contend. Eviction is LRU. With ``policy="tinylfu"`` a new
+    entry is only admitted over the LRU victim if it has been asked for more
+    often recently (a frequency sketch per shard), which keeps one-off scans
+    from flushing out the hot set.
+
+    ``stats`` counts hits, misses, inserts, evictions and admission rejections,
+    summed over the shards' own counters.
+    """
+
+    def __init__(self, capacity_bytes, shards=16, policy="lru"):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown cache policy {policy!r}, expected one of {POLICIES}")
+        self.capacity_bytes = capacity_bytes
+        self.policy = policy
+        self.shards = [_Shard(capacity_bytes // shards, policy == "tinylfu") for _ in range(shards)]
+
+    def _shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+
+    def get(self, key, default=None, record_miss=True):
+        """
+        The cached value, or ``default``. With ``record_miss=False`` a miss leaves no
+        trace (no count, no frequency), for a probe that a full lookup follows.
+        """
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is None and not record_miss:
+                return default
+            if shard.sketch is not None:
+                shard.sketch.increment(key)
+            if entry is None:
+                shard.stats["misses"] += 1
+                return default
+            shard.entries.move_to_end(key)
+            shard.stats["hits"] += 1
+            return entry[0]
+
+    def token(self, key):
+        """
+        Call before reading what will be cached: put(..., token=...) then drops the
+        value if ``key`` was invalidated in the meantime, so a slow reader can not
+        cache a value that a concurrent write has already replaced.
+        """
+        return self._shard(key).generation
+
+    def put(self, key, value, size, token=None):
+        shard = self._shard(key)
+        if size > shard.capacity:
+            return
+        with shard.lock:
+            if token is not None and token != shard.generation:
+                return
+            old = shard.entries.pop(key, None)
+            if old is not None:
+                shard.bytes -= old[1]
+            while shard.bytes + size > shard.capacity:
+                victim_key, (_, victim_size) = next(iter(shard.entries.items()))
+                if shard.sketch is not None and shard.sketch.estimate(key) <= shard.sketch.estimate(victim_key):
+                    shard.stats["rejections"] += 1
+                    return
+                del shard.entries[victim_key]
+                shard.bytes -= victim_size
+                shard.stats["evictions"] += 1
+            shard.entries[key] = (value, size)
+            shard.bytes += size
+            shard.stats["inserts"] += 1
+
+    def invalidate(self, key):
+        shard = self._shard(key)
+        with shard.lock:
+            shard.generation += 1
+            old = shard.entries.pop(key, None)
+            if old is not None:
+                shard.bytes -= old[1]
+
+    def clear(self):
+        for shard in self.shards:
+            with shard.lock:
+                shard.generation += 1
+                shard.entries.clear()
+                shard.bytes = 0
+
+    @property
+    def stats(self):
+        totals = dict.fromkeys(STATS, 0)
+        for shard in self.shards:
+            with shard.lock:
+                for name, count in shard.stats.items():
+                    totals[name] += count
+        return totals
+
+    @property
+    def bytes(self):
+        return sum(shard.bytes for shard in self.shards)
+
+    def __len__(self):
+        return sum(len(shard.entries) for shard in self.shards)
+
+    def hit_rate(self):
+        stats = self.stats
+        lookups = stats["hits"] + stats["misses"]
+        return stats["hits"] / lookups if lookups else 0.0
@@ -0,0 +1,45 @@
+"""
+Block compression shared by SSTables, snapshots and the WAL. Every
+compressed unit carries the id of the codec it was written with, so files
+written under different settings stay readable side by side.
+"""
+import lzma
+import zlib
+
+NONE, ZLIB, LZMA = 0, 1, 2
+CODECS = {"none": NONE, "zlib": ZLIB, "lzma": LZMA}
+CODEC_NAMES = {codec: name for name, codec in CODECS.items()}
+MIN_BYTES = 256     # smaller payloads are stored as they are
+MAX_RATIO = 0.9     # keep the compressed form only if it saves at least 10%
+
+
+def codec_id(name):
+    try:
+        return CODECS[name or "none"]
+    except KeyError:
+        raise ValueError(f"Unknown compression {name!r}, expected one of {tuple(CODECS)}") from None
+
+
+def compress(data, codec, min_bytes=MIN_BYTES):
+    """Return (codec actually used, payload); data that is small or does not shrink stays as is."""
+    if codec == NONE or len(data) < min_bytes:
+        return NONE, data
+    if codec == ZLIB:
+        packed = zlib.compress(data, 6)
+    elif codec == LZMA:
+        packed = lzma.compress(data, preset=1)
+    else:
+        raise ValueError(f"unknown codec id {codec}")
+    if len(packed) > len(data) * MAX_RATIO:
+        return NONE, data
+    return codec, packed
+
+
+def decompress(codec, payload):
+    if codec == NONE:
+        return payload
+    if codec == ZLIB:
+        return zlib.decompress(payload)
+    if codec == LZMA:
+        return lzma.decompress(payload)
+    raise ValueError(f"unknown codec id {codec}")
@@ -0,0 +1,268 @@
+import heapq
+import threading
+import time
+
+from .metrics import Histogram
+from .sstable import SSTableWriter
+from .ttl import expired, now_ms
+
+
+class RateLimiter:
+    """Token bucket limiting compaction I/O to ``bytes_per_sec``."""
+
+    def __init__(self, bytes_per_sec):
+        self.rate = float(bytes_per_sec)
+        self.tokens = self.rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, nbytes):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= nbytes
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+def _ranked(entries, rank):
+    for key, value, expires_at in entries:
+        yield key, rank, value, expires_at
+
+
+def merge_entries(tables, drop_tombstones=False, start=None, end=None):
+    """
+    K-way streaming merge of SSTables (or memtables) given newest first. Yields
+    the newest (key, value, deadline or None) for every key from start to end in
+    key order; value None is a tombstone, and a key whose deadline has passed
+    comes out as one. Only one block per input table is held in memory at a time.
+    """
+    now = now_ms()
+    streams = [_ranked(table.entries(start, end), rank) for rank, table in enumerate(tables)]
+    last_key = None
+    for key, _, value, expires_at in heapq.merge(*streams):
+        if key == last_key:
+            continue  # shadowed by a newer table
+        last_key = key
+        if expired(expires_at, now):
+            value = expires_at = None
+        if value is None and drop_tombstones:
+            continue
+        yield key, value, expires_at
+
+
+def merge_tables(tables, drop_tombstones=False, start=None, end=None):
+    """merge_entries as (key, value) pairs."""
+    for key, value, _ in merge_entries(tables, drop_tombstones, start, end):
+        yield key, value
+
+
+def _overlapping(tables, first_key, last_key):
+    return [t for t in tables if t.count and not (t.last_key < first_key or t.first_key > last_key)]
+
+
+def _level_bytes(tables):
+    return sum(t.file_size for t in tables)
+
+
+class LeveledCompaction:
+    """
+    LevelDB-style leveling: L0 holds overlapping flushed tables; every deeper
+    level is a sorted run of disjoint tables, ``level_multiplier`` times larger
+    than the one above it.
+    """
+
+    def __init__(self, l0_trigger=4, base_level_bytes=10 * 1024 * 1024, level_multiplier=10,
+                 target_file_bytes=2 * 1024 * 1024):
+        self.l0_trigger = l0_trigger
+        self.base_level_bytes = base_level_bytes
+        self.level_multiplier = level_multiplier
+        self.target_file_bytes = target_file_bytes
+        self.compact_pointer = {}
+
+    def max_bytes(self, level):
+        return self.base_level_bytes * self.level_multiplier ** (level - 1)
+
+    def pick(self, levels):
+        """Return (inputs, output_level) or None. Inputs are ordered newest first."""
+        if len(levels[0]) >= self.l0_trigger:
+            l0 = sorted(levels[0], key=lambda t: t.seq, reverse=True)
+            tables = [t for t in l0 if t.count]
+            if not tables:
+                return l0, 1
+            first = min(t.first_key for t in tables)
+            last = max(t.last_key for t in tables)
+            below = _overlapping(levels[1], first, last) if len(levels) > 1 else []
+            return l0 + below, 1
+
+        for level in range(1, len(levels)):
+            if _level_bytes(levels[level]) <= self.max_bytes(level):
+                continue
+            tables = sorted(levels[level], key=lambda t: t.first_key)
+            pointer = self.compact_pointer.get(level)
+            table = next((t for t in tables if pointer is None or t.first_key > pointer), tables[0])
+            self.compact_pointer[level] = table.last_key
+            below = _overlapping(levels[level + 1], table.first_key, table.last_key) if level + 1 < len(levels) else []
+            return [table] + below, level + 1
+        return None
+
+
+class SizeTieredCompaction:
+    """
+    Cassandra-style size tiering: all tables stay in L0 and a run of
+    ``min_threshold`` adjacent (by age) tables of similar size is merged into one.
+    """
+
+    def __init__(self, min_threshold=4, max_threshold=32, bucket_low=0.5, bucket_high=1.5):
+        self.min_threshold = min_threshold
+        self.max_threshold = max_threshold
+        self.bucket_low = bucket_low
+        self.bucket_high = bucket_high
+        self.target_file_bytes = None
+
+    def pick(self, levels):
+        tables = sorted(levels[0], key=lambda t: t.seq)  # oldest first
+        run = []
+        for table in tables + [None]:
+            if table is not None and run:
+                average = _level_bytes(run) / len(run)
+                if self.bucket_low * average <= table.file_size <= self.bucket_high * average:
+                    run.append(table)
+                    if len(run) < self.max_threshold:
+                        continue
+            if len(run) >= self.min_threshold:
+                return run[::-1], 0
+            run = [table] if table is not None else []
+        return None
+
+
+STRATEGIES = {"leveled": LeveledCompaction, "tiered": SizeTieredCompaction}
+
+
+class Compactor:
+    """
+    Runs compactions for a KeyValueStore on a background thread. The store's
+    lock is only held to pick inputs and to swap the result in, so foreground
+    reads and writes never wait on compaction I/O.
+
+    When the strategy has nothing to do, a table whose earliest deadline
+    passed ``expiry_delay`` seconds ago (store.expiry_index) is rewritten on
+    its own level, which purges every key in it that has expired by then.
+    The delay lets expirations accumulate into one rewrite.
+    """
+
+    def __init__(self, store, strategy="leveled", rate_limit_bytes=None, expiry_delay=60.0):
+        self.store = store
+        self.strategy = STRATEGIES[strategy]() if isinstance(strategy, str) else strategy
+        self.rate_limiter = RateLimiter(rate_limit_bytes) if rate_limit_bytes else None
+        self.expiry_delay = expiry_delay
+        self.stats = {"compactions": 0, "expiry_compactions": 0, "bytes_read": 0, "bytes_written": 0,
+                      "bytes_flushed": 0, "write_amplification": 0.0}
+        self.latency = Histogram()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._run_lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def notify(self):
+        self._wakeup.set()
+
+    def paused(self):
+        """Context manager: no compaction runs (one in progress is waited for) while it is open."""
+        return self._run_lock
+
+    def record_flush(self, nbytes):
+        self.stats["bytes_flushed"] += nbytes
+        self._update_write_amplification()
+
+    def _update_write_amplification(self):
+        flushed = self.stats["bytes_flushed"]
+        if flushed:
+            self.stats["write_amplification"] = (flushed + self.stats["bytes_written"]) / flushed
+
+    def _loop(self):
+        while not self._stopped:
+            self._wakeup.wait(1.0)
+            self._wakeup.clear()
+            while not self._stopped and self.run_once():
+                pass
+
+    def run_once(self):
+        """Run one compaction if the strategy picks one; returns whether any work was done."""
+        with self._run_lock:
+            store = self.store
+            with store._lock:
+                levels = [list(level) for level in store.levels]
+                picked = self.strategy.pick(levels) or self._pick_expired(levels)
+            if picked is None:
+                return False
+            inputs, output_level = picked
+            started = time.perf_counter()
+            outputs = self._compact(inputs, output_level, levels)
+            with store._lock:
+                while len(store.levels) <= output_level:
+                    store.levels.append([])
+                for level in store.levels:
+                    level[:] = [t for t in level if t not in inputs]
+                store.levels[output_level].extend(outputs)
+            store._save_manifest()
+            for table in inputs:
+                table.remove()
+            self.stats["compactions"] += 1
+            self.stats["bytes_read"] += _level_bytes(inputs)
+            self.stats["bytes_written"] += _level_bytes(outputs)
+            self.latency.observe(time.perf_counter() - started)
+            self._update_write_amplification()
+            return True
+
+    def _pick_expired(self, levels):
+        live = {table.filename: table for level in levels for table in level}
+        table = self.store.expiry_index.due(now_ms() - int(self.expiry_delay * 1000), live)
+        if table is None:
+            return None
+        self.stats["expiry_compactions"] += 1
+        return [table], next(i for i, level in enumerate(levels) if table in level)
+
+    def _compact(self, inputs, output_level, levels):
+        # Tombstones may only be dropped when nothing older can hold the key
+        if output_level == 0:
+            oldest = min((t.seq for t in levels[0]), default=0)
+            drop_tombstones = min(t.seq for t in inputs) == oldest and len(levels) == 1
+        else:
+            drop_tombstones = all(not level for level in levels[output_level + 1:])
+        seq = max(t.seq for t in inputs)
+        expected = sum(t.count for t in inputs)
+        target = self.strategy.target_file_bytes if output_level > 0 else None
+
+        outputs, writer = [], None
+        try:
+            for key, value, expires_at in merge_entries(inputs, drop_tombstones):
+                if writer is None:
+                    writer = SSTableWriter(self.store._new_sstable_filename(), expected, level=output_level,
+                                           seq=seq, rate_limiter=self.rate_limiter,
+                                           compression=self.store.compression)
+                writer.add(key, value, expires_at)
+                if target and writer.offset >= target:
+                    outputs.append(self.store._open_sstable(writer.finish()))
+                    writer = None
+            if writer is not None:
+                outputs.append(self.store._open_sstable(writer.finish()))
+        except BaseException:
+            if writer is not None:
+                writer.abort()
+            for table in outputs:
+                table.remove()
+            raise
+        return outputs
@@ -1,164 +1,473 @@
 from .wal import WriteAheadLog
 from .sstable import SSTable
+from .memtable import Memtable
+from .compaction import Compactor, merge_entries, merge_tables
+from .snapshot import read_snapshot_entries, write_snapshot
+from .manifest import read_manifest, write_manifest
+from .cache import Cache
+from .metrics import histograms
+from .ttl import ExpiryIndex, deadline, expired, now_ms
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import os
 import threading
 import time
-import random
-import requests
 
 class KeyValueStore:
-    def __init__(self):
-        self.store = {}
-        self.wal = WriteAheadLog()
-        self.state = "follower"
-        self.leader_port = None
+    def __init__(self, data_dir=".", fsync_policy="always", fsync_interval_ms=10,
+                 memtable_bytes=4 * 1024 * 1024, max_immutable_memtables=2,
+                 compaction="leveled", compaction_rate_limit=None, snapshot_wal_bytes=16 * 1024 * 1024,
+                 block_cache_bytes=8 * 1024 * 1024, row_cache_bytes=0, cache_policy="lru", compression="none",
+                 expiry_compaction_delay=60.0, recovery_threads=8):
+        self.data_dir = os.path.abspath(data_dir)
+        os.makedirs(data_dir, exist_ok=True)
+        # Codec for new WAL records, SSTable blocks and snapshots; files written with another stay readable
+        self.compression = compression
+        self.wal = WriteAheadLog(os.path.join(data_dir, "wal.log"), os.path.join(data_dir, "snapshot.json"),
+                                 fsync_policy=fsync_policy, fsync_interval_ms=fsync_interval_ms,
+                                 compression=compression)
+        self.memtable = Memtable()
+        self.immutable_memtables = []  # oldest first, waiting to be flushed
+        self.levels = [[]]             # levels[0]: overlapping flushed tables, deeper levels: disjoint runs
+        self.memtable_bytes = memtable_bytes
+        self.max_immutable_memtables = max_immutable_memtables
+        self.snapshot_wal_bytes = snapshot_wal_bytes
+        self.next_sstable_id = 1
+        self.manifest_path = os.path.join(self.data_dir, "MANIFEST")
+        self.wal_checkpoint = 0        # newest sealed WAL segment whose records are all in SSTables
+        self.recovery_threads = recovery_threads
+        self.stats = {"puts": 0, "deletes": 0, "reads": 0, "multi_gets": 0, "scans": 0, "flushes": 0}
+        self.latency = histograms("read", "multi_get", "write", "flush", "snapshot", "install_snapshot")
+        # Decoded SSTable blocks, and hot keys that had to be read from SSTables
+        self.block_cache = Cache(block_cache_bytes, policy=cache_policy) if block_cache_bytes else None
+        self.row_cache = Cache(row_cache_bytes, policy=cache_policy) if row_cache_bytes else None
+        self.expiry_index = ExpiryIndex()  # SSTables by the earliest key deadline they hold
+        self._lock = threading.Lock()
+        self._flush_cond = threading.Condition(self._lock)
+        self._manifest_lock = threading.Lock()
+        self._index_loader = None
+        self._closed = False
         self.current_term = 0
         self.voted_for = None
-        self.peers = []
-        self.port = None
-        self.election_timeout = random.uniform(3, 5)
-        self.last_heartbeat = time.time()
-        self.op_count = 0
-        self.snapshot_threshold = 100  # Take snapshot every 100 ops
+        self.compactor = Compactor(self, compaction, compaction_rate_limit, expiry_compaction_delay)
         self.recover()
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+        self.compactor.start()
 
 
-    def set_config(self, port, peers):
-        self.port = port
-        self.peers = peers
-
-    def set_leader(self, port, term):
-        self.state = "leader" if port == self.port else "follower"
-        self.leader_port = port
+    def save_raft_state(self, term, voted_for):
+        """Durably record the Raft term and vote; recover() restores them from the WAL."""
         self.current_term = term
-        if self.state == "leader":
-            print(f"[ELECTION] Node {port} became LEADER for term {term}")
-            self.broadcast_heartbeat()
+        self.voted_for = voted_for
+        self.wal.append_state(term, voted_for)
+
+    def recover(self):
+        """
+        Open the tables the MANIFEST lists (in a thread pool; each open reads only
+        a footer) and replay the WAL segments after its checkpoint. Table indexes
+        are loaded in the background afterwards, so the store serves as soon as
+        the WAL tail is back in the memtable.
+        """
+        for path in glob.glob(os.path.join(self.data_dir, "sstable_*.db.tmp")):
+            os.remove(path)
+        on_disk = sorted(glob.glob(os.path.join(self.data_dir, "sstable_*.db")))
+        for path in on_disk:
+            table_id = int(os.path.basename(path)[len("sstable_"):-len(".db")])
+            self.next_sstable_id = max(self.next_sstable_id, table_id + 1)
+        manifest = read_manifest(self.manifest_path)
+        if manifest is not None:
+            paths = [os.path.join(self.data_dir, name) for level in manifest["levels"] for name in level]
+            for path in set(on_disk) - set(paths):
+                # Output of a flush or compaction that crashed before the manifest named it,
+                # or an input it replaced that was not deleted yet
+                os.remove(path)
+            self.next_sstable_id = max(self.next_sstable_id, manifest["next_table_id"])
+            self.wal_checkpoint = manifest["wal_checkpoint"]
         else:
-            print(f"[ELECTION] Node {port} is the new LEADER for term {term} (this node is FOLLOWER)")
-
-    def broadcast_heartbeat(self):
-        def task():
-            while self.state == "leader":
-                for peer in self.peers:
-                    try:
-                        requests.post(f"http://localhost:{peer+100}/heartbeat",
-                                      json={"leader": self.port, "term": self.current_term},
-                                      timeout=0.5)
-                    except:
-                        continue
-                time.sleep(2)
-        threading.Thread(target=task, daemon=True).start()
-
-    def receive_heartbeat(self, leader_port, term):
-        if term >= self.current_term:
-            self.state = "follower"
-            self.current_term = term
-            self.voted_for = None
-            self.leader_port = leader_port
-            self.last_heartbeat = time.time()
-
-    def request_vote(self):
-        self.current_term += 1
-        self.voted_for = self.port
-        self.wal.append_state(self.current_term, self.voted_for)
-        self.state = "candidate"
-        votes = 1
-        print(f"[ELECTION] Node {self.port} requesting votes for term {self.current_term}...")
-        for peer in self.peers:
-            try:
-                resp = requests.post(f"http://localhost:{peer+100}/vote",
-                                     json={"candidate": self.port, "term": self.current_term},
-                                     timeout=0.5)
-                if resp.status_code == 200 and resp.json().get("vote_granted"):
-                    votes += 1
-            except:
-                continue
-
-        if votes > (len(self.peers) + 1) // 2:
-            self.set_leader(self.port, self.current_term)
+            # A new data dir, or one written before the manifest: every table file is live
+            paths = on_disk
+        with ThreadPoolExecutor(max_workers=self.recovery_threads) as pool:
+            tables = dict(zip(paths, pool.map(self._open_sstable, paths)))
+        if manifest is not None:
+            self.levels = [[tables[os.path.join(self.data_dir, name)] for name in level]
+                           for level in manifest["levels"]] or [[]]
         else:
-            print(f"[ELECTION] Node {self.port} failed to get majority (votes={votes}). Retrying...")
-            self.state = "follower"
-            self.voted_for = None
-
-    def monitor_election(self):
-        def monitor():
-            while True:
-                time.sleep(1)
-                if self.state != "leader" and (time.time() - self.last_heartbeat > self.election_timeout):
-                    self.request_vote()
-        threading.Thread(target=monitor, daemon=True).start()
-
-    def handle_vote_request(self, candidate, term):
-        if term > self.current_term:
-            self.current_term = term
-            self.voted_for = None
-            self.state = "follower"
-
-        if (self.voted_for is None or self.voted_for == candidate) and term >= self.current_term:
-            self.voted_for = candidate
-            self.wal.append_state(self.current_term, self.voted_for)
-            return True
-        return False
-    
-    def recover(self):
-        for op, key, value in self.wal.replay():
+            for sstable in tables.values():
+                while len(self.levels) <= sstable.level:
+                    self.levels.append([])
+                self.levels[sstable.level].append(sstable)
+        self._save_manifest()
+
+        for op, key, value in self.wal.replay(self.wal_checkpoint):
             if op == "SNAPSHOT":
-                self.store = key  # key contains snapshot dict
+                for k, v in key.items():  # key contains snapshot dict
+                    self.memtable.put(k, v)
             elif op == "STATE":
                 self.current_term = key
                 self.voted_for = value
             elif op == "PUT":
-                self.store[key] = value
+                self.memtable.put(key, value)
+            elif op == "PUTEX":
+                self.memtable.put(key, *value)
             elif op == "DELETE":
-                self.store.pop(key, None)
+                self.memtable.delete(key)
+        if len(self.memtable):
+            # Move replayed data into an SSTable so the old log (and any legacy snapshot) can go
+            with self._lock:
+                self._rotate_memtable()
+        self._index_loader = ThreadPoolExecutor(max_workers=self.recovery_threads)
+        for sstable in tables.values():
+            self._index_loader.submit(self._load_index, sstable)
+
+    @staticmethod
+    def _load_index(sstable):
+        try:
+            sstable.first_keys
+            sstable.bloom
+        except (ValueError, TypeError):
+            pass  # compacted away (and closed) before its turn came
+
+    def _save_manifest(self):
+        # Snapshots and writes under one lock, so a slower writer never replaces a newer state
+        with self._manifest_lock:
+            with self._lock:
+                levels = [[os.path.basename(t.filename) for t in level] for level in self.levels]
+                next_table_id, checkpoint = self.next_sstable_id, self.wal_checkpoint
+            write_manifest(self.manifest_path, levels, next_table_id, checkpoint)
+
+    def _rotate_memtable(self):
+        # Caller holds self._lock
+        self.memtable.wal_segment = self.wal.rotate()
+        self.immutable_memtables.append(self.memtable)
+        self.memtable = Memtable()
+        self._flush_cond.notify_all()
+
+    def _write(self, operations):
+        with self.latency["write"].time():
+            self._write_locked(operations)
+
+    def _write_locked(self, operations):
+        # One WAL record (and so one group-commit slot) per call, however many operations
+        with self._lock:
+            while len(self.immutable_memtables) >= self.max_immutable_memtables:
+                # Write stall: flushing has fallen behind
+                self._flush_cond.wait()
+            # Queued first: a stopped WAL rejects the write before the memtable sees it
+            if len(operations) == 1:
+                seq = self.wal.enqueue(*operations[0])
+            else:
+                seq = self.wal.enqueue_batch(operations)
+            for op, key, value in operations:
+                if op == "PUT":
+                    self.memtable.put(key, value)
+                    self.stats["puts"] += 1
+                elif op == "PUTEX":
+                    self.memtable.put(key, *value)
+                    self.stats["puts"] += 1
+                else:
+                    self.memtable.delete(key)
+                    self.stats["deletes"] += 1
+                if self.row_cache is not None:
+                    self.row_cache.invalidate(key)
+            self._check_snapshot()
+        self.wal.wait(seq)
 
     def _check_snapshot(self):
-        self.op_count += 1
-        if self.op_count >= self.snapshot_threshold:
-            print(f"[SNAPSHOT] Creating snapshot at {self.op_count} operations")
-            self.wal.create_snapshot(self.store, self.current_term, self.voted_for)
-            self.op_count = 0
+        # Caller holds self._lock. Sealing the memtable is the incremental snapshot: it is
+        # flushed to an SSTable in the background and the WAL segments it covers are dropped.
+        # Triggering on WAL bytes as well keeps replay bounded under overwrite-heavy loads,
+        # where the memtable stays small but the log keeps growing.
+        if self.memtable.size >= self.memtable_bytes or self.wal.active_bytes >= self.snapshot_wal_bytes:
+            self._rotate_memtable()
+
+    def _flush_loop(self):
+        while True:
+            with self._lock:
+                while not self.immutable_memtables and not self._closed:
+                    self._flush_cond.wait()
+                if not self.immutable_memtables:
+                    return
+                memtable = self.immutable_memtables[0]
+            with self.latency["flush"].time():
+                sstable = self._write_sstable(memtable.entries(), len(memtable)) if len(memtable) else None
+            self.stats["flushes"] += 1
+            with self._lock:
+                if sstable is not None:
+                    self.levels[0].append(sstable)
+                self.wal_checkpoint = memtable.wal_segment
+            # The table must be in the manifest before the WAL segments it covers go
+            self._save_manifest()
+            with self._lock:
+                self.immutable_memtables.pop(0)
+                self._flush_cond.notify_all()
+            self.wal.truncate_before(memtable.wal_segment)
+            if sstable is not None:
+                self.compactor.record_flush(sstable.file_size)
+                self.compactor.notify()
+
+    def _new_sstable_filename(self, table_id=None):
+        if table_id is None:
+            with self._lock:
+                table_id = self.next_sstable_id
+                self.next_sstable_id += 1
+        return os.path.join(self.data_dir, f"sstable_{table_id:06d}.db")
+
+    def _write_sstable(self, items, expected_entries):
+        with self._lock:
+            table_id = self.next_sstable_id
+            self.next_sstable_id += 1
+        filename = self._new_sstable_filename(table_id)
+        SSTable.write(filename, items, expected_entries, level=0, seq=table_id, compression=self.compression)
+        return self._open_sstable(filename)
+
+    def _open_sstable(self, filename):
+        sstable = SSTable(filename=filename, block_cache=self.block_cache)
+        self.expiry_index.add(sstable)
+        return sstable
 
-    def put(self, key, value):
-        self.store[key] = value
-        self.wal.append("PUT", key, value)
-        self._check_snapshot()
+    @property
+    def sstables(self):
+        """All live SSTables, newest first."""
+        with self._lock:
+            return self._sstables_newest_first()
+
+    def _sstables_newest_first(self):
+        # Caller holds self._lock. Within a level the newest data (highest seq) wins; deeper
+        # levels only overlap after a crash mid-compaction, where the output is the newer file.
+        tables = []
+        for level in self.levels:
+            tables.extend(sorted(level, key=lambda t: (t.seq, t.filename), reverse=True))
+        return tables
+
+    def _tables(self):
+        # Newest first: active memtable, immutable memtables, then SSTables level by level
+        with self._lock:
+            return [self.memtable] + self.immutable_memtables[::-1] + self._sstables_newest_first()
+
+    def put(self, key, value, ttl=None):
+        """Write ``key``; with ``ttl`` (seconds) it reads as deleted once that much time has passed."""
+        if ttl is None:
+            self._write([("PUT", key, value)])
+        else:
+            self._write([("PUTEX", key, (value, deadline(ttl)))])
 
     def read(self, key):
-        if key in self.memtable:
-            return self.memtable[key]
-        for sstable in reversed(self.sstables):
-            val = sstable.get(key)
-            if val is not None:
-                return val
+        # Once the WAL has failed the memtables may hold writes that never became durable
+        self.wal.check()
+        self.stats["reads"] += 1
+        with self.latency["read"].time():
+            return self._read(key)
+
+    def read_cached(self, key):
+        """
+        (found, value) from the memtables and the row cache alone, never reading an
+        SSTable; found is False when only read() can answer. Only answered reads count.
+        """
+        self.wal.check()
+        started = time.perf_counter()
+        with self._lock:
+            memtables = [self.memtable] + self.immutable_memtables[::-1]
+        found, value = self._read_memory(key, memtables, record_miss=False)
+        if found:
+            self.stats["reads"] += 1
+            self.latency["read"].observe(time.perf_counter() - started)
+        return found, value
+
+    def _read_memory(self, key, memtables, record_miss=True):
+        for table in memtables:
+            found, value = table.lookup(key)
+            if found:
+                return True, value
+        if self.row_cache is not None:
+            cached = self.row_cache.get(key, record_miss=record_miss)
+            if cached is not None:
+                value, expires_at = cached
+                return True, None if expired(expires_at, now_ms()) else value
+        return False, None
+
+    def _read(self, key):
+        # The token is taken before the memtables are looked at, so a write racing with
+        # this read keeps the value read from the SSTables out of the row cache.
+        token = self.row_cache.token(key) if self.row_cache is not None else None
+        with self._lock:
+            memtables = [self.memtable] + self.immutable_memtables[::-1]
+            sstables = self._sstables_newest_first()
+        found, value = self._read_memory(key, memtables)
+        if found:
+            return value
+        for table in sstables:
+            found, value, expires_at = table.lookup_entry(key)
+            if found:
+                if value is not None and self.row_cache is not None:
+                    self.row_cache.put(key, (value, expires_at), len(key) + len(value) + 64, token)
+                return value
         return None
 
-    def read_key_range(self, start, end):
-        result = {k: v for k, v in self.memtable.items() if start <= k <= end}
-        for sstable in self.sstables:
-            result.update(sstable.range_query(start, end))
+    def multi_get(self, keys):
+        """
+        Return {key: value} for the keys that exist. Memtables are consulted under the
+        write lock, so a concurrent batch is seen either entirely or not at all.
+        """
+        self.wal.check()
+        self.stats["multi_gets"] += 1
+        with self.latency["multi_get"].time():
+            return self._multi_get(keys)
+
+    def _multi_get(self, keys):
+        result, missing = {}, []
+        with self._lock:
+            memtables = [self.memtable] + self.immutable_memtables[::-1]
+            sstables = self._sstables_newest_first()
+            for key in keys:
+                for table in memtables:
+                    found, value = table.lookup(key)
+                    if found:
+                        if value is not None:
+                            result[key] = value
+                        break
+                else:
+                    missing.append(key)
+        for key in missing:
+            for table in sstables:
+                found, value = table.lookup(key)
+                if found:
+                    if value is not None:
+                        result[key] = value
+                    break
         return result
 
+    def scan(self, start=None, end=None):
+        """
+        Yield live (key, value) pairs from start to end inclusive in key order. The
+        memtables and SSTables are merged lazily, so nothing beyond one block per
+        table is held in memory however large the range is.
+        """
+        self.wal.check()
+        self.stats["scans"] += 1
+        return merge_tables(self._tables(), drop_tombstones=True, start=start, end=end)
+
+    def read_key_range(self, start, end):
+        return dict(self.scan(start, end))
+
     def batch_put(self, items):
-        for k, v in items:
-            self.put(k, v)
+        self.batch_write([("PUT", k, v) for k, v in items])
+
+    def batch_write(self, operations):
+        """
+        Apply (op, key, value) triples atomically: they share one WAL record and
+        fsync and become visible together. op is "PUT", "DELETE" or "PUTEX", whose
+        value is (value, deadline) with the deadline in store.ttl's terms.
+        """
+        operations = [(op, key, value if op != "DELETE" else None) for op, key, value in operations]
+        for op, _, _ in operations:
+            if op not in ("PUT", "PUTEX", "DELETE"):
+                raise ValueError(f"unsupported batch operation {op!r}")
+        if operations:
+            self._write(operations)
 
     def delete(self, key):
-        if key in self.store:
-            del self.store[key]
-            self.wal.append("DELETE", key)
-            self._check_snapshot()
-            
+        self._write([("DELETE", key, None)])
+
     def flush_to_sstable(self):
-        sstable = SSTable(self.memtable)
-        self.sstables.append(sstable)
-        self.memtable.clear()
-        self.wal.clear()
-        if len(self.sstables) > 3:
-            self.compact_sstables()
+        """Seal the active memtable and block until it has been flushed."""
+        with self._lock:
+            if not len(self.memtable):
+                return
+            memtable = self.memtable
+            self._rotate_memtable()
+            while memtable in self.immutable_memtables:
+                self._flush_cond.wait()
+
+    def snapshot_items(self):
+        """
+        Return (entries, meta) for a point-in-time snapshot: the active memtable is
+        sealed and ``entries`` streams the live keys of the now immutable tables in
+        key order as (key, value, deadline or None). Writes made after this call do
+        not show up in ``entries``.
+        """
+        with self._lock:
+            if len(self.memtable):
+                self._rotate_memtable()
+            tables = self.immutable_memtables[::-1] + self._sstables_newest_first()
+            meta = {"term": self.current_term, "voted_for": self.voted_for}
+        return merge_entries(tables, drop_tombstones=True), meta
+
+    def create_snapshot(self, path=None, meta=None):
+        """
+        Write a point-in-time snapshot of the whole keyspace to ``path`` (default
+        <data_dir>/snapshot.bin). The active memtable is sealed so the snapshot reads
+        only immutable tables; writes keep flowing into a fresh memtable meanwhile.
+        """
+        path = path or os.path.join(self.data_dir, "snapshot.bin")
+        items, snapshot_meta = self.snapshot_items()
+        snapshot_meta.update(meta or {})
+        print(f"[SNAPSHOT] Writing snapshot to {path}")
+        with self.latency["snapshot"].time():
+            write_snapshot(path, items, snapshot_meta, self.compression)
+        return path
+
+    def install_snapshot(self, path):
+        """
+        Replace the whole keyspace with the contents of a snapshot file (a Raft
+        follower catching up from the leader's snapshot). The snapshot becomes one
+        SSTable and every older table and WAL segment is dropped. Callers must keep
+        writes out until this returns.
+        """
+        with self.latency["install_snapshot"].time():
+            self._install_snapshot(path)
+
+    def _install_snapshot(self, path):
+        _, items = read_snapshot_entries(path)
+        with self.compactor.paused():
+            with self._lock:
+                # Flush everything first so no older table can land after the swap
+                if len(self.memtable):
+                    self._rotate_memtable()
+                while self.immutable_memtables:
+                    self._flush_cond.wait()
+            sstable = self._write_sstable(items, max(1024, os.path.getsize(path) // 64))
+            with self._lock:
+                old_tables = [table for level in self.levels for table in level]
+                self.levels = [[sstable]]
+                self.memtable = Memtable()
+                self.wal_checkpoint = self.wal.rotate()
+            self._save_manifest()
+            self.wal.truncate_before(self.wal_checkpoint)
+            if self.row_cache is not None:
+                self.row_cache.clear()
+            for table in old_tables:
+                table.remove()
+
+    def table_stats(self):
+        """Sizes of the memtables and of the SSTables on every level."""
+        with self._lock:
+            return {"memtable_bytes": self.memtable.size, "memtable_entries": len(self.memtable),
+                    "immutable_memtables": len(self.immutable_memtables),
+                    "levels": [(len(level), sum(t.file_size for t in level)) for level in self.levels]}
+
+    def cache_stats(self):
+        """Counters, size and hit rate of the block and row caches (None when disabled)."""
+        stats = {}
+        for name, cache in (("block_cache", self.block_cache), ("row_cache", self.row_cache)):
+            stats[name] = None if cache is None else dict(cache.stats, bytes=cache.bytes, entries=len(cache),
+                                                          capacity_bytes=cache.capacity_bytes,
+                                                          hit_rate=round(cache.hit_rate(), 4))
+        return stats
+
+    def close(self):
+        """Finish pending flushes, stop background work and close the WAL."""
+        with self._lock:
+            self._closed = True
+            self._flush_cond.notify_all()
+        self._flusher.join()
+        self.compactor.stop()
+        if self._index_loader is not None:
+            self._index_loader.shutdown(cancel_futures=True)
+        self.wal.close()
 
     def compact_sstables(self):
-        new_sstable = SSTable.compact(self.sstables)
-        self.sstables = [new_sstable]
+        """Run compactions in the calling thread until the strategy has nothing left to do."""
+        while self.compactor.run_once():
+            pass
@@ -0,0 +1,36 @@
+"""
+The MANIFEST names a store's live SSTables level by level, the next table id
+and the WAL checkpoint: the newest sealed WAL segment whose records are all
+in those tables. It is rewritten whenever the table set changes (a flush, a
+compaction, an installed snapshot), through a temp file and an atomic rename,
+before the files it no longer names are deleted. A restart opens exactly the
+listed tables, deletes any other table file (the output of an interrupted
+flush or compaction) and replays only the WAL segments after the checkpoint.
+"""
+import json
+import os
+
+FORMAT = 1
+
+
+def write_manifest(path, levels, next_table_id, wal_checkpoint):
+    """Atomically replace ``path``; ``levels`` lists the table file names (not paths) of every level."""
+    state = {"format": FORMAT, "levels": levels, "next_table_id": next_table_id, "wal_checkpoint": wal_checkpoint}
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_manifest(path):
+    """Return the manifest as a dict, or None when the store has none yet (a new or pre-manifest data dir)."""
+    try:
+        with open(path, "r") as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+    if state.get("format") != FORMAT:
+        raise ValueError(f"{path}: unsupported manifest format {state.get('format')!r}")
+    return state
@@ -0,0 +1,69 @@
+from bisect import bisect_left, bisect_right, insort
+
+from .ttl import expired, now_ms
+
+ENTRY_OVERHEAD = 64  # rough per-entry cost of the dict slot, key list slot and str headers
+
+
+class Memtable:
+    """Sorted in-memory table. A value of None is a tombstone."""
+
+    def __init__(self):
+        self.data = {}
+        self.keys = []
+        self.expires = {}  # key -> deadline (store.ttl) of keys written with a TTL
+        self.size = 0
+        self.wal_segment = None
+
+    def put(self, key, value, expires_at=None):
+        if key in self.data:
+            old = self.data[key]
+            self.size -= len(old) if old is not None else 0
+            self.data[key] = value
+        else:
+            # Publish in data before keys so concurrent items() never sees a missing key
+            self.data[key] = value
+            insort(self.keys, key)
+            self.size += len(key) + ENTRY_OVERHEAD
+        self.size += len(value) if value is not None else 0
+        if expires_at is not None:
+            self.expires[key] = expires_at
+        elif self.expires:
+            self.expires.pop(key, None)
+
+    def delete(self, key):
+        self.put(key, None)
+
+    def lookup(self, key):
+        """Return (found, value); an expired key is found with value None, shadowing older tables."""
+        if key in self.data:
+            if self.expires and expired(self.expires.get(key), now_ms()):
+                return True, None
+            return True, self.data[key]
+        return False, None
+
+    def get(self, key):
+        return self.lookup(key)[1]
+
+    def entries(self, start=None, end=None):
+        """Yield (key, value, deadline or None) in key order from start to end inclusive, tombstones included."""
+        lo = 0 if start is None else bisect_left(self.keys, start)
+        hi = len(self.keys) if end is None else bisect_right(self.keys, end)
+        data, expires = self.data, self.expires
+        for key in self.keys[lo:hi]:
+            yield key, data[key], expires.get(key)
+
+    def items(self, start=None, end=None):
+        """Yield (key, value) in key order from start to end inclusive; tombstones and expired keys have None."""
+        now = now_ms()
+        for key, value, expires_at in self.entries(start, end):
+            yield key, None if expired(expires_at, now) else value
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __len__(self):
+        return len(self.data)
@@ -0,0 +1,201 @@
+"""
+Latency histograms for the hot paths and a Prometheus text exposition of
+everything a node knows about itself (served on /metrics by server.py).
+
+Instrumented objects keep their own ``stats`` counters and ``latency``
+histograms; nothing is registered globally, and the exposition reads them
+when it is scraped. Observing is a bisect and three increments, cheap
+enough to leave on.
+"""
+import time
+from bisect import bisect_left
+
+# Upper bounds in seconds, 50us .. 10s
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram. Increments are not locked: like the ``stats`` dicts
+    they sit next to, a racing scrape may see a count that is one behind.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of observations."""
+        if not self.count:
+            return None
+        target, seen = fraction * self.count, 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+def histograms(*names):
+    return {name: Histogram() for name in names}
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for name, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{name}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _format_value(value):
+    if value is None:
+        return "NaN"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Exposition:
+    """Collects samples by metric family and renders the Prometheus text format (version 0.0.4)."""
+
+    def __init__(self, prefix="kv_"):
+        self.prefix = prefix
+        self.families = {}  # name -> (type, help, [lines])
+
+    def _family(self, name, kind, help_text):
+        name = self.prefix + name
+        if name not in self.families:
+            self.families[name] = (kind, help_text, [])
+        return name, self.families[name][2]
+
+    def gauge(self, name, help_text, value, **labels):
+        name, lines = self._family(name, "gauge", help_text)
+        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+    def counter(self, name, help_text, value, **labels):
+        name, lines = self._family(name, "counter", help_text)
+        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+    def histogram(self, name, help_text, histogram, **labels):
+        name, lines = self._family(name, "histogram", help_text)
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{_format_labels(dict(labels, le=_format_value(bound)))} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(histogram.sum)}")
+        lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+
+    def render(self):
+        out = []
+        for name, (kind, help_text, lines) in self.families.items():
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(lines)
+        return "\n".join(out) + "\n"
+
+
+def collect(members, exposition=None):
+    """
+    Exposition of the given (KeyValueStore, RaftNode) pairs, one per partition:
+    operation counters and latencies, WAL, flush, snapshot and compaction
+    activity, memtable/SSTable sizes, cache hit rates and Raft replication
+    state including each follower's lag behind the leader.
+    """
+    out = exposition or Exposition()
+    for partition, (store, node) in enumerate(members):
+        p = {"partition": partition}
+        for op, count in store.stats.items():
+            out.counter("store_operations_total", "Store operations (keys for puts and deletes)", count, op=op, **p)
+        for op, histogram in store.latency.items():
+            out.histogram("store_duration_seconds", "Store operation latency", histogram, op=op, **p)
+
+        wal = store.wal.stats
+        out.counter("wal_records_total", "Records appended to the WAL", wal["appends"], **p)
+        out.counter("wal_group_commits_total", "WAL group commits (one write, at most one fsync)", wal["batches"], **p)
+        out.counter("wal_fsyncs_total", "WAL fsync calls", wal["fsyncs"], **p)
+        out.counter("wal_bytes_total", "Bytes written to the WAL", wal["bytes"], **p)
+        out.gauge("wal_active_bytes", "Size of the active WAL segment", store.wal.active_bytes, **p)
+        for op, histogram in store.wal.latency.items():
+            out.histogram("wal_duration_seconds", "WAL group commit write and fsync latency", histogram,
+                          op=op, **p)
+
+        sizes = store.table_stats()
+        out.gauge("memtable_bytes", "Approximate size of the active memtable", sizes["memtable_bytes"], **p)
+        out.gauge("memtable_entries", "Entries in the active memtable", sizes["memtable_entries"], **p)
+        out.gauge("immutable_memtables", "Sealed memtables waiting to be flushed", sizes["immutable_memtables"], **p)
+        for level, (tables, nbytes) in enumerate(sizes["levels"]):
+            out.gauge("sstables", "Live SSTables per level", tables, level=level, **p)
+            out.gauge("sstable_bytes", "SSTable bytes per level", nbytes, level=level, **p)
+
+        compactor = store.compactor.stats
+        out.counter("compactions_total", "Compactions run", compactor["compactions"], **p)
+        out.counter("expiry_compactions_total", "Compactions run to purge expired keys",
+                    compactor["expiry_compactions"], **p)
+        out.counter("compaction_read_bytes_total", "Bytes read by compactions", compactor["bytes_read"], **p)
+        out.counter("compaction_written_bytes_total", "Bytes written by compactions", compactor["bytes_written"], **p)
+        out.gauge("write_amplification", "(flushed + compacted bytes) / flushed bytes",
+                  compactor["write_amplification"], **p)
+        out.histogram("compaction_duration_seconds", "Compaction latency", store.compactor.latency, **p)
+
+        for name, cache in store.cache_stats().items():
+            if cache is None:
+                continue
+            c = dict(p, cache=name)
+            for event in ("hits", "misses", "evictions", "rejections"):
+                out.counter(f"cache_{event}_total", f"Cache {event}", cache[event], **c)
+            out.gauge("cache_bytes", "Bytes held by the cache", cache["bytes"], **c)
+            out.gauge("cache_capacity_bytes", "Cache capacity", cache["capacity_bytes"], **c)
+            out.gauge("cache_hit_ratio", "Cache hits / lookups since start", cache["hit_rate"], **c)
+
+        if node is None:
+            continue
+        status = node.replication_status()
+        out.gauge("raft_term", "Current Raft term", status["term"], **p)
+        out.gauge("raft_leader", "1 if this node leads the partition", status["state"] == "leader", **p)
+        out.gauge("raft_last_index", "Index of the last log entry", status["last_index"], **p)
+        out.gauge("raft_commit_index", "Highest committed log index", status["commit_index"], **p)
+        out.gauge("raft_applied_index", "Highest log index applied to the store", status["last_applied"], **p)
+        out.gauge("raft_snapshot_index", "Log index covered by the latest snapshot", status["snapshot_index"], **p)
+        out.gauge("raft_log_entries", "Entries kept in the in-memory log", status["log_entries"], **p)
+        for follower in status["followers"]:
+            f = dict(p, follower=follower["peer"])
+            out.gauge("raft_follower_match_index", "Highest entry known replicated on the follower",
+                      follower["match_index"], **f)
+            out.gauge("raft_follower_lag_entries", "Entries the follower is behind the leader's log",
+                      follower["lag_entries"], **f)
+            out.gauge("raft_follower_last_reply_seconds", "Seconds since the follower last answered",
+                      follower["last_reply_seconds"], **f)
+        for op, histogram in node.latency.items():
+            out.histogram("raft_duration_seconds", "Raft replication (append to majority ack), apply and "
+                          "snapshot latency", histogram, op=op, **p)
+    return out
@@ -1,98 +1,891 @@
+import base64
+import collections
+import os
 import threading
 import time
 import random
 import socket
 import json
 
+from .metrics import histograms
+from .raftlog import RaftLog
+from .snapshot import read_snapshot_meta, write_snapshot
+
+ELECTION_TIMEOUT = (0.4, 0.8)  # seconds without a leader before standing for election, randomized
+HEARTBEAT_INTERVAL = 0.1
+MAX_BATCH_ENTRIES = 512   # log entries per AppendEntries message
+MAX_IN_FLIGHT = 8         # unacknowledged AppendEntries per follower
+REPLY_TIMEOUT = 2         # a follower this slow to answer gets a fresh connection
+CONNECT_TIMEOUT = 0.5
+RECONNECT_DELAY = 0.1
+LEASE_FRACTION = 0.9      # of the minimum election timeout, leaving room for clock drift
+SNAPSHOT_ENTRIES = 10000  # applied entries between store snapshots; the log is truncated behind each
+LOG_TRAILING_ENTRIES = 1000  # entries kept behind the snapshot so slightly lagging followers skip InstallSnapshot
+SNAPSHOT_CHUNK_BYTES = 256 * 1024
+SNAPSHOT_WINDOW = 4       # unacknowledged InstallSnapshot chunks per follower
+NOOP = ("NOOP", None, None)  # appended by a new leader so earlier-term entries can commit
+READ_MODES = ("leader-lease", "read-index", "stale-ok")
+WATCH_SCAN_ENTRIES = 4096  # log entries one changes() call looks through, matching or not
+
+
+class NotLeaderError(Exception):
+    """The operation has to go to the leader (``leader``, or None while unknown)."""
+
+    def __init__(self, leader):
+        super().__init__(f"not the leader (leader is {leader})")
+        self.leader = leader
+
+
+class LogCompactedError(Exception):
+    """The log no longer holds the entries after the requested index (they are in a snapshot)."""
+
+    def __init__(self, index, log_start):
+        super().__init__(f"log index {index} is no longer in the log (it starts after {log_start})")
+        self.index = index
+        self.log_start = log_start
+
+
+class PeerConnection:
+    """
+    Persistent JSON-lines connection to a peer's client port. The peer answers
+    messages in order, so callbacks queue up and a reader thread hands each
+    reply (a dict, or None if the connection died) to the next one.
+    """
+
+    def __init__(self, peer, timeout=1):
+        self.sock = socket.create_connection(peer, timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(None)
+        self.reader = self.sock.makefile("rb")
+        self.callbacks = collections.deque()
+        self.lock = threading.Lock()
+        self.closed = False
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    def send(self, msg, callback):
+        with self.lock:
+            if self.closed:
+                raise ConnectionError("connection closed")
+            self.callbacks.append(callback)
+            try:
+                self.sock.sendall((json.dumps(msg) + "\n").encode())
+            except OSError:
+                self.callbacks.pop()
+                raise
+
+    def _read_loop(self):
+        try:
+            while True:
+                line = self.reader.readline()
+                if not line:
+                    break
+                with self.lock:
+                    if not self.callbacks:
+                        break  # closed under us: its callbacks have already been failed
+                    callback = self.callbacks.popleft()
+                try:
+                    reply = json.loads(line)
+                except ValueError:
+                    reply = None  # ERR line from the peer
+                callback(reply if isinstance(reply, dict) else None)
+        except (OSError, ValueError):
+            pass
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            callbacks, self.callbacks = self.callbacks, collections.deque()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        for callback in callbacks:
+            callback(None)
+
+
+class PeerTransport:
+    """One persistent PeerConnection per peer, shared by elections and replication."""
+
+    def __init__(self):
+        self.conns = {}
+        self.locks = collections.defaultdict(threading.Lock)
+        self.lock = threading.Lock()
+
+    def send(self, peer, msg, callback):
+        """Send ``msg``; ``callback`` gets the reply. Raises OSError if the peer is unreachable."""
+        with self.lock:
+            peer_lock = self.locks[peer]
+        with peer_lock:
+            conn = self.conns.get(peer)
+            if conn is None or conn.closed:
+                conn = self.conns[peer] = PeerConnection(peer, CONNECT_TIMEOUT)
+        conn.send(msg, callback)
+
+    def send_async(self, peer, msg, callback):
+        """Like send, but connects and sends from a helper thread; unreachable peers reply None."""
+        def task():
+            try:
+                self.send(peer, msg, callback)
+            except OSError:
+                callback(None)
+        threading.Thread(target=task, daemon=True).start()
+
+    def reset(self, peer):
+        conn = self.conns.pop(peer, None)
+        if conn is not None:
+            conn.close()
+
+    def close(self):
+        for peer in list(self.conns):
+            self.reset(peer)
+
+
+class PeerReplicator:
+    """
+    Leader-side replication to one follower. Entries appended while earlier
+    AppendEntries are unacknowledged are batched into the next message, and up
+    to MAX_IN_FLIGHT messages are pipelined on the peer connection. An idle
+    follower gets an empty AppendEntries every HEARTBEAT_INTERVAL.
+
+    A follower that needs entries from before the start of our log is sent the
+    snapshot file instead, in SNAPSHOT_CHUNK_BYTES chunks with at most
+    SNAPSHOT_WINDOW of them unacknowledged, then replication resumes after it.
+    """
+
+    def __init__(self, node, peer, term):
+        self.node = node
+        self.peer = peer
+        self.term = term
+        self.next_index = node.last_index() + 1
+        self.match_index = 0
+        self.in_flight = 0
+        self.last_sent = 0
+        self.acked_at = 0  # send time of the newest message the follower accepted
+        self.last_reply = time.monotonic()
+        self.snapshot = None  # (file, last index, last term, size) while streaming InstallSnapshot
+        self.snapshot_offset = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def active(self):
+        node = self.node
+        return not node.stopped and node.state == "leader" and node.current_term == self.term
+
+    def run(self):
+        node = self.node
+        while True:
+            with node.cond:
+                msg = self._next_message()
+                if msg is None:
+                    self._close_snapshot()
+                    break
+                sent_at = self.last_sent
+            try:
+                node.transport.send(self.peer, msg, lambda reply, sent_at=sent_at: self._on_reply(sent_at, reply))
+            except OSError:
+                self._on_reply(sent_at, None)
+                time.sleep(RECONNECT_DELAY)
+
+    def _next_message(self):
+        # Caller holds node.cond. Blocks until there is something to send; None once we are no longer leader.
+        node = self.node
+        while self.active():
+            now = time.monotonic()
+            if self.in_flight and now - self.last_reply > REPLY_TIMEOUT:
+                self.last_reply = now
+                node.transport.reset(self.peer)  # fails the in-flight messages and rewinds next_index
+                continue
+            if self.snapshot is None and self.next_index <= node.log_start and not self.in_flight:
+                self._open_snapshot()
+            if self.snapshot is not None:
+                if self.in_flight < SNAPSHOT_WINDOW and self.snapshot_offset < self.snapshot[3]:
+                    self.in_flight += 1
+                    self.last_sent = now
+                    return self._snapshot_chunk()
+                node.cond.wait(min(HEARTBEAT_INTERVAL, REPLY_TIMEOUT))
+                continue
+            has_entries = self.next_index <= node.last_index()
+            heartbeat_due = now - self.last_sent >= HEARTBEAT_INTERVAL or self.last_sent < node.heartbeat_requested
+            if self.in_flight < MAX_IN_FLIGHT and (has_entries or heartbeat_due) and self.next_index > node.log_start:
+                prev_index = self.next_index - 1
+                entries = node.entries(prev_index, prev_index + MAX_BATCH_ENTRIES)
+                self.next_index += len(entries)
+                self.in_flight += 1
+                self.last_sent = now
+                return {
+                    "type": "append_entries", "partition": node.partition, "term": self.term, "leader": node.node_id,
+                    "prev_index": prev_index, "prev_term": node.term_at(prev_index),
+                    "entries": entries, "commit": node.commit_index,
+                }
+            node.cond.wait(HEARTBEAT_INTERVAL if not self.in_flight else min(HEARTBEAT_INTERVAL, REPLY_TIMEOUT))
+        return None
+
+    def _open_snapshot(self):
+        # Caller holds node.cond, under which the node swaps snapshot files, so the
+        # file and its index always belong together.
+        node = self.node
+        f = open(node.snapshot_path, "rb")
+        self.snapshot = (f, node.snapshot_index, node.snapshot_term, os.fstat(f.fileno()).st_size)
+        self.snapshot_offset = 0
+        print(f"[RAFT] Sending snapshot at index {node.snapshot_index} to {self.peer}")
+
+    def _snapshot_chunk(self):
+        f, last_index, last_term, size = self.snapshot
+        offset = self.snapshot_offset
+        data = f.read(SNAPSHOT_CHUNK_BYTES)
+        self.snapshot_offset += len(data)
+        return {
+            "type": "install_snapshot", "partition": self.node.partition, "term": self.term,
+            "leader": self.node.node_id,
+            "last_index": last_index, "last_term": last_term, "offset": offset,
+            "data": base64.b64encode(data).decode("ascii"), "done": self.snapshot_offset >= size,
+        }
+
+    def _close_snapshot(self):
+        if self.snapshot is not None:
+            self.snapshot[0].close()
+            self.snapshot = None
+
+    def _on_reply(self, sent_at, reply):
+        node = self.node
+        with node.cond:
+            self.in_flight -= 1
+            self.last_reply = time.monotonic()
+            if reply is None:
+                # Resend everything the follower has not confirmed (a snapshot from its start)
+                self._close_snapshot()
+                self.next_index = self.match_index + 1
+            elif reply.get("term", 0) > node.current_term:
+                node.step_down(reply["term"])
+            elif reply.get("success"):
+                self.match_index = max(self.match_index, reply["match"])
+                self.acked_at = max(self.acked_at, sent_at)
+                if self.snapshot is not None and reply.get("installed"):
+                    self._close_snapshot()
+                    self.next_index = self.match_index + 1
+                node.advance_commit()
+                node.maybe_transfer_leadership(self)
+            elif self.snapshot is not None:
+                self._close_snapshot()
+                self.next_index = self.match_index + 1
+            else:
+                self.next_index = max(1, min(self.next_index, reply["match"] + 1))
+            node.cond.notify_all()
+
+
 class RaftNode:
-    def __init__(self, node_id, peers, kvstore):
+    """
+    Raft consensus for one node: leader election and log replication over
+    persistent connections to the peers' client ports. Candidates ask every
+    peer for its vote at once; votes go only to candidates whose log is at
+    least as up to date as ours. Term and vote are persisted in the store's WAL,
+    the log itself in ``raft_log.bin`` (store.raftlog): a node syncs an entry there
+    before acknowledging it, or as leader before counting itself towards a majority.
+
+    Every node applies log entries to its store in log order once they are
+    committed: a follower when the leader's commit index reaches them, the
+    leader when a majority holds them. ``last_applied`` is how far the store
+    has got (never past ``commit_index``), which is what read_barrier() waits on.
+
+    A node can host several Raft groups, one per ``partition``; messages carry
+    the partition so the server can route them. When ``preferred_leader`` is
+    set, a leader hands over to that node once it has caught up (TimeoutNow),
+    which keeps the groups' leaders spread over the cluster.
+
+    Every SNAPSHOT_ENTRIES applied entries the store is snapshotted to
+    ``snapshot_path`` and the log before it is dropped (but for a trailing
+    LOG_TRAILING_ENTRIES), so ``log`` only holds the entries after ``log_start``.
+    """
+
+    def __init__(self, node_id, peers, kvstore, partition=0):
         self.node_id = node_id
         self.peers = peers
         self.kvstore = kvstore
+        self.partition = partition
+        self.preferred_leader = None
+        self.transfer_sent_at = None
         self.state = "follower"
-        self.current_term = 0
-        self.voted_for = None
-        self.log = []
+        self.current_term = kvstore.current_term
+        self.voted_for = kvstore.voted_for
+        self.log = []  # [term, entry] pairs; log index i is self.log[i - log_start - 1]
+        self.log_start = 0       # index of the last entry dropped from the log ...
+        self.log_start_term = 0  # ... and its term
+        self.snapshot_path = os.path.join(kvstore.data_dir, "raft_snapshot.bin")
+        self.snapshot_index = 0
+        self.snapshot_term = 0
+        self.snapshot_entries = SNAPSHOT_ENTRIES
+        self.log_trailing_entries = LOG_TRAILING_ENTRIES
+        self.snapshotting = False
+        self.incoming_snapshot = None  # file receiving an InstallSnapshot stream
         self.commit_index = 0
+        self.last_applied = 0
+        self.persisted_index = 0  # on the leader, how far the log is durable on disk
+        self.apply_lock = threading.Lock()  # taken before self.cond
         self.leader = None
-        self.election_timeout = random.uniform(3, 5)
-        self.last_heartbeat = time.time()
+        self.replicators = []
+        self.replication_timeout = 5
+        self.transport = PeerTransport()
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.election_timeout = random.uniform(*ELECTION_TIMEOUT)
+        self.last_heartbeat = time.monotonic()
+        self.leader_contact = 0      # when the leader last reached us
+        self.caught_up_at = 0        # when our store last reflected the leader's commit index
+        self.heartbeat_requested = 0  # replicators send a heartbeat if they have not since
+        self.watchers = set()  # callbacks run whenever changes() may have more to return
+        self.latency = histograms("replicate", "apply", "snapshot")
+        self._load_snapshot()
+        self.raft_log = RaftLog(os.path.join(kvstore.data_dir, "raft_log.bin"), kvstore.wal.fsync_policy != "os")
+        self._load_log()
         threading.Thread(target=self.election_timer, daemon=True).start()
+        threading.Thread(target=self._apply_loop, daemon=True).start()
+
+    def _load_snapshot(self):
+        # The store already holds at least everything up to our last snapshot, so after a
+        # restart the log resumes from there instead of from index 1.
+        if not os.path.exists(self.snapshot_path):
+            return
+        meta, _ = read_snapshot_meta(self.snapshot_path)
+        self.snapshot_index = self.log_start = self.commit_index = self.last_applied = meta["last_index"]
+        self.snapshot_term = self.log_start_term = meta["last_term"]
+
+    def _load_log(self):
+        # The logged entries are kept if they join up with the snapshot the store resumes
+        # from; a log that does not (the snapshot was installed after it) starts over there.
+        loaded = self.raft_log.load()
+        if loaded is not None:
+            log_start, log_start_term, log = loaded
+            if log_start <= self.snapshot_index <= log_start + len(log):
+                self.log_start, self.log_start_term, self.log = log_start, log_start_term, log
+                if self.term_at(self.snapshot_index) == self.snapshot_term:
+                    return
+            self.log = []
+            self.log_start, self.log_start_term = self.snapshot_index, self.snapshot_term
+        self.raft_log.rewrite(self.log_start, self.log_start_term, self.log)
 
     def election_timer(self):
-        while True:
-            time.sleep(0.5)
-            if self.state != "leader" and (time.time() - self.last_heartbeat) > self.election_timeout:
-                self.start_election()
-
-    def start_election(self):
-        self.state = "candidate"
-        self.current_term += 1
-        self.voted_for = self.node_id
-        votes = 1
+        with self.cond:
+            while not self.stopped:
+                if self.state == "leader":
+                    self.cond.wait()
+                    continue
+                remaining = self.last_heartbeat + self.election_timeout - time.monotonic()
+                if remaining > 0:
+                    self.cond.wait(remaining)
+                else:
+                    self.start_election()
+
+    def start_election(self, transfer=False):
+        """
+        Stand for leader in the next term, requesting votes from all peers concurrently.
+        ``transfer`` marks an election the current leader asked for (TimeoutNow).
+        """
+        with self.cond:
+            self.state = "candidate"
+            self.current_term += 1
+            self.voted_for = self.node_id
+            self.leader = None
+            self._persist_state()
+            self.last_heartbeat = time.monotonic()
+            self.election_timeout = random.uniform(*ELECTION_TIMEOUT)
+            term, votes = self.current_term, {self.node_id}
+            print(f"[ELECTION] Node {self.node_id} requesting votes for term {term}...")
+            msg = {"type": "request_vote", "partition": self.partition, "term": term, "candidate": self.node_id,
+                   "last_log_index": self.last_index(), "last_log_term": self.term_at(self.last_index()),
+                   "transfer": transfer}
+            self._count_votes(term, votes)
         for peer in self.peers:
-            if self.request_vote(peer):
-                votes += 1
-        if votes > (len(self.peers) + 1) // 2:
+            self.transport.send_async(peer, msg, lambda reply, peer=peer: self._on_vote(term, votes, peer, reply))
+
+    def _on_vote(self, term, votes, peer, reply):
+        with self.cond:
+            if reply is None:
+                return
+            if reply["term"] > self.current_term:
+                self.step_down(reply["term"])
+            elif reply.get("granted") and reply["term"] == term:
+                votes.add(peer)
+                self._count_votes(term, votes)
+
+    def _count_votes(self, term, votes):
+        # Caller holds self.cond
+        if self.state == "candidate" and self.current_term == term and len(votes) > (len(self.peers) + 1) // 2:
+            self.become_leader()
+
+    def become_leader(self):
+        with self.cond:
             self.state = "leader"
             self.leader = self.node_id
-            threading.Thread(target=self.send_heartbeats, daemon=True).start()
+            self.transfer_sent_at = None
+            self.log.append([self.current_term, list(NOOP)])
+            self.raft_log.sync(self.raft_log.append(self.last_index(), self.current_term, list(NOOP)))
+            self.persisted_index = self.last_index()
+            self.replicators = [PeerReplicator(self, peer, self.current_term) for peer in self.peers]
+            self.advance_commit()
+            self.cond.notify_all()
+            print(f"[ELECTION] Node {self.node_id} became LEADER for term {self.current_term}")
 
-    def request_vote(self, peer):
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(1)
-            sock.connect(peer)
-            msg = json.dumps({"type": "vote_request", "term": self.current_term})
-            sock.sendall(msg.encode())
-            resp = sock.recv(1024).decode()
-            sock.close()
-            return resp == "vote_granted"
-        except:
-            return False
-
-    def send_heartbeats(self):
-        while self.state == "leader":
-            for peer in self.peers:
-                try:
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.settimeout(1)
-                    sock.connect(peer)
-                    msg = json.dumps({"type": "heartbeat", "leader": self.node_id})
-                    sock.sendall(msg.encode())
-                    sock.close()
-                except:
-                    pass
-            time.sleep(1)
+    def step_down(self, term, leader=None):
+        # Caller holds self.cond
+        if term > self.current_term:
+            self.current_term = term
+            self.voted_for = None
+            self._persist_state()
+        if leader is not None:
+            self.last_heartbeat = self.leader_contact = time.monotonic()
+            if leader != self.leader:
+                print(f"[ELECTION] Node {leader} is the LEADER for term {term}")
+        self.state = "follower"
+        self.leader = leader
+        self.cond.notify_all()
+
+    def maybe_transfer_leadership(self, replicator):
+        # Caller holds self.cond. Ask the preferred leader to take over once it holds our whole log.
+        now = time.monotonic()
+        if (self.state == "leader" and replicator.peer[1] == self.preferred_leader != self.node_id
+                and replicator.match_index == self.last_index() == self.commit_index
+                and (self.transfer_sent_at is None or now - self.transfer_sent_at > ELECTION_TIMEOUT[1])):
+            self.transfer_sent_at = now
+            msg = {"type": "timeout_now", "partition": self.partition, "term": self.current_term}
+            self.transport.send_async(replicator.peer, msg, lambda reply: None)
+
+    def handle_timeout_now(self, msg):
+        with self.cond:
+            if msg["term"] == self.current_term and self.state == "follower":
+                print(f"[ELECTION] Node {self.node_id} taking over leadership of partition {self.partition}")
+                self.start_election(transfer=True)
+        return {"term": self.current_term}
+
+    def _persist_state(self):
+        # Caller holds self.cond. Must be durable before we act on the new term or vote.
+        self.kvstore.save_raft_state(self.current_term, self.voted_for)
+
+    def last_index(self):
+        return self.log_start + len(self.log)
+
+    def term_at(self, index):
+        if index == self.log_start:
+            return self.log_start_term
+        return self.log[index - self.log_start - 1][0] if self.log_start < index <= self.last_index() else 0
+
+    def applied_index(self):
+        # The last index whose write reads may see: both applied to our store and committed
+        return min(self.last_applied, self.commit_index)
+
+    def entries(self, start, end):
+        """The [term, entry] pairs with log index in (start, end]; start must be >= log_start."""
+        return self.log[start - self.log_start:end - self.log_start]
+
+    def advance_commit(self):
+        # Caller holds self.cond. An entry from the current term is committed once a
+        # majority of the cluster (the leader included, once the entry is on its disk) holds it.
+        matches = sorted([self.persisted_index] + [r.match_index for r in self.replicators], reverse=True)
+        index = matches[(len(self.peers) + 1) // 2]
+        if index > self.commit_index and self.term_at(index) == self.current_term:
+            self.commit_index = index
+            self.cond.notify_all()
 
     def replicate_log(self, entry):
-        self.log.append(entry)
-        for peer in self.peers:
-            try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.settimeout(1)
-                sock.connect(peer)
-                msg = json.dumps({"type": "replicate", "entry": entry})
-                sock.sendall(msg.encode())
-                sock.close()
-            except:
-                pass
+        """
+        Append ``entry`` to the log, block until a majority of the cluster holds it,
+        then apply it to the leader's store.
+        """
+        started = time.perf_counter()
+        with self.cond:
+            if self.state != "leader":
+                raise NotLeaderError(self.leader)
+            term = self.current_term
+            self.log.append([term, entry])
+            index = self.last_index()
+            seq = self.raft_log.append(index, term, entry)
+            self.cond.notify_all()  # replicators can send it while we sync it
+        self.raft_log.sync(seq)
+        with self.cond:
+            if self.state == "leader" and self.current_term == term:
+                self.persisted_index = max(self.persisted_index, index)
+                self.advance_commit()
+            deadline = time.monotonic() + self.replication_timeout
+            while self.commit_index < index:
+                if self.state != "leader" or self.current_term != term:
+                    raise RuntimeError("leadership lost before the write committed")
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("write was not acknowledged by a majority")
+                self.cond.wait(remaining)
+        self.latency["replicate"].observe(time.perf_counter() - started)
+        self._apply_committed(index)
+        return index
+
+    def _apply_committed(self, index):
+        # Apply committed entries in log order. Whoever gets the lock applies everything
+        # committed so far as one store batch; writers queued behind it find their entry done.
+        with self.apply_lock:
+            with self.cond:
+                if self.last_applied >= index:
+                    return
+                start, end = self.last_applied, self.commit_index
+                entries = [entry for _, entry in self.entries(start, end)]
+            with self.latency["apply"].time():
+                self.kvstore.batch_write(list(entry_operations(entries)))
+            with self.cond:
+                self.last_applied = max(self.last_applied, end)
+                self._maybe_snapshot()
+                self._wake_watchers()
+                self.cond.notify_all()
+
+    def _apply_loop(self):
+        # Applies what commits with no writer waiting in replicate_log to do it, such as
+        # the entries of earlier terms a new leader commits along with its NOOP
+        while True:
+            with self.cond:
+                while not self.stopped and self.last_applied >= self.commit_index:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                index = self.commit_index
+            self._apply_committed(index)
+
+    def _maybe_snapshot(self):
+        # Caller holds self.cond
+        if not self.snapshotting and self.last_applied - self.snapshot_index >= self.snapshot_entries:
+            self.snapshotting = True
+            threading.Thread(target=self._take_snapshot, daemon=True).start()
+
+    def _take_snapshot(self):
+        """Snapshot the store as of applied_index(), then drop the log entries it covers."""
+        started = time.perf_counter()
+        try:
+            with self.apply_lock:  # the store must not move past ``index`` while it is sealed
+                with self.cond:
+                    index = self.applied_index()
+                    term = self.term_at(index)
+                items, meta = self.kvstore.snapshot_items()
+            meta.update(last_index=index, last_term=term)
+            write_snapshot(self.snapshot_path + ".new", items, meta, self.kvstore.compression)
+            with self.cond:
+                os.replace(self.snapshot_path + ".new", self.snapshot_path)
+                self.snapshot_index, self.snapshot_term = index, term
+                self.compact_log(index - self.log_trailing_entries)
+            self.latency["snapshot"].observe(time.perf_counter() - started)
+        finally:
+            with self.cond:
+                self.snapshotting = False
+
+    def compact_log(self, index):
+        # Caller holds self.cond. Drop entries up to ``index``; only committed entries the snapshot
+        # covers may go.
+        index = min(index, self.snapshot_index, self.commit_index)
+        if index <= self.log_start:
+            return
+        self.log_start_term = self.term_at(index)
+        del self.log[:index - self.log_start]
+        self.log_start = index
+        self.raft_log.rewrite(self.log_start, self.log_start_term, self.log)
+
+    def changes(self, after=None, prefix="", limit=1000):
+        """
+        Committed writes to keys starting with ``prefix`` from the log entries after
+        index ``after``, oldest first: ([(index, op, key, value)], next index), op being
+        PUT or DELETE (value None). Only entries both committed and applied here are
+        returned, so a read that follows sees them. A batch never splits an entry and
+        stops once it has ``limit`` events; the next call resumes after ``next index``.
+        ``after`` None means from the current position. Raises LogCompactedError when
+        the entries after ``after`` were dropped for a snapshot.
+        """
+        with self.cond:
+            horizon = self.applied_index()
+            if after is None or after >= horizon:
+                return [], horizon if after is None else after
+            if after < self.log_start:
+                raise LogCompactedError(after, self.log_start)
+            events, index = [], after
+            for _, entry in self.entries(after, min(horizon, after + WATCH_SCAN_ENTRIES)):
+                index += 1
+                for op, key, value in entry_operations([entry]):
+                    if key.startswith(prefix):
+                        if op == "PUTEX":
+                            op, value = "PUT", value[0]
+                        events.append((index, op, key, value))
+                if len(events) >= limit:
+                    break
+            return events, index
+
+    def add_watcher(self, callback):
+        """Have ``callback()`` run whenever changes() may have more; it runs under self.cond and must not block."""
+        with self.cond:
+            self.watchers.add(callback)
+
+    def remove_watcher(self, callback):
+        with self.cond:
+            self.watchers.discard(callback)
+
+    def _wake_watchers(self):
+        # Caller holds self.cond
+        for callback in self.watchers:
+            callback()
+
+    def replication_status(self):
+        """Log positions, and on a leader each follower's progress, for /metrics and /status."""
+        now = time.monotonic()
+        with self.cond:
+            last_index = self.last_index()
+            status = {"state": self.state, "term": self.current_term, "leader": self.leader,
+                      "last_index": last_index, "commit_index": self.commit_index,
+                      "last_applied": self.last_applied, "snapshot_index": self.snapshot_index,
+                      "log_entries": len(self.log), "followers": []}
+            if self.state == "leader":
+                for r in self.replicators:
+                    status["followers"].append({
+                        "peer": f"{r.peer[0]}:{r.peer[1]}", "match_index": r.match_index,
+                        "lag_entries": last_index - r.match_index,
+                        "last_reply_seconds": round(now - r.last_reply, 3)})
+        return status
+
+    def lease_valid(self):
+        # The followers that acknowledged a message sent at time t will not vote for anyone
+        # else before t + the minimum election timeout, so until then no other leader exists.
+        if self.state != "leader" or self.transfer_sent_at is not None:
+            return False  # a node we asked to take over may win votes at any time
+        acked = sorted([time.monotonic()] + [r.acked_at for r in self.replicators], reverse=True)
+        return acked[(len(self.peers) + 1) // 2] + ELECTION_TIMEOUT[0] * LEASE_FRACTION > time.monotonic()
+
+    def local_read_ok(self, mode, max_staleness=None):
+        """Whether a read in ``mode`` can be answered from our store right now, without waiting."""
+        if mode == "stale-ok":
+            if self.state == "leader":
+                return True
+            return max_staleness is None or time.monotonic() - self.caught_up_at <= max_staleness
+        if mode == "leader-lease":
+            return self.lease_valid() and self.applied_index() >= self.commit_index
+        return False
+
+    def read_barrier(self, mode, max_staleness=None):
+        """
+        Block until a read in ``mode`` may be served from this node's store:
+
+        - leader-lease: the leader answers while its lease holds, else as read-index
+        - read-index:   the leader's commit index, confirmed by a heartbeat round,
+                        must be applied here (on a follower, ask the leader for it)
+        - stale-ok:     any node whose data is at most ``max_staleness`` seconds old
+
+        Raises NotLeaderError when the read should go to the leader instead.
+        """
+        if mode not in READ_MODES:
+            raise ValueError(f"unknown read mode {mode!r}")
+        if self.local_read_ok(mode, max_staleness):
+            return
+        if mode == "stale-ok":
+            raise NotLeaderError(self.leader)
+        if self.state == "leader":
+            self._apply_committed(self.confirm_read_index())
+        elif mode == "leader-lease":
+            raise NotLeaderError(self.leader)
+        else:
+            self._wait_applied(self._remote_read_index())
+
+    def confirm_read_index(self):
+        """ReadIndex: our commit index, once a heartbeat round shows we are still the leader."""
+        with self.cond:
+            deadline = time.monotonic() + self.replication_timeout
+            term = self.current_term
+            start = None
+            while True:
+                if self.state != "leader" or self.current_term != term:
+                    raise NotLeaderError(self.leader)
+                if start is None and self.term_at(self.commit_index) == term:
+                    # Only once an entry of our own term has committed is commit_index current
+                    start = time.monotonic()
+                    read_index = self.commit_index
+                    self.heartbeat_requested = start
+                    self.cond.notify_all()
+                if start is not None:
+                    acked = sorted([start] + [r.acked_at for r in self.replicators], reverse=True)
+                    if acked[(len(self.peers) + 1) // 2] >= start:
+                        return read_index
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("could not confirm leadership with a majority")
+                self.cond.wait(remaining)
+
+    def _remote_read_index(self):
+        leader = self.leader
+        peer = next((p for p in self.peers if p[1] == leader), None)
+        if peer is None:
+            raise NotLeaderError(leader)
+        reply = {}
+        done = threading.Event()
+
+        def on_reply(msg):
+            reply.update(msg or {})
+            done.set()
+        try:
+            self.transport.send(peer, {"type": "read_index", "partition": self.partition}, on_reply)
+        except OSError:
+            raise NotLeaderError(leader)
+        if not done.wait(self.replication_timeout) or "index" not in reply:
+            raise NotLeaderError(leader)
+        return reply["index"]
+
+    def _wait_applied(self, index):
+        with self.cond:
+            deadline = time.monotonic() + self.replication_timeout
+            while self.applied_index() < index:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("did not catch up with the leader's commit index")
+                self.cond.wait(remaining)
+
+    def handle_read_index(self):
+        try:
+            return {"index": self.confirm_read_index()}
+        except (NotLeaderError, TimeoutError) as e:
+            return {"error": str(e)}
+
+    def handle_append_entries(self, msg):
+        """
+        Follower side of AppendEntries. Entries up to the leader's commit index are
+        applied to the store as one atomic batch (one WAL record and fsync); later
+        ones stay in the log only, as the next leader may still replace them.
+        """
+        with self.apply_lock, self.cond:
+            if msg["term"] < self.current_term:
+                return {"term": self.current_term, "success": False, "match": 0}
+            self.step_down(msg["term"], msg["leader"])
+            if self.stopped:
+                return {"term": self.current_term, "success": False, "match": 0}  # its log is closed
+            prev_index, entries = msg["prev_index"], msg["entries"]
+            if prev_index < self.log_start:
+                # Everything up to log_start is committed, so it matches the leader already
+                entries = entries[self.log_start - prev_index:]
+                prev_index = self.log_start
+            elif prev_index > self.last_index() or self.term_at(prev_index) != msg["prev_term"]:
+                return {"term": self.current_term, "success": False, "match": min(prev_index - 1, self.last_index())}
+            for offset, entry in enumerate(entries):
+                index = prev_index + 1 + offset
+                if index <= self.last_index():
+                    if self.term_at(index) == entry[0]:
+                        continue  # already have it
+                    # Only an uncommitted (so not yet applied) suffix can conflict
+                    del self.log[index - self.log_start - 1:]
+                self.log.append(entry)
+                self.raft_log.append(index, *entry)
+            self.raft_log.sync()  # what we acknowledge must survive a restart
+            match = prev_index + len(entries)
+            # Only what is known to match the leader's log, not a stale tail of ours
+            self.commit_index = max(self.commit_index, min(msg["commit"], match))
+            if self.last_applied < self.commit_index:
+                applied = [entry for _, entry in self.entries(self.last_applied, self.commit_index)]
+                self.kvstore.batch_write(list(entry_operations(applied)))
+                self.last_applied = self.commit_index
+                self._maybe_snapshot()
+            if self.applied_index() >= msg["commit"]:
+                self.caught_up_at = time.monotonic()
+            self._wake_watchers()
+            self.cond.notify_all()
+            return {"term": self.current_term, "success": True, "match": match}
+
+    def handle_install_snapshot(self, msg):
+        """
+        Follower side of InstallSnapshot. Chunks are appended to a temp file; the
+        last one makes it our snapshot, replaces the store's contents with it and
+        restarts our log right after it.
+        """
+        with self.apply_lock:
+            with self.cond:
+                if msg["term"] < self.current_term:
+                    return {"term": self.current_term, "success": False, "match": 0}
+                self.step_down(msg["term"], msg["leader"])
+                if self.stopped:
+                    return {"term": self.current_term, "success": False, "match": 0}
+                term = self.current_term
+            part_path = self.snapshot_path + ".part"
+            if msg["offset"] == 0:
+                self._close_incoming_snapshot()
+                self.incoming_snapshot = open(part_path, "wb")
+            elif self.incoming_snapshot is None or self.incoming_snapshot.tell() != msg["offset"]:
+                return {"term": term, "success": False, "match": 0}  # a chunk went missing: start over
+            self.incoming_snapshot.write(base64.b64decode(msg["data"]))
+            if not msg["done"]:
+                return {"term": term, "success": True, "match": 0}
+            self.incoming_snapshot.flush()
+            os.fsync(self.incoming_snapshot.fileno())
+            self._close_incoming_snapshot()
+            last_index, last_term = msg["last_index"], msg["last_term"]
+            with self.cond:
+                os.replace(part_path, self.snapshot_path)
+                self.snapshot_index, self.snapshot_term = last_index, last_term
+            self.kvstore.install_snapshot(self.snapshot_path)
+            with self.cond:
+                self.log = []
+                self.log_start, self.log_start_term = last_index, last_term
+                self.raft_log.rewrite(last_index, last_term, [])
+                self.last_applied = last_index
+                self.commit_index = max(self.commit_index, last_index)
+                self._wake_watchers()
+                self.cond.notify_all()
+            print(f"[RAFT] Node {self.node_id} installed snapshot at index {last_index}")
+            return {"term": term, "success": True, "match": last_index, "installed": True}
+
+    def _close_incoming_snapshot(self):
+        if self.incoming_snapshot is not None:
+            self.incoming_snapshot.close()
+            self.incoming_snapshot = None
+
+    def handle_request_vote(self, msg):
+        with self.cond:
+            # While a leader is known to be alive, refuse to help depose it: this is
+            # what makes leader leases safe against a partitioned node's elections.
+            # The leader itself asks for a transfer election, so that one may proceed.
+            if msg["candidate"] != self.leader and not msg.get("transfer") and (
+                    self.lease_valid() or time.monotonic() - self.leader_contact < ELECTION_TIMEOUT[0]):
+                return {"term": self.current_term, "granted": False}
+            if msg["term"] > self.current_term:
+                self.step_down(msg["term"])
+            last_index = self.last_index()
+            up_to_date = (msg["last_log_term"], msg["last_log_index"]) >= (self.term_at(last_index), last_index)
+            granted = (msg["term"] == self.current_term and up_to_date
+                       and self.voted_for in (None, msg["candidate"]))
+            if granted:
+                if self.voted_for is None:
+                    self.voted_for = msg["candidate"]
+                    self._persist_state()
+                self.last_heartbeat = time.monotonic()
+            return {"term": self.current_term, "granted": granted}
 
     def handle_message(self, msg):
-        if msg["type"] == "heartbeat":
-            self.last_heartbeat = time.time()
-            self.leader = msg["leader"]
-            self.state = "follower"
-        elif msg["type"] == "vote_request":
-            if self.voted_for is None or self.voted_for == msg["term"]:
-                self.voted_for = msg["term"]
-                return "vote_granted"
-            return "vote_denied"
-        elif msg["type"] == "replicate":
-            self.log.append(msg["entry"])
-            op, key, value = msg["entry"]
-            if op == "PUT":
-                self.kvstore.put(key, value)
-            elif op == "DEL":
-                self.kvstore.delete(key)
+        if msg["type"] == "append_entries":
+            return json.dumps(self.handle_append_entries(msg))
+        elif msg["type"] == "request_vote":
+            return json.dumps(self.handle_request_vote(msg))
+        elif msg["type"] == "timeout_now":
+            return json.dumps(self.handle_timeout_now(msg))
+        elif msg["type"] == "install_snapshot":
+            return json.dumps(self.handle_install_snapshot(msg))
+        elif msg["type"] == "read_index":
+            return json.dumps(self.handle_read_index())
         return "ok"
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.state, self.leader = "follower", None  # so clients look for another leader
+            self.cond.notify_all()
+        for replicator in self.replicators:
+            replicator.thread.join()
+        self.transport.close()
+        with self.apply_lock:  # followers write the log while holding it
+            self.raft_log.close()
+
+
+def entry_operations(entries):
+    """Expand replicated log entries into KeyValueStore.batch_write operations."""
+    for op, key, value in entries:
+        if op == "BATCH":
+            for batch_op, batch_key, batch_value in key:
+                yield batch_op, batch_key, batch_value
+        elif op == "DEL":
+            yield "DELETE", key, None
+        elif op != "NOOP":
+            yield op, key, value
@@ -0,0 +1,143 @@
+"""
+The Raft log on disk (``raft_log.bin``). A node writes every entry it takes into
+its log here, and syncs it before acknowledging the entry to a leader or counting
+itself towards a majority, so after a restart it still holds everything it
+acknowledged and cannot vote for a candidate that lacks a committed entry.
+
+Records use the WAL's framing (u32 body length | u32 crc32(body)); a body is
+u8 kind | u64 index | u64 term | JSON entry. A START record opens every file with
+the log's starting point (log_start and its term). An ENTRY whose index is not
+one past the last one cuts the log back before it: that is how a conflicting
+suffix replaced by a new leader is recorded. When the log is truncated behind a
+snapshot, or restarted by an installed one, the file is rewritten from scratch.
+"""
+import json
+import os
+import struct
+import threading
+import zlib
+
+from .wal import RECORD_HEADER
+
+RECORD_BODY = struct.Struct("<BQQ")
+START = 1
+ENTRY = 2
+
+
+def encode_record(kind, index, term, entry=None):
+    body = RECORD_BODY.pack(kind, index, term) + json.dumps(entry).encode()
+    return RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def decode_records(buf):
+    """Yield (kind, index, term, entry, end_offset); stops at the first truncated or corrupt record."""
+    offset, size = 0, len(buf)
+    while offset + RECORD_HEADER.size <= size:
+        length, crc = RECORD_HEADER.unpack_from(buf, offset)
+        start = offset + RECORD_HEADER.size
+        end = start + length
+        if length < RECORD_BODY.size or end > size:
+            return
+        body = buf[start:end]
+        if zlib.crc32(body) != crc:
+            return
+        kind, index, term = RECORD_BODY.unpack_from(body)
+        yield kind, index, term, json.loads(body[RECORD_BODY.size:]), end
+        offset = end
+
+
+class RaftLog:
+    """
+    Append-only file of log entries with group commit: append() queues a record
+    under a short lock (the caller appends to its in-memory log at the same time)
+    and sync() writes and fsyncs everything queued so far, so writers waiting
+    together share one fsync.
+    """
+
+    def __init__(self, path, fsync=True):
+        self.path = path
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()  # taken before self._lock
+        self._pending = []
+        self._appended_seq = 0
+        self._durable_seq = 0
+        self.file = open(path, "ab")
+
+    def load(self):
+        """
+        The log as last written: (log_start, log_start_term, [[term, entry], ...]),
+        or None when nothing was written yet. A torn tail is cut off the file.
+        """
+        with open(self.path, "rb") as f:
+            buf = f.read()
+        log_start = log_start_term = None
+        entries, valid_end = [], 0
+        for kind, index, term, entry, end in decode_records(buf):
+            if kind == START:
+                log_start, log_start_term, entries = index, term, []
+            elif kind != ENTRY or log_start is None or not log_start < index <= log_start + len(entries) + 1:
+                break
+            else:
+                del entries[index - log_start - 1:]
+                entries.append([term, entry])
+            valid_end = end
+        if valid_end < len(buf):
+            print(f"[RAFT] Discarding {len(buf) - valid_end} bytes of torn tail in {self.path}")
+            with self._io_lock:
+                os.truncate(self.path, valid_end)
+        if log_start is None:
+            return None
+        return log_start, log_start_term, entries
+
+    def append(self, index, term, entry):
+        """Queue log entry ``index``; returns a sequence number for sync()."""
+        record = encode_record(ENTRY, index, term, entry)
+        with self._lock:
+            self._pending.append(record)
+            self._appended_seq += 1
+            return self._appended_seq
+
+    def sync(self, seq=None):
+        """Block until the record ``seq`` (default: every record queued so far) is durable."""
+        with self._io_lock:
+            with self._lock:
+                if seq is None:
+                    seq = self._appended_seq
+                if self._durable_seq >= seq:
+                    return
+                batch, self._pending = self._pending, []
+                durable = self._appended_seq
+            self.file.write(b"".join(batch))
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+            with self._lock:
+                self._durable_seq = durable
+
+    def rewrite(self, log_start, log_start_term, entries):
+        """
+        Atomically replace the file with a log starting after ``log_start`` and holding
+        ``entries`` ([term, entry] pairs). They must include every queued record, which
+        this makes durable.
+        """
+        data = [encode_record(START, log_start, log_start_term)]
+        data += [encode_record(ENTRY, log_start + i, term, entry) for i, (term, entry) in enumerate(entries, 1)]
+        tmp_path = self.path + ".tmp"
+        with self._io_lock:
+            with self._lock:
+                self._pending = []
+                durable = self._appended_seq
+            with open(tmp_path, "wb") as f:
+                f.write(b"".join(data))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self.file.close()
+            self.file = open(self.path, "ab")
+            with self._lock:
+                self._durable_seq = durable
+
+    def close(self):
+        with self._io_lock:
+            self.file.close()
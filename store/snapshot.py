@@ -0,0 +1,110 @@
+import json
+import mmap
+import os
+import struct
+
+from . import codec
+from .ttl import expired, now_ms
+from .wal import decode_records, encode_record
+
+# Point-in-time snapshot file:
+#   MAGIC | u32 header length | JSON header | block*
+#   block: u32 stored length | u8 codec | payload
+# A block's payload, once decompressed with its codec (store.codec), is a run of
+# PUT records (WAL record encoding; PUTEX for keys with a deadline) of about BLOCK_BYTES. Records are streamed
+# in key order, so writing never holds the dataset in memory, and every record
+# carries its own length prefix and CRC. The header's "compression" names the
+# codec the file was written with. KVSNAP06 files (records without blocks) are
+# still read.
+MAGIC = b"KVSNAP07"
+MAGIC_V6 = b"KVSNAP06"
+HEADER_LEN = struct.Struct("<I")
+BLOCK_HEADER = struct.Struct("<IB")
+BLOCK_BYTES = 64 * 1024
+
+
+def write_snapshot(path, entries, meta, compression="none"):
+    """Stream (key, value, deadline or None) entries into ``path`` via a temp file and an atomic rename."""
+    tmp_path = path + ".tmp"
+    compression_id = codec.codec_id(compression)
+    header = json.dumps(dict(meta, compression=compression or "none")).encode("utf-8")
+    count = 0
+
+    def write_block(f, block):
+        used, payload = codec.compress(bytes(block), compression_id)
+        f.write(BLOCK_HEADER.pack(len(payload), used) + payload)
+
+    try:
+        with open(tmp_path, "wb", buffering=1024 * 1024) as f:
+            f.write(MAGIC + HEADER_LEN.pack(len(header)) + header)
+            block = bytearray()
+            for key, value, expires_at in entries:
+                if expires_at is not None:
+                    block += encode_record("PUTEX", key, (value, expires_at))
+                else:
+                    block += encode_record("PUT", key, value)
+                count += 1
+                if len(block) >= BLOCK_BYTES:
+                    write_block(f, block)
+                    block = bytearray()
+            if block:
+                write_block(f, block)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return count
+
+
+def _read_header(f, path):
+    magic = f.read(len(MAGIC))
+    if magic not in (MAGIC, MAGIC_V6):
+        raise ValueError(f"{path} is not a snapshot file")
+    (length,) = HEADER_LEN.unpack(f.read(HEADER_LEN.size))
+    return magic, json.loads(f.read(length)), len(MAGIC) + HEADER_LEN.size + length
+
+
+def read_snapshot_meta(path):
+    with open(path, "rb") as f:
+        _, meta, offset = _read_header(f, path)
+    return meta, offset
+
+
+def read_snapshot(path):
+    """Return (meta, iterator of (key, value)) for a snapshot written by write_snapshot; expired keys are skipped."""
+    meta, entries = read_snapshot_entries(path)
+    now = now_ms()
+    return meta, ((key, value) for key, value, expires_at in entries if not expired(expires_at, now))
+
+
+def read_snapshot_entries(path):
+    """Return (meta, iterator of (key, value, deadline or None)), keeping every key's deadline."""
+    with open(path, "rb") as f:
+        magic, meta, offset = _read_header(f, path)
+
+    def entries():
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= offset:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if magic == MAGIC_V6:
+                    for _, key, value, _ in decode_records(mm, offset):
+                        yield key, value, None
+                    return
+                pos = offset
+                while pos + BLOCK_HEADER.size <= size:
+                    length, used = BLOCK_HEADER.unpack_from(mm, pos)
+                    pos += BLOCK_HEADER.size
+                    block = codec.decompress(used, mm[pos:pos + length])
+                    pos += length
+                    for operation, key, value, _ in decode_records(block):
+                        if operation == "PUTEX":
+                            yield key, *value
+                        else:
+                            yield key, value, None
+
+    return meta, entries()
@@ -1,35 +1,437 @@
+import mmap
 import os
-import json
+import struct
 import uuid
+from bisect import bisect_left, bisect_right
+
+from . import codec
+from .bloom import BloomFilter
+from .ttl import expired, now_ms
+
+# File layout:
+#   [data block]* [bloom filter] [index block] [key range] [footer]
+# Data blocks hold sorted entries. Each entry stores only the part of its key
+# that differs from the previous key in the block (ENTRY header + unshared key
+# bytes + value bytes); the first entry of a block stores its whole key. A
+# block is written as u8 codec + payload, the payload compressed with that
+# codec (store.codec) when that pays off. An entry written with a TTL has
+# FLAG_EXPIRES set and its value bytes start with the u64 deadline (store.ttl).
+# The index block maps the first key of every data block to its offset/length
+# (as stored), so a point lookup costs at most one block read.
+# The key range holds the table's first and last key. The footer records where
+# everything is, the table's LSM level and sequence number (the newest flush it
+# contains) so table order can be rebuilt from the files, the codec the table
+# was written with, and the earliest deadline in the table with the number of
+# entries that have one, which the compactor uses to find expired keys.
+#
+# Tables are read through a read-only memory map: opening one reads only the
+# footer and key range, the bloom filter is probed in place, the index is
+# parsed on first use, and uncompressed blocks are decoded straight from the
+# mapped pages, which the OS caches and shares between processes.
+# Tables in the previous formats (KVSST006: key range and deadlines in the
+# index; KVSST005: whole keys, no compression) are still read.
+MAGIC = b"KVSST007"
+MAGIC_V6 = b"KVSST006"
+MAGIC_V5 = b"KVSST005"
+BLOCK_SIZE = 4096
+ENTRY = struct.Struct("<HIIB")         # shared key prefix length, unshared key length, value length, flags
+ENTRY_V5 = struct.Struct("<IIB")       # key length, value length, flags
+INDEX_ENTRY = struct.Struct("<QII")    # block offset, block length, first key length
+# index offset/length, bloom offset/length, entry count, level, seq, codec, earliest deadline (0: none),
+# entries with a deadline, key range length, magic
+FOOTER = struct.Struct("<QQQQQIQBQQI8s")
+FOOTER_V6 = struct.Struct("<QQQQQIQB8s")
+FOOTER_V5 = struct.Struct("<QQQQQIQ8s")
+KEY_LEN = struct.Struct("<I")
+EXPIRY_V6 = struct.Struct("<QQ")       # optional end of a KVSST006 index: earliest deadline, entries with one
+EXPIRES = struct.Struct("<Q")
+MAX_SHARED = 0xFFFF
+FLAG_TOMBSTONE = 0x01
+FLAG_EXPIRES = 0x02
+
+
+def _to_str(data):
+    # Decodes bytes and memoryview slices of the map alike, without an intermediate copy
+    return str(data, "utf-8", "surrogateescape")
+
+
+class SSTableWriter:
+    """
+    Streams sorted (key, value) pairs into a new SSTable file; value None is a
+    tombstone. ``add`` takes the key's deadline (store.ttl) if it has one.
+    """
+
+    def __init__(self, filename, expected_entries=1024, block_size=BLOCK_SIZE, level=0, seq=0, rate_limiter=None,
+                 compression="none"):
+        self.filename = filename
+        self.codec = codec.codec_id(compression)
+        self.tmp_filename = filename + ".tmp"
+        self.block_size = block_size
+        self.level = level
+        self.seq = seq
+        self.rate_limiter = rate_limiter
+        self.file = open(self.tmp_filename, "wb")
+        self.bloom = BloomFilter.for_capacity(expected_entries)
+        self.index = []
+        self.block = bytearray()
+        self.block_first_key = None
+        self.block_last_key = b""
+        self.offset = 0
+        self.count = 0
+        self.first_key = None
+        self.last_key = None
+        self.raw_bytes = 0  # block bytes before compression
+        self.min_expires_at = None
+        self.expiring = 0
+
+    def add(self, key, value, expires_at=None):
+        if self.last_key is not None and key <= self.last_key:
+            raise ValueError(f"SSTable keys must be added in strictly increasing order ({key!r} after {self.last_key!r})")
+        key_bytes = key.encode("utf-8", "surrogateescape")
+        if value is None:
+            flags, value_bytes = FLAG_TOMBSTONE, b""
+        else:
+            flags, value_bytes = 0, value.encode("utf-8", "surrogateescape")
+            if expires_at is not None:
+                flags, value_bytes = FLAG_EXPIRES, EXPIRES.pack(expires_at) + value_bytes
+                self.expiring += 1
+                if self.min_expires_at is None or expires_at < self.min_expires_at:
+                    self.min_expires_at = expires_at
+        if self.block_first_key is None:
+            self.block_first_key = key_bytes
+            shared = 0
+        else:
+            shared = _shared_prefix(self.block_last_key, key_bytes)
+        self.block += ENTRY.pack(shared, len(key_bytes) - shared, len(value_bytes), flags)
+        self.block += key_bytes[shared:]
+        self.block += value_bytes
+        self.block_last_key = key_bytes
+        self.bloom.add(key_bytes)
+        self.count += 1
+        if self.first_key is None:
+            self.first_key = key
+        self.last_key = key
+        if len(self.block) >= self.block_size:
+            self._finish_block()
+
+    def _finish_block(self):
+        if not self.block:
+            return
+        used, payload = codec.compress(bytes(self.block), self.codec)
+        stored = bytes([used]) + payload
+        if self.rate_limiter is not None:
+            self.rate_limiter.consume(len(stored))
+        self.file.write(stored)
+        self.index.append((self.block_first_key, self.offset, len(stored)))
+        self.offset += len(stored)
+        self.raw_bytes += len(self.block)
+        self.block = bytearray()
+        self.block_first_key = None
+        self.block_last_key = b""
+
+    def finish(self):
+        self._finish_block()
+        bloom_bytes = self.bloom.to_bytes()
+        bloom_offset = self.offset
+        self.file.write(bloom_bytes)
+
+        index = bytearray(struct.pack("<I", len(self.index)))
+        for first_key, offset, length in self.index:
+            index += INDEX_ENTRY.pack(offset, length, len(first_key))
+            index += first_key
+        index_offset = bloom_offset + len(bloom_bytes)
+        self.file.write(index)
+        key_range = bytearray()
+        for key in (self.first_key, self.last_key):
+            key_bytes = (key or "").encode("utf-8", "surrogateescape")
+            key_range += KEY_LEN.pack(len(key_bytes)) + key_bytes
+        self.file.write(key_range)
+        self.file.write(FOOTER.pack(index_offset, len(index), bloom_offset, len(bloom_bytes), self.count,
+                                    self.level, self.seq, self.codec, self.min_expires_at or 0, self.expiring,
+                                    len(key_range), MAGIC))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.tmp_filename, self.filename)
+        return self.filename
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.tmp_filename):
+            os.remove(self.tmp_filename)
+
+
+def _shared_prefix(a, b):
+    n = min(len(a), len(b), MAX_SHARED)
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def _decode_block(block):
+    """Yield (key, value, deadline or None) for every entry of a decompressed block."""
+    offset, size, key_bytes = 0, len(block), b""
+    while offset < size:
+        shared, unshared, value_len, flags = ENTRY.unpack_from(block, offset)
+        offset += ENTRY.size
+        key_bytes = key_bytes[:shared] + block[offset:offset + unshared]
+        offset += unshared
+        key = _to_str(key_bytes)
+        expires_at = None
+        if flags & FLAG_TOMBSTONE:
+            value = None
+        elif flags & FLAG_EXPIRES:
+            (expires_at,) = EXPIRES.unpack_from(block, offset)
+            value = _to_str(block[offset + EXPIRES.size:offset + value_len])
+        else:
+            value = _to_str(block[offset:offset + value_len])
+        offset += value_len
+        yield key, value, expires_at
+
+
+def _search_block(block, key_bytes):
+    """
+    Find one key in a decompressed block without decoding the others: keys are
+    rebuilt and compared as bytes, and only the match's value is decoded.
+    Returns (found, value, deadline or None).
+    """
+    offset, size, current = 0, len(block), b""
+    while offset < size:
+        shared, unshared, value_len, flags = ENTRY.unpack_from(block, offset)
+        offset += ENTRY.size
+        current = current[:shared] + block[offset:offset + unshared]
+        offset += unshared
+        if current == key_bytes:
+            if flags & FLAG_TOMBSTONE:
+                return True, None, None
+            if flags & FLAG_EXPIRES:
+                (expires_at,) = EXPIRES.unpack_from(block, offset)
+                return True, _to_str(block[offset + EXPIRES.size:offset + value_len]), expires_at
+            return True, _to_str(block[offset:offset + value_len]), None
+        if current > key_bytes:
+            break
+        offset += value_len
+    return False, None, None
+
+
+def _decode_block_v5(block):
+    offset, size = 0, len(block)
+    while offset < size:
+        key_len, value_len, flags = ENTRY_V5.unpack_from(block, offset)
+        offset += ENTRY_V5.size
+        key = _to_str(block[offset:offset + key_len])
+        offset += key_len
+        value = None if flags & FLAG_TOMBSTONE else _to_str(block[offset:offset + value_len])
+        offset += value_len
+        yield key, value, None
+
 
 class SSTable:
-    def __init__(self, data=None, filename=None):
+    def __init__(self, data=None, filename=None, block_cache=None):
+        # block_cache (store.cache.Cache) holds decoded blocks keyed by (filename, block
+        # number); file names are never reused, so a removed table's blocks just age out.
+        # Without one, lookups search the mapped block in place and rely on the OS page cache.
+        self.block_cache = block_cache
         if filename:
             self.filename = filename
         else:
             self.filename = f"sstable_{uuid.uuid4().hex}.db"
-            if data:
-                with open(self.filename, "w") as f:
-                    json.dump(data, f)
+            SSTable.write(self.filename, sorted((data or {}).items()), len(data or {}))
+        self._open()
+
+    @staticmethod
+    def write(filename, items, expected_entries=1024, **options):
+        """Write sorted (key, value) or (key, value, deadline) items to a new table."""
+        writer = SSTableWriter(filename, expected_entries, **options)
+        try:
+            for item in items:
+                writer.add(*item)
+        except BaseException:
+            writer.abort()
+            raise
+        return writer.finish()
+
+    def _open(self):
+        self.map = None
+        with open(self.filename, "rb") as f:
+            self.file_size = os.fstat(f.fileno()).st_size
+            if self.file_size >= len(MAGIC):
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic = self.map[-len(MAGIC):] if self.map is not None else b""
+        self.view = memoryview(self.map) if self.map is not None else None
+        self._bloom = self._index = None
+        if magic == MAGIC:
+            (self._index_offset, self._index_length, self._bloom_offset, self._bloom_length, self.count,
+             self.level, self.seq, self.codec, min_expires_at, self.expiring, range_length, _) = FOOTER.unpack_from(
+                self.map, self.file_size - FOOTER.size)
+            self.min_expires_at = min_expires_at or None
+            self.version, self._decode = 7, _decode_block
+            pos = self.file_size - FOOTER.size - range_length
+            keys = []
+            for _ in range(2):
+                (key_len,) = KEY_LEN.unpack_from(self.map, pos)
+                keys.append(_to_str(self.map[pos + KEY_LEN.size:pos + KEY_LEN.size + key_len]))
+                pos += KEY_LEN.size + key_len
+            self.first_key, self.last_key = keys if self.count else (None, None)
+        elif magic in (MAGIC_V6, MAGIC_V5):
+            footer = FOOTER_V6 if magic == MAGIC_V6 else FOOTER_V5
+            fields = footer.unpack_from(self.map, self.file_size - footer.size)
+            (self._index_offset, self._index_length, self._bloom_offset, self._bloom_length, self.count,
+             self.level, self.seq) = fields[:7]
+            if magic == MAGIC_V6:
+                self.version, self.codec, self._decode = 6, fields[7], _decode_block
+            else:
+                self.version, self.codec, self._decode = 5, codec.NONE, _decode_block_v5
+            # The key range and deadlines live in the index: load it now
+            self._load_index()
+        else:
+            self.close()
+            raise ValueError(f"{self.filename} is not an SSTable (bad magic {magic!r})")
+
+    @property
+    def bloom(self):
+        if self._bloom is None:
+            # Probed in place: the bits stay in the mapped file, not on the heap
+            self._bloom = BloomFilter.from_bytes(
+                self.view[self._bloom_offset:self._bloom_offset + self._bloom_length], copy=False)
+        return self._bloom
+
+    @property
+    def first_keys(self):
+        return (self._index or self._load_index())[0]
+
+    @property
+    def blocks(self):
+        return (self._index or self._load_index())[1]
+
+    def _load_index(self):
+        # Built aside and published at once, so concurrent first users at worst parse it twice
+        index = self.map[self._index_offset:self._index_offset + self._index_length]
+        (num_blocks,) = struct.unpack_from("<I", index)
+        pos = 4
+        first_keys, blocks = [], []
+        for _ in range(num_blocks):
+            offset, length, key_len = INDEX_ENTRY.unpack_from(index, pos)
+            pos += INDEX_ENTRY.size
+            first_keys.append(_to_str(index[pos:pos + key_len]))
+            blocks.append((offset, length))
+            pos += key_len
+        if self.version == 6:
+            (key_len,) = struct.unpack_from("<I", index, pos)
+            self.last_key = _to_str(index[pos + 4:pos + 4 + key_len]) if num_blocks else None
+            self.first_key = first_keys[0] if num_blocks else None
+            pos += 4 + key_len
+            self.min_expires_at, self.expiring = None, 0
+            if pos + EXPIRY_V6.size <= len(index):  # absent in tables written before expiry existed
+                min_expires_at, self.expiring = EXPIRY_V6.unpack_from(index, pos)
+                self.min_expires_at = min_expires_at or None
+        elif self.version == 5:
+            (key_len,) = struct.unpack_from("<I", index, pos)
+            self.last_key = _to_str(index[pos + 4:pos + 4 + key_len]) if num_blocks else None
+            self.first_key = first_keys[0] if num_blocks else None
+            self.min_expires_at, self.expiring = None, 0
+        self._index = (first_keys, blocks)
+        return self._index
+
+    def _read_block(self, i):
+        """The decompressed block i; an uncompressed block is a zero-copy view of the map."""
+        offset, length = self.blocks[i]
+        stored = self.view[offset:offset + length]
+        if self.version == 5:
+            return stored
+        return codec.decompress(stored[0], stored[1:])
+
+    def _block_entries(self, i):
+        """
+        Return (keys, values, deadlines) of block i, decoded once and then served
+        from the block cache. deadlines is None when no entry in the block has one.
+        """
+        cache_key = (self.filename, i)
+        if self.block_cache is not None:
+            entries = self.block_cache.get(cache_key)
+            if entries is not None:
+                return entries
+        block = self._read_block(i)
+        keys, values, deadlines = [], [], []
+        for k, v, expires_at in self._decode(block):
+            keys.append(k)
+            values.append(v)
+            deadlines.append(expires_at)
+        entries = (keys, values, deadlines if any(d is not None for d in deadlines) else None)
+        if self.block_cache is not None:
+            self.block_cache.put(cache_key, entries, len(block) + 64 * len(keys))
+        return entries
+
+    def lookup(self, key):
+        """Return (found, value); value is None when the key's newest entry here is a tombstone or has expired."""
+        return self.lookup_entry(key)[:2]
+
+    def lookup_entry(self, key):
+        """Like lookup, returning (found, value, deadline or None)."""
+        if not self.count or key < self.first_key or key > self.last_key:
+            return False, None, None
+        key_bytes = key.encode("utf-8", "surrogateescape")
+        if not self.bloom.might_contain(key_bytes):
+            return False, None, None
+        i = bisect_right(self.first_keys, key) - 1
+        if i < 0:
+            return False, None, None
+        if self.block_cache is None and self.version > 5:
+            found, value, expires_at = _search_block(self._read_block(i), key_bytes)
+        else:
+            keys, values, deadlines = self._block_entries(i)
+            j = bisect_left(keys, key)
+            found = j < len(keys) and keys[j] == key
+            value = values[j] if found else None
+            expires_at = deadlines[j] if found and deadlines is not None else None
+        if not found:
+            return False, None, None
+        if expired(expires_at, now_ms()):
+            return True, None, None
+        return True, value, expires_at
 
     def get(self, key):
-        with open(self.filename, "r") as f:
-            data = json.load(f)
-            return data.get(key)
+        return self.lookup(key)[1]
+
+    def entries(self, start=None, end=None):
+        """Yield (key, value, deadline or None) in key order from start to end inclusive, tombstones included."""
+        # Bypasses the block cache: scans and compactions would only flush out hot blocks
+        first_keys = self.first_keys
+        i = 0 if start is None else max(0, bisect_right(first_keys, start) - 1)
+        for block_no in range(i, len(first_keys)):
+            if end is not None and first_keys[block_no] > end:
+                return
+            for entry in self._decode(self._read_block(block_no)):
+                if start is not None and entry[0] < start:
+                    continue
+                if end is not None and entry[0] > end:
+                    return
+                yield entry
+
+    def items(self, start=None, end=None):
+        """Yield (key, value) in key order from start to end inclusive; tombstones and expired keys have None."""
+        now = now_ms()
+        for key, value, expires_at in self.entries(start, end):
+            yield key, None if expired(expires_at, now) else value
 
     def range_query(self, start, end):
-        with open(self.filename, "r") as f:
-            data = json.load(f)
-            return {k: v for k, v in data.items() if start <= k <= end}
+        return {k: v for k, v in self.items(start, end) if v is not None}
 
-    @staticmethod
-    def compact(sstables):
-        merged_data = {}
-        for sstable in sstables:
-            with open(sstable.filename, "r") as f:
-                data = json.load(f)
-                merged_data.update({k: v for k, v in data.items() if v is not None})
-        new_sstable = SSTable(merged_data)
-        for sstable in sstables:
-            os.remove(sstable.filename)
-        return new_sstable
+    def close(self):
+        if getattr(self, "map", None) is not None:
+            self._bloom = None  # a view of the map
+            self.view.release()
+            try:
+                self.map.close()
+            except BufferError:
+                pass  # a reader still holds a block view; the mapping goes with it
+            self.map = self.view = None
+
+    def __del__(self):
+        self.close()
+
+    def remove(self):
+        # Only unlink: readers that still hold this table keep reading through the mapping,
+        # which is closed once the last reference goes away.
+        os.remove(self.filename)
@@ -0,0 +1,59 @@
+"""
+Per-key expiry. A key written with a TTL carries an absolute deadline in epoch
+milliseconds, fixed once when the write is accepted (by the leader, so every
+replica stores the same deadline). Reads treat a key past its deadline as
+deleted; compactions rewrite it as a tombstone, or drop it where no older
+table can hold the key.
+"""
+import heapq
+import threading
+import time
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def deadline(seconds, now=None):
+    """Absolute deadline for a TTL of ``seconds`` (a positive integer)."""
+    seconds = int(seconds)
+    if seconds <= 0:
+        raise ValueError("expiry must be a positive number of seconds")
+    return (now_ms() if now is None else now) + seconds * 1000
+
+
+def expired(expires_at, now):
+    return expires_at is not None and expires_at <= now
+
+
+class ExpiryIndex:
+    """
+    Min-heap of SSTables by the earliest deadline among their entries, so the
+    compactor finds the tables worth rewriting without looking at the others.
+    Tables are indexed by file name as they are opened; names of tables that
+    have since been compacted away are dropped lazily.
+    """
+
+    def __init__(self):
+        self.heap = []  # (earliest deadline, filename)
+        self._lock = threading.Lock()
+
+    def add(self, table):
+        if table.min_expires_at is not None:
+            with self._lock:
+                heapq.heappush(self.heap, (table.min_expires_at, table.filename))
+
+    def due(self, now, live):
+        """Pop the live table (from {filename: table}) whose earliest deadline is oldest and not after ``now``."""
+        with self._lock:
+            if len(self.heap) > 2 * len(live) + 16:
+                self.heap = [item for item in self.heap if item[1] in live]
+                heapq.heapify(self.heap)
+            while self.heap and self.heap[0][0] <= now:
+                _, filename = heapq.heappop(self.heap)
+                if filename in live:
+                    return live[filename]
+        return None
+
+    def __len__(self):
+        return len(self.heap)
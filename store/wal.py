@@ -1,37 +1,319 @@
 import os
+import glob
 import json
+import mmap
+import struct
+import threading
+import time
+import zlib
+
+from . import codec
+from .metrics import histograms
+
+FSYNC_POLICIES = ("always", "interval", "os")
+
+# Binary record layout:
+#   header: u32 body length | u32 crc32(body)
+#   body:   u8 op | u8 flags | u32 key length | key bytes | value bytes
+# A BATCH record's value is a run of complete PUT/DELETE records; the outer CRC
+# makes the whole batch replay together or not at all. Bits 2-3 of flags hold
+# the codec (store.codec) the value bytes are compressed with, if any. A PUTEX
+# record is a PUT with a TTL: its value bytes start with the u64 deadline
+# (store.ttl), and it is read back as ("PUTEX", key, (value, deadline)).
+MAGIC = b"KVWAL002"
+RECORD_HEADER = struct.Struct("<II")
+RECORD_BODY = struct.Struct("<BBI")
+OP_CODES = {"PUT": 1, "DELETE": 2, "STATE": 3, "BATCH": 4, "PUTEX": 5}
+OP_NAMES = {code: op for op, code in OP_CODES.items()}
+FLAG_KEY = 0x01
+FLAG_VALUE = 0x02
+CODEC_SHIFT = 2
+CODEC_MASK = 0x0C
+EXPIRES = struct.Struct("<Q")
+
+
+def _to_bytes(item):
+    if isinstance(item, (bytes, bytearray, memoryview)):
+        return bytes(item)
+    return str(item).encode("utf-8", "surrogateescape")
+
+
+def encode_record(operation, key=None, value=None, compression=codec.NONE):
+    flags = 0
+    key_bytes = value_bytes = b""
+    if key is not None:
+        flags |= FLAG_KEY
+        key_bytes = _to_bytes(key)
+    if value is not None:
+        flags |= FLAG_VALUE
+        if operation == "PUTEX":
+            value, expires_at = value
+            value_bytes = EXPIRES.pack(expires_at) + _to_bytes(value)
+        else:
+            value_bytes = _to_bytes(value)
+        used, value_bytes = codec.compress(value_bytes, compression)
+        flags |= used << CODEC_SHIFT
+    return _frame(RECORD_BODY.pack(OP_CODES[operation], flags, len(key_bytes)) + key_bytes + value_bytes)
+
+
+def encode_batch(operations, compression=codec.NONE):
+    """Encode (operation, key, value) PUT/PUTEX/DELETE triples as a single BATCH record."""
+    records = b"".join(encode_record(operation, key, value) for operation, key, value in operations)
+    used, payload = codec.compress(records, compression)
+    return _frame(RECORD_BODY.pack(OP_CODES["BATCH"], FLAG_VALUE | used << CODEC_SHIFT, 0) + payload)
+
+
+def _frame(body):
+    return RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def decode_records(buf, offset=0):
+    """
+    Yield (operation, key, value, end_offset) from a buffer of binary records.
+    For a BATCH record the value is the list of (operation, key, value) it holds.
+    Stops at the first truncated or corrupt record; the caller can compare the
+    last end_offset with len(buf) to detect a torn tail.
+    """
+    size = len(buf)
+    while offset + RECORD_HEADER.size <= size:
+        length, crc = RECORD_HEADER.unpack_from(buf, offset)
+        start = offset + RECORD_HEADER.size
+        end = start + length
+        if length < RECORD_BODY.size or end > size:
+            return
+        body = buf[start:end]
+        if zlib.crc32(body) != crc:
+            return
+        code, flags, key_len = RECORD_BODY.unpack_from(body)
+        operation = OP_NAMES.get(code)
+        if operation is None or RECORD_BODY.size + key_len > length:
+            return
+        key_end = RECORD_BODY.size + key_len
+        key = body[RECORD_BODY.size:key_end].decode("utf-8", "surrogateescape") if flags & FLAG_KEY else None
+        payload = body[key_end:]
+        if flags & CODEC_MASK:
+            payload = codec.decompress((flags & CODEC_MASK) >> CODEC_SHIFT, payload)
+        if operation == "BATCH":
+            value = [(op, k, v) for op, k, v, _ in decode_records(payload)]
+        elif operation == "PUTEX":
+            value = (payload[EXPIRES.size:].decode("utf-8", "surrogateescape"), EXPIRES.unpack_from(payload)[0])
+        else:
+            value = payload.decode("utf-8", "surrogateescape") if flags & FLAG_VALUE else None
+        yield operation, key, value, end
+        offset = end
+
 
 class WriteAheadLog:
-    def __init__(self, filename="wal.log", snapshot_file="snapshot.json"):
-        self.filename = filename
-        self.snapshot_file = snapshot_file
-        if not os.path.exists(self.filename):
-            with open(self.filename, "w") as f:
-                f.write("")
-        if not os.path.exists(self.snapshot_file):
-            with open(self.snapshot_file, "w") as f:
-                json.dump({}, f)
+    """
+    Append-only log with group commit.
+
+    A single long-lived handle is kept open and a background flusher drains
+    concurrent appends into one write (+ fsync) per batch. ``append`` blocks
+    until the record's batch is durable according to ``fsync_policy``:
+
+    - "always":   write + fsync as soon as a batch is pending
+    - "interval": collect appends for ``fsync_interval_ms``, then write + fsync
+    - "os":       write to the OS page cache only, never fsync
+
+    ``rotate`` seals the active file as a numbered segment (``wal.log.000001``)
+    so segments covered by flushed SSTables can be dropped with
+    ``truncate_before``.
+
+    A failed write or fsync stops the log for good: every record not yet durable
+    fails its waiter and nothing more is written or accepted (IOError), so no
+    acknowledged record can end up behind a torn one. A restart replays what
+    made it to disk.
+    """
+
+    def __init__(self, filename="wal.log", snapshot_file="snapshot.json",
+                 fsync_policy="always", fsync_interval_ms=10, compression="none"):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy {fsync_policy!r}, expected one of {FSYNC_POLICIES}")
+        self.codec = codec.codec_id(compression)
+        self.filename = os.path.abspath(filename)
+        self.snapshot_file = os.path.abspath(snapshot_file)
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval_ms / 1000.0
+        self.legacy_file = self.filename + ".legacy"
+        self.last_state = None
+        segments = self._segments()
+        self.next_segment = segments[-1][0] + 1 if segments else 1
+        if os.path.exists(self.filename) and os.path.getsize(self.filename) > 0:
+            with open(self.filename, "rb") as f:
+                is_binary = f.read(len(MAGIC)) == MAGIC
+            if not is_binary:
+                # Pre-binary text log: keep it aside for replay, start a fresh binary log
+                os.replace(self.filename, self.legacy_file)
+        self.file = open(self.filename, "ab")
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+            self.file.flush()
+        self.active_bytes = self.file.tell()  # size of the active file, including queued records
+
+        self.stats = {"appends": 0, "batches": 0, "fsyncs": 0, "bytes": 0, "fsync_seconds": 0.0}
+        self.latency = histograms("write", "fsync")
+        self._cond = threading.Condition()
+        self._io_lock = threading.Lock()
+        self._pending = []
+        self._appended_seq = 0
+        self._durable_seq = 0
+        self._error = None
+        self._closed = False
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
 
     def append(self, operation, key=None, value=None):
-        with open(self.filename, "a") as f:
-            if value is not None:
-                f.write(f"{operation},{key},{value}\n")
-            elif key is not None:
-                f.write(f"{operation},{key}\n")
-            else:
-                f.write(f"{operation}\n")
+        self.wait(self.enqueue(operation, key, value))
 
     def append_state(self, term, voted_for):
-        with open(self.filename, "a") as f:
-            f.write(f"STATE,{term},{voted_for if voted_for else 'None'}\n")
+        self.last_state = (term, voted_for)
+        self.wait(self._enqueue(encode_record("STATE", term, voted_for)))
 
-    def replay(self):
-        if os.path.exists(self.snapshot_file):
+    def enqueue(self, operation, key=None, value=None):
+        """Queue a record for the next group commit and return its sequence number for wait()."""
+        return self._enqueue(encode_record(operation, key, value, self.codec))
+
+    def enqueue_batch(self, operations):
+        """Queue several PUT/PUTEX/DELETE operations as one atomic record; returns its sequence number."""
+        return self._enqueue(encode_batch(operations, self.codec))
+
+    def _enqueue(self, record):
+        with self._cond:
+            if self._closed:
+                raise ValueError("WAL is closed")
+            self.check()
+            self._pending.append(record)
+            self.active_bytes += len(record)
+            self._appended_seq += 1
+            self._cond.notify_all()
+            return self._appended_seq
+
+    def wait(self, seq):
+        with self._cond:
+            self._wait_durable(seq)
+
+    def _wait_durable(self, seq):
+        # Caller holds self._cond
+        while self._durable_seq < seq and self._error is None:
+            self._cond.wait()
+        if self._durable_seq < seq:
+            self.check()
+
+    def check(self):
+        """Raise IOError if a failed write or fsync has stopped the log."""
+        if self._error is not None:
+            raise IOError(f"WAL write failed: {self._error}")
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+            if self.fsync_policy == "interval":
+                time.sleep(self.fsync_interval)
+            self._flush_pending()
+
+    def _flush_pending(self):
+        with self._io_lock:
+            self._write_pending()
+
+    def _write_pending(self):
+        # Caller holds self._io_lock
+        with self._cond:
+            batch, self._pending = self._pending, []
+            seq = self._appended_seq
+            if self._error is not None:
+                return  # stopped: the batch's waiters have already failed
+        if not batch:
+            return
+        try:
+            data = b"".join(batch)
+            start = time.perf_counter()
+            self.file.write(data)
+            self.file.flush()
+            self.latency["write"].observe(time.perf_counter() - start)
+            if self.fsync_policy != "os":
+                start = time.perf_counter()
+                os.fsync(self.file.fileno())
+                elapsed = time.perf_counter() - start
+                self.latency["fsync"].observe(elapsed)
+                self.stats["fsync_seconds"] += elapsed
+                self.stats["fsyncs"] += 1
+            self.stats["appends"] += len(batch)
+            self.stats["batches"] += 1
+            self.stats["bytes"] += len(data)
+        except Exception as e:
+            with self._cond:
+                self._error = e
+                self._cond.notify_all()
+            return
+        with self._cond:
+            self._durable_seq = seq
+            self._cond.notify_all()
+
+    def sync(self):
+        """Block until everything appended so far is durable."""
+        self._flush_pending()
+        with self._cond:
+            self._wait_durable(self._appended_seq)
+
+    def replay(self, after_segment=0):
+        """
+        Yield the logged operations oldest first. Sealed segments up to and including
+        ``after_segment`` (a checkpoint: their records are already in SSTables) are
+        skipped, along with the pre-segment history, which the first flush covers.
+        """
+        # snapshot.json is only written by pre-LSM versions; it is replayed once and then
+        # dropped by truncate_before() after the first flush.
+        if not after_segment and os.path.exists(self.snapshot_file):
             with open(self.snapshot_file, "r") as f:
                 snapshot = json.load(f)
                 yield "SNAPSHOT", snapshot, None
 
-        with open(self.filename, "r") as f:
+        if not after_segment and os.path.exists(self.legacy_file):
+            for record in self._replay_legacy(self.legacy_file):
+                yield self._track_state(*record)
+
+        for number, segment_file in self._segments():
+            if number > after_segment:
+                yield from self._replay_file(segment_file)
+        yield from self._replay_file(self.filename, truncate_torn_tail=True)
+
+    def _replay_file(self, filename, truncate_torn_tail=False):
+        with open(filename, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= len(MAGIC):
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                valid_end = len(MAGIC)
+                for operation, key, value, valid_end in decode_records(mm, len(MAGIC)):
+                    if operation == "BATCH":
+                        yield from value
+                    else:
+                        yield self._track_state(*self._decode_state(operation, key, value))
+        if valid_end < size:
+            print(f"[WAL] Discarding {size - valid_end} bytes of torn tail in {filename}")
+            if truncate_torn_tail:
+                # Drop it so new appends are not hidden behind it
+                with self._io_lock:
+                    os.truncate(filename, valid_end)
+
+    def _track_state(self, operation, key, value):
+        if operation == "STATE":
+            self.last_state = (key, value)
+        return operation, key, value
+
+    @staticmethod
+    def _decode_state(operation, key, value):
+        if operation == "STATE":
+            return "STATE", int(key), None if value in (None, "None") else int(value)
+        return operation, key, value
+
+    @staticmethod
+    def _replay_legacy(filename):
+        with open(filename, "r") as f:
             for line in f:
                 parts = line.strip().split(",")
                 if not parts or len(parts) < 1:
@@ -43,17 +325,61 @@ class WriteAheadLog:
                 elif len(parts) == 2:
                     yield parts[0], parts[1], None
 
-    def create_snapshot(self, data, term, voted_for):
-        # Write snapshot
-        with open(self.snapshot_file, "w") as f:
-            json.dump(data, f)
+    def clear(self):
+        with self._io_lock:
+            self._reopen()
 
-        # Reset WAL but keep state
-        with open(self.filename, "w") as f:
-            f.write(f"STATE,{term},{voted_for if voted_for else 'None'}\n")
+    def _segments(self):
+        segments = []
+        for path in glob.glob(glob.escape(self.filename) + ".*"):
+            suffix = path.rsplit(".", 1)[1]
+            if suffix.isdigit():
+                segments.append((int(suffix), path))
+        return sorted(segments)
 
-    def clear(self):
+    def rotate(self):
+        """Seal the active log as a numbered segment and start a new one; returns the segment number."""
+        with self._io_lock:
+            self._write_pending()
+            self.check()
+            self.file.close()
+            segment = self.next_segment
+            self.next_segment += 1
+            os.replace(self.filename, f"{self.filename}.{segment:06d}")
+            self.file = open(self.filename, "ab")
+            self.file.write(MAGIC)
+            if self.last_state is not None:
+                # Term/vote must survive the older segments being dropped
+                self.file.write(encode_record("STATE", *self.last_state))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.active_bytes = self.file.tell()
+        return segment
+
+    def truncate_before(self, segment):
+        """Drop sealed segments up to and including ``segment`` plus any pre-segment history."""
+        with self._io_lock:
+            for number, path in self._segments():
+                if number <= segment:
+                    os.remove(path)
+            for path in (self.legacy_file, self.snapshot_file):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _reopen(self):
+        # Caller holds self._io_lock. Records still queued land in the new file.
         self.file.close()
-        open(self.filename, "w").close()
-        self.file = open(self.filename, "a+", buffering=1)
+        with open(self.filename, "wb") as f:
+            f.write(MAGIC)
+        self.file = open(self.filename, "ab")
+        self.active_bytes = len(MAGIC)
+        if os.path.exists(self.legacy_file):
+            os.remove(self.legacy_file)
 
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._flusher.join()
+        with self._io_lock:
+            self.file.close()
@@ -0,0 +1,65 @@
+import asyncio
+import threading
+
+import pytest
+
+from server import start_server
+from store.kv import KeyValueStore
+from store.raft import entry_operations
+
+
+@pytest.fixture(autouse=True)
+def isolated_cwd(tmp_path, monkeypatch):
+    # The store writes wal.log / snapshot / sstable files relative to the cwd
+    monkeypatch.chdir(tmp_path)
+
+
+class LocalRaft:
+    """
+    Single-node stand-in for RaftNode: leader (or follower of ``leader``), nothing
+    to replicate to. Entries are applied to ``kvstore`` once it is set.
+    """
+
+    def __init__(self, state="leader", leader=None):
+        self.state = state
+        self.leader = leader
+        self.entries = []
+        self.kvstore = None
+
+    def replicate_log(self, entry):
+        self.entries.append(entry)
+        if self.kvstore is not None:
+            self.kvstore.batch_write(list(entry_operations([entry])))
+
+    def handle_message(self, msg):
+        return "ok"
+
+
+@pytest.fixture
+def local_raft():
+    return LocalRaft()
+
+
+@pytest.fixture
+def kv_server(local_raft):
+    """Run the asyncio server on an event loop thread; yields (port, store)."""
+    store = KeyValueStore()
+    local_raft.kvstore = store
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(start_server(store, local_raft, "127.0.0.1", 0))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield server.sockets[0].getsockname()[1], store
+
+    async def shutdown():
+        server.close()
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run_coroutine_threadsafe(shutdown(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+    store.close()
@@ -0,0 +1,38 @@
+import collections
+import json
+
+from bench import micro
+from bench.workloads import WORKLOADS, Counter, OperationChooser, ZipfianGenerator, key_chooser, make_rng, summarize
+
+
+def test_key_choosers_are_skewed_and_reproducible():
+    zipfian = ZipfianGenerator(1000, make_rng(1))
+    counts = collections.Counter(zipfian.next() for _ in range(20000))
+    assert counts.most_common(1)[0][0] == 0 and counts[0] > 20 * counts.get(500, 1)
+    assert max(counts) < 1000
+    runs = [key_chooser("zipfian", Counter(1000), make_rng(7)) for _ in range(2)]
+    assert [runs[0].next() for _ in range(20)] == [runs[1].next() for _ in range(20)]
+    counter = Counter(100)
+    latest = key_chooser("latest", counter, make_rng(1))
+    counter.next()
+    assert sum(latest.next() >= 90 for _ in range(1000)) > 500 and max(latest.next() for _ in range(1000)) == 100
+    chooser = OperationChooser(WORKLOADS["b"], make_rng(1))
+    ops = collections.Counter(chooser.next() for _ in range(10000))
+    assert 9300 < ops["read"] < 9700 and ops["read"] + ops["update"] == 10000
+
+
+def test_summary_percentiles():
+    summary = summarize([i / 1000 for i in range(1, 1001)], elapsed=2)
+    assert summary["count"] == 1000 and summary["ops_per_sec"] == 500
+    assert (summary["p50_ms"], summary["p99_ms"], summary["p999_ms"]) == (501, 991, 1000)
+    assert summarize([]) == {"count": 0}
+
+
+def test_micro_benchmarks_report_json(tmp_path, capsys):
+    micro.main(["--count", "400", "--lookups", "200", "--tables", "4", "--fsync-policies", "os",
+                "--output", str(tmp_path / "report.json")])
+    report = json.loads((tmp_path / "report.json").read_text())
+    assert json.loads(capsys.readouterr().out) == report
+    assert report["wal"]["replay_os"]["records"] == 800
+    assert report["sstable-get"]["get_hit_block_cache"]["count"] == 200
+    assert report["compaction"]["input_tables"] == 4 and report["compaction"]["output_tables"] == 1
@@ -0,0 +1,71 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from store.cache import Cache
+from store.sstable import SSTable
+
+
+def test_lru_eviction_is_bounded_by_bytes():
+    cache = Cache(400, shards=1)
+    for i in range(4):
+        cache.put(i, f"v{i}", 100)
+    assert cache.get(0) == "v0"  # 0 becomes the most recently used
+    cache.put(4, "v4", 100)
+    assert cache.get(1) is None and cache.get(0) == "v0" and cache.get(4) == "v4"
+    assert cache.bytes == 400 and len(cache) == 4
+    assert cache.stats["evictions"] == 1 and cache.stats["hits"] == 3 and cache.stats["misses"] == 1
+    cache.put("huge", "x", 1000)  # larger than the shard: never cached
+    assert cache.get("huge") is None
+
+
+def test_tinylfu_keeps_the_hot_set_through_a_scan():
+    cache = Cache(1000, shards=1, policy="tinylfu")
+    for _ in range(3):
+        for i in range(10):
+            if cache.get(f"hot{i}") is None:
+                cache.put(f"hot{i}", i, 100)
+    for i in range(100):  # one-off keys, each seen once
+        cache.get(f"scan{i}")
+        cache.put(f"scan{i}", i, 100)
+    assert all(cache.get(f"hot{i}") == i for i in range(10))
+    assert cache.stats["rejections"] >= 100
+
+
+def test_stats_are_exact_under_concurrent_access():
+    cache = Cache(1024 * 1024, shards=8)
+
+    def work(thread):
+        for i in range(2000):
+            key = f"{thread}:{i % 100}"
+            if cache.get(key) is None:
+                cache.put(key, i, 10)
+
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(work, range(8)))
+    stats = cache.stats
+    assert stats["misses"] == stats["inserts"] == 800 and stats["hits"] == 8 * 2000 - 800
+    assert cache.hit_rate() == stats["hits"] / (8 * 2000)
+
+
+def test_invalidation_drops_racing_fills():
+    cache = Cache(1000, shards=1)
+    token = cache.token("k")
+    cache.invalidate("k")  # a write lands while the reader is still reading
+    cache.put("k", "stale", 10, token)
+    assert cache.get("k") is None
+    cache.put("k", "fresh", 10, cache.token("k"))
+    assert cache.get("k") == "fresh"
+
+
+def test_block_cache_serves_repeated_lookups():
+    cache = Cache(1024 * 1024)
+    table = SSTable({f"key{i:05d}": f"value{i}" for i in range(2000)})
+    table = SSTable(filename=table.filename, block_cache=cache)
+    reads = []
+    original = table._read_block
+    table._read_block = lambda i: reads.append(i) or original(i)
+    for _ in range(5):
+        assert table.get("key01500") == "value1500" and table.get("key01501") == "value1501"
+    assert table.get("key01500x") is None
+    assert len(reads) == 1 and cache.stats["hits"] >= 9
+    assert table.range_query("key00000", "key00001") == {"key00000": "value0", "key00001": "value1"}
+    assert len(cache) == 1  # scans do not fill the cache
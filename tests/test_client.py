@@ -0,0 +1,101 @@
+import asyncio
+import socket
+import time
+
+import pytest
+
+from client import AsyncKVClient, Command, KVClient, KVClientError
+from server import start_server
+from store.kv import KeyValueStore
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_client_reuses_connection_and_pipelines(kv_server, binary):
+    port, store = kv_server
+    client = KVClient([port], binary=binary, host="127.0.0.1")
+    assert client.put("a", "1") == "OK"
+    conn = client._conns[port]
+    assert client.read("a") == "1"
+    assert client._conns[port] is conn
+
+    pipe = client.pipeline()
+    for i in range(100):
+        pipe.put(f"k{i:03d}", f"v{i}")
+    pipe.read("k042").delete("a").read("a").range_read("k000", "k001")
+    results = pipe.execute()
+    assert results[:100] == ["OK"] * 100
+    assert results[100:] == ["v42", "OK", "NOT_FOUND", {"k000": "v0", "k001": "v1"}]
+    assert store.read("k099") == "v99"
+    assert client.batch_put([("b1", "x"), ("b2", "y")]) == "OK"
+    assert client.multi_get(["b1", "b2", "missing"]) == {"b1": "x", "b2": "y"}
+    client.close()
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_scan_streams_pages(kv_server, binary):
+    port, store = kv_server
+    client = KVClient([port], binary=binary, host="127.0.0.1")
+    assert client.batch_put([(f"k{i:03d}", str(i)) for i in range(50)]) == "OK"
+    assert client.delete("k010") == "OK"
+    assert list(client.scan("k005", "k020", page_size=4)) == [(f"k{i:03d}", str(i)) for i in range(5, 21) if i != 10]
+    assert list(client.scan("x", "z")) == []
+    page = client._execute(Command.scan("k000", "k049", 3, "k047"))
+    assert page == ([("k047", "47"), ("k048", "48"), ("k049", "49")], None)
+    assert client._execute(Command.scan("k000", "k049", 2)) == ([("k000", "0"), ("k001", "1")], "k002")
+    client.close()
+
+
+def test_client_gives_up_after_bounded_retries():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        dead_port = s.getsockname()[1]
+    client = KVClient([dead_port], host="127.0.0.1", max_retries=3, backoff=0.01)
+    started = time.monotonic()
+    with pytest.raises(KVClientError):
+        client.put("a", "1")
+    assert time.monotonic() - started < 1
+
+
+def test_async_client_follows_redirect(local_raft):
+    class Follower:
+        state, entries = "follower", []
+
+        def replicate_log(self, entry):
+            pass
+
+    async def scenario():
+        leader_store, follower_store = KeyValueStore("leader"), KeyValueStore("follower")
+        local_raft.kvstore = leader_store
+        leader = await start_server(leader_store, local_raft, "127.0.0.1", 0)
+        leader_port = leader.sockets[0].getsockname()[1]
+        Follower.leader = leader_port
+        follower = await start_server(follower_store, Follower(), "127.0.0.1", 0)
+        follower_port = follower.sockets[0].getsockname()[1]
+
+        client = AsyncKVClient([follower_port, leader_port], binary=True, host="127.0.0.1")
+        assert await client.put("x", "1") == "OK"
+        assert client.leader_port == leader_port
+        results = await asyncio.gather(*(client.put(f"k{i}", str(i)) for i in range(50)))
+        assert results == ["OK"] * 50
+        assert await client.range_read("k0", "k1") == {"k0": "0", "k1": "1"}
+        assert [item async for item in client.scan("k0", "k1", page_size=1)] == [("k0", "0"), ("k1", "1")]
+        assert leader_store.read("k49") == "49" and follower_store.read("x") is None
+        await client.close()
+
+        # Pipelined writes sent to the follower (no ROUTES lookup) are bounced and resent to the leader
+        client = AsyncKVClient([follower_port, leader_port], host="127.0.0.1", partitions=1)
+        pipe = client.pipeline()
+        for i in range(20):
+            pipe.put(f"p{i:02d}", str(i))
+        assert await pipe.execute() == ["OK"] * 20 and client.leader_port == leader_port
+        pipe.read("p07").delete("p07").read("p07").range_read("p00", "p01")
+        assert await pipe.execute() == ["7", "OK", "NOT_FOUND", {"p00": "0", "p01": "1"}]
+        assert await pipe.execute() == []
+        await client.close()
+        for server in (leader, follower):
+            server.close()
+            await server.wait_closed()
+        leader_store.close()
+        follower_store.close()
+
+    asyncio.run(scenario())
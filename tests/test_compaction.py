@@ -0,0 +1,84 @@
+import time
+
+from store.compaction import RateLimiter, SizeTieredCompaction, merge_tables
+from store.kv import KeyValueStore
+from store.sstable import SSTable
+
+
+def test_merge_newest_wins_and_keeps_tombstones():
+    older = SSTable({"a": "old", "b": "keep", "c": "gone"})
+    newer = SSTable({"a": "new", "c": None})
+    assert list(merge_tables([newer, older])) == [("a", "new"), ("b", "keep"), ("c", None)]
+    assert list(merge_tables([newer, older], drop_tombstones=True)) == [("a", "new"), ("b", "keep")]
+
+
+def fill(kv, rounds, per_round=50):
+    for r in range(rounds):
+        for i in range(per_round):
+            kv.put(f"key{i:03d}", f"round{r}")
+        kv.flush_to_sstable()
+
+
+def test_leveled_compaction_keeps_deletes_and_reports_write_amplification():
+    kv = KeyValueStore()
+    kv.compactor.stop()  # drive compaction by hand
+    fill(kv, 2)
+    kv.delete("key007")
+    kv.flush_to_sstable()
+    fill(kv, 1, per_round=5)
+    assert len(kv.levels[0]) == 4
+
+    kv.compact_sstables()
+    assert kv.levels[0] == []
+    assert len(kv.levels[1]) == 1
+    assert kv.read("key007") is None
+    assert kv.read("key003") == "round0"
+    assert kv.read("key030") == "round1"
+    stats = kv.compactor.stats
+    assert stats["compactions"] == 1
+    assert stats["bytes_written"] > 0 and stats["bytes_read"] > 0
+    assert stats["write_amplification"] > 1
+
+
+def test_compaction_survives_restart():
+    kv = KeyValueStore()
+    kv.compactor.stop()
+    fill(kv, 4)
+    kv.compact_sstables()
+    kv.put("key001", "newest")
+    kv.flush_to_sstable()
+    kv.close()
+
+    kv = KeyValueStore()
+    assert [len(level) for level in kv.levels] == [1, 1]
+    assert kv.read("key001") == "newest"
+    assert kv.read("key002") == "round3"
+
+
+def test_size_tiered_merges_runs_of_similar_size():
+    kv = KeyValueStore(compaction="tiered")
+    kv.compactor.stop()
+    fill(kv, 4)
+    assert isinstance(kv.compactor.strategy, SizeTieredCompaction)
+    kv.compact_sstables()
+    assert len(kv.levels) == 1 and len(kv.levels[0]) == 1
+    assert kv.read("key010") == "round3"
+
+
+def test_background_compaction():
+    kv = KeyValueStore()
+    fill(kv, 5)
+    deadline = time.time() + 5
+    while kv.compactor.stats["compactions"] == 0 and time.time() < deadline:
+        time.sleep(0.01)
+    assert kv.compactor.stats["compactions"] >= 1
+    assert kv.read("key010") == "round4"
+    kv.close()
+
+
+def test_rate_limiter_throttles():
+    limiter = RateLimiter(100_000)
+    start = time.monotonic()
+    for _ in range(3):
+        limiter.consume(100_000)
+    assert time.monotonic() - start >= 1.5
@@ -0,0 +1,48 @@
+import socket
+from concurrent.futures import ThreadPoolExecutor
+
+import protocol
+from client import BinaryConnection
+
+
+def test_frame_round_trip():
+    frame = protocol.encode_frame(7, protocol.PUT, [b"k", "v a\nl", b""])
+    body_length, request_id, code = protocol.split_frame_header(frame[:protocol.FRAME_HEADER.size])
+    assert (request_id, code) == (7, protocol.PUT)
+    assert protocol.decode_fields(frame[protocol.FRAME_HEADER.size:]) == [b"k", b"v a\nl", b""]
+    assert body_length == len(frame) - protocol.FRAME_HEADER.size
+
+    value = memoryview(b"0123456789")[2:6]
+    parts = protocol.frame_parts(7, protocol.OK, ["key", value])
+    assert parts[-1] is value  # handed to the transport as is
+    assert protocol.decode_fields(b"".join(parts)[protocol.FRAME_HEADER.size:]) == [b"key", b"2345"]
+
+
+def test_binary_values_and_multiplexing(kv_server):
+    port, store = kv_server
+    conn = BinaryConnection("127.0.0.1", port)
+    raw = b"\x00\xff spaces\nnewlines\r\n" * 1000
+    assert conn.request(protocol.PUT, b"bin key", raw) == (protocol.OK, [])
+    assert conn.request(protocol.READ, b"bin key") == (protocol.OK, [raw])
+    assert conn.request(protocol.READ, b"nope") == (protocol.NOT_FOUND, [])
+
+    futures = [conn.submit(protocol.PUT, f"k{i:03d}", f"v{i}") for i in range(200)]
+    assert all(f.result(5) == (protocol.OK, []) for f in futures)
+    with ThreadPoolExecutor(8) as pool:
+        reads = list(pool.map(lambda i: conn.request(protocol.READ, f"k{i:03d}", timeout=5), range(200)))
+    assert reads == [(protocol.OK, [f"v{i}".encode()]) for i in range(200)]
+
+    status, fields = conn.request(protocol.RANGE, "k000", "k002")
+    assert status == protocol.OK and fields == [b"k000", b"v0", b"k001", b"v1", b"k002", b"v2"]
+    assert conn.request(protocol.BATCHPUT, "b1", "x", "b2", "y") == (protocol.OK, [])
+    assert store.read("b2") == "y"
+    assert conn.request(99)[0] == protocol.ERROR
+    conn.close()
+
+
+def test_text_clients_share_the_port(kv_server):
+    port, _ = kv_server
+    BinaryConnection("127.0.0.1", port).request(protocol.PUT, "shared", "yes")
+    with socket.create_connection(("127.0.0.1", port)) as s:
+        s.sendall(b"READ shared\n")
+        assert s.recv(100) == b"yes\n"
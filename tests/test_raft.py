@@ -0,0 +1,430 @@
+import asyncio
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import protocol
+from client import Command, KVClient, KVClientError
+from server import Partitions, start_partitioned_server
+from store.kv import KeyValueStore
+from store import raft
+from store.raft import RaftNode
+
+
+def run_cluster(partitions=1):
+    """
+    Three nodes, each serving ``partitions`` Raft groups, on one event loop thread.
+    Yields a list of (port, [RaftNode per partition], [KeyValueStore per partition]).
+    """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    members = []
+    for i in range(3):
+        stores = [KeyValueStore(f"node{i}/partition_{p}") for p in range(partitions)]
+        nodes = [RaftNode(None, [], store, partition=p) for p, store in enumerate(stores)]
+        server = asyncio.run_coroutine_threadsafe(
+            start_partitioned_server(Partitions(zip(stores, nodes)), "127.0.0.1", 0), loop).result()
+        port = server.sockets[0].getsockname()[1]
+        for node in nodes:
+            node.node_id = port
+        members.append((port, nodes, stores, server))
+    for _, nodes, _, _ in members:
+        for node in nodes:
+            node.peers = [("127.0.0.1", port) for port, *_ in members if port != node.node_id]
+    yield [(port, nodes, stores) for port, nodes, stores, _ in members]
+
+    for _, nodes, _, _ in members:
+        for node in nodes:
+            node.stop()
+
+    async def shutdown():
+        for *_, server in members:
+            server.close()
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        # Peer connections close with their nodes; let those handlers finish on their own
+        _, tasks = await asyncio.wait(tasks, timeout=1) if tasks else (None, [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run_coroutine_threadsafe(shutdown(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+    for _, _, stores, _ in members:
+        for store in stores:
+            store.close()
+
+
+@pytest.fixture
+def cluster():
+    """A single-partition cluster; yields a list of (port, node, store)."""
+    for members in run_cluster():
+        yield [(port, nodes[0], stores[0]) for port, nodes, stores in members]
+
+
+@pytest.fixture
+def sharded_cluster():
+    yield from run_cluster(partitions=3)
+
+
+def wait_for_leader(members, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        leaders = [m for m in members if m[1].state == "leader"]
+        followers = [m for m in members if m[1].state == "follower" and leaders and m[1].leader == leaders[0][0]]
+        if len(leaders) == 1 and len(followers) == len(members) - 1:
+            return leaders[0], followers
+        time.sleep(0.01)
+    raise AssertionError("no leader elected")
+
+
+def test_writes_commit_on_a_majority_and_reach_followers(cluster):
+    (leader_port, leader, leader_store), followers = wait_for_leader(cluster)
+
+    client = KVClient([leader_port], binary=True, host="127.0.0.1")
+    with ThreadPoolExecutor(16) as pool:
+        results = list(pool.map(lambda i: client.put(f"k{i:03d}", str(i)), range(300)))
+    assert results == ["OK"] * 300
+    assert client.batch_put([("b1", "x"), ("b2", "y")]) == "OK"
+    assert client.delete("k000") == "OK"
+    assert leader.commit_index == len(leader.log) == 303  # the leader's NOOP, then the writes
+    deadline = time.monotonic() + 5
+    while any(node.last_applied < 303 for _, node, _ in followers) and time.monotonic() < deadline:
+        time.sleep(0.01)  # followers apply once the next message carries the commit index
+    for _, node, store in followers:
+        assert store.read("k299") == "299" and store.read("b2") == "y" and store.read("k000") is None
+    # Far fewer AppendEntries rounds (follower WAL records) than writes
+    assert followers[0][2].wal.stats["appends"] < 302
+    client.close()
+
+
+def test_failover_elects_a_new_leader_quickly(cluster):
+    old, followers = wait_for_leader(cluster)
+    client = KVClient([port for port, _, _ in cluster], host="127.0.0.1")
+    assert client.put("a", "1") == "OK"
+    old_term = old[1].current_term
+    old[1].stop()  # the leader goes silent
+    started = time.monotonic()
+    (new_port, new_leader, new_store), _ = wait_for_leader(followers)
+    assert time.monotonic() - started < 2
+    assert new_leader.current_term > old_term
+    # Earlier-term entries are applied only once the new leader's NOOP commits
+    new_leader.read_barrier("read-index")
+    assert new_store.read("a") == "1"
+    client.leader_port = None  # forget the dead leader; the client finds the new one itself
+    client.nodes = [new_port, old[0]]
+    assert client.put("b", "2") == "OK" and client.leader_port == new_port
+    client.close()
+
+
+def test_read_modes(cluster):
+    (leader_port, leader, _), followers = wait_for_leader(cluster)
+    writer = KVClient([leader_port], binary=True, host="127.0.0.1")
+    assert writer.put("a", "1") == "OK"
+    assert leader.lease_valid()
+
+    for port, _, _ in followers:
+        reader = KVClient([port], host="127.0.0.1", read_mode="read-index")
+        assert writer.put("a", port) == "OK"
+        assert reader.read("a") == str(port)
+        assert list(reader._conns) == [port]  # served by the follower itself
+        reader.close()
+
+    lease = KVClient([followers[0][0]], binary=True, host="127.0.0.1", read_mode="leader-lease")
+    assert lease.multi_get(["a"]) == {"a": str(followers[-1][0])} and lease.leader_port == leader_port
+    lease.close()
+
+    follower = followers[0][1]
+    assert follower.local_read_ok("stale-ok", 0.1)
+    leader.stop()
+    time.sleep(0.2)
+    assert not follower.local_read_ok("stale-ok", 0.1) and follower.local_read_ok("stale-ok", 5)
+    with pytest.raises(KVClientError):
+        KVClient([followers[0][0]], host="127.0.0.1", read_mode="linearish", max_retries=0).read("a")
+    writer.close()
+
+
+def test_log_is_truncated_and_lagging_follower_gets_a_snapshot(cluster, monkeypatch):
+    monkeypatch.setattr(raft, "SNAPSHOT_CHUNK_BYTES", 512)
+    for _, node, _ in cluster:
+        node.snapshot_entries, node.log_trailing_entries = 100, 20
+    (leader_port, leader, _), followers = wait_for_leader(cluster)
+    client = KVClient([leader_port], binary=True, host="127.0.0.1")
+    pipe = client.pipeline()
+    for i in range(500):
+        pipe.put(f"k{i:03d}", str(i))
+    assert pipe.execute() == ["OK"] * 500
+
+    deadline = time.monotonic() + 5
+    while leader.snapshot_index < 400 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert leader.log_start > 0 and len(leader.log) < 200
+    assert leader.term_at(leader.log_start) == leader.current_term
+
+    # A follower that lost its log (a restart) and holds data the cluster never had
+    _, follower, follower_store = followers[0]
+    with follower.apply_lock, follower.cond:
+        follower.log, follower.log_start, follower.log_start_term = [], 0, 0
+        follower.last_applied = follower.commit_index = 0
+        follower_store.put("junk", "x")
+    assert client.put("after", "1") == "OK"
+    deadline = time.monotonic() + 5
+    while follower_store.read("after") != "1" and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert follower.log_start >= 400 and follower_store.read("after") == "1"
+    assert follower_store.read("k499") == "499" and follower_store.read("junk") is None
+    restarted = RaftNode(None, [], follower_store)  # picks the log up again after the snapshot
+    assert restarted.last_applied == follower.snapshot_index
+    assert (restarted.log_start, restarted.log) == (follower.log_start, follower.log)
+    restarted.stop()
+    client.close()
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_watch_streams_committed_changes_and_resumes(cluster, binary):
+    (leader_port, leader, _), followers = wait_for_leader(cluster)
+    writer = KVClient([leader_port], binary=True, host="127.0.0.1")
+    assert writer.put("user:0", "zero") == "OK"
+    client = KVClient([port for port, _, _ in cluster], binary=binary, host="127.0.0.1")
+    feed = client.watch("user:")
+    seen = []
+    consumer = threading.Thread(target=lambda: seen.extend(next(feed) for _ in range(4)))
+    consumer.start()
+    time.sleep(0.2)  # the watch starts from now: user:0 is not replayed
+    assert writer.put("user:1", "a") == "OK"
+    assert writer.put("other", "x") == "OK"
+    assert writer.batch_put([("user:2", "b"), ("user:3", "c")]) == "OK"
+    assert writer.delete("user:1") == "OK"
+    consumer.join(5)
+    assert [(e.op, e.key, e.value) for e in seen] == [
+        ("PUT", "user:1", "a"), ("PUT", "user:2", "b"), ("PUT", "user:3", "c"), ("DELETE", "user:1", None)]
+    assert seen[1].index == seen[2].index == seen[0].index + 2  # one log entry, one index
+    feed.close()
+
+    # Resume from an index, against a follower: it serves what it has committed
+    follower = KVClient([followers[0][0]], binary=binary, host="127.0.0.1")
+    resumed = follower.watch("user:", from_index=seen[0].index)
+    assert [next(resumed).key for _ in range(3)] == ["user:2", "user:3", "user:1"]
+    resumed.close()
+    assert list(itertools.islice(follower.watch("", from_index=seen[0].index - 1), 2)) == [
+        seen[0], (seen[0].index + 1, "PUT", "other", "x")]
+    writer.close()
+    client.close()
+    follower.close()
+
+
+def test_changes_reads_whole_entries_and_reports_a_compacted_log():
+    store = KeyValueStore()
+    node = RaftNode(1, [], store)
+    node.become_leader()
+    node.replicate_log(("PUTEX", "a1", ["v", 2 ** 40]))
+    node.replicate_log(("BATCH", [("PUT", "a2", "x"), ("PUT", "b", "y"), ("PUT", "a3", "z")], None))
+    node.replicate_log(("DEL", "a1", None))
+    assert node.changes(None) == ([], 4)
+    assert node.changes(4, "a") == ([], 4)
+    assert node.changes(0, "a", limit=2) == ([(2, "PUT", "a1", "v"), (3, "PUT", "a2", "x"), (3, "PUT", "a3", "z")], 3)
+    assert node.changes(3, "a") == ([(4, "DELETE", "a1", None)], 4)
+    node.snapshot_index = 3
+    node.compact_log(3)
+    with pytest.raises(raft.LogCompactedError):
+        node.changes(2)
+    assert node.changes(3)[0] == [(4, "DELETE", "a1", None)]
+    node.stop()
+    store.close()
+
+
+def test_partitions_spread_leaders_and_route_keys(sharded_cluster):
+    ports = [port for port, _, _ in sharded_cluster]
+    for port, nodes, _ in sharded_cluster:
+        for node in nodes:
+            node.preferred_leader = ports[node.partition]
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        leaders = [[port for port, nodes, _ in sharded_cluster if nodes[p].state == "leader"] for p in range(3)]
+        if leaders == [[port] for port in ports]:
+            break
+        time.sleep(0.01)
+    assert leaders == [[port] for port in ports]  # one group led by each node
+
+    client = KVClient(ports, binary=True, host="127.0.0.1")
+    pipe = client.pipeline()
+    for i in range(90):
+        pipe.put(f"k{i:02d}", str(i))
+    assert pipe.execute() == ["OK"] * 90
+    assert client.partitions == 3 and client.leaders == dict(enumerate(ports))
+    for p in range(3):
+        leader_store = sharded_cluster[p][2][p]
+        keys = [f"k{i:02d}" for i in range(90)]
+        owned = [k for k in keys if protocol.partition_for(k, 3) == p]
+        assert 0 < len(owned) < 90
+        assert all(leader_store.read(k) is not None for k in owned)
+        assert all(leader_store.read(k) is None for k in keys if k not in owned)
+
+    assert client.batch_put([("b1", "x"), ("b2", "y"), ("b3", "z")]) == "OK"
+    assert client.multi_get(["b1", "b3", "k05", "nope"]) == {"b1": "x", "b3": "z", "k05": "5"}
+    assert list(client.range_read("k10", "k14")) == ["k10", "k11", "k12", "k13", "k14"]
+    assert list(client.scan("k00", "k89", page_size=7)) == [(f"k{i:02d}", str(i)) for i in range(90)]
+    text = KVClient([ports[0]], host="127.0.0.1")  # any node gathers RANGE and SCAN over its partitions
+    assert text.range_read("b1", "b3") == {"b1": "x", "b2": "y", "b3": "z"}
+    assert text.read("k42") == "42"
+    assert text._execute(Command("SCAN k10 k89 5", protocol.SCAN)) == (
+        [(f"k{i}", str(i)) for i in range(10, 15)], "k15")
+    text.close()
+    client.close()
+
+
+def test_term_and_vote_survive_restart():
+    store = KeyValueStore()
+    node = RaftNode(7, [], store)
+    node.start_election()
+    assert node.state == "leader"
+    term = node.current_term
+    node.stop()
+    store.close()
+    store = KeyValueStore()
+    assert (store.current_term, store.voted_for) == (term, 7)
+    node = RaftNode(7, [], store)
+    assert node.current_term == term
+    node.stop()
+    store.close()
+
+
+def test_log_survives_restart():
+    store = KeyValueStore()
+    node = RaftNode(2, [], store)
+    node.election_timeout = 60
+    entries = [[1, ["PUT", "a", "1"]], [1, ["PUT", "b", "1"]], [1, ["DEL", "a", None]]]
+    msg = {"term": 1, "leader": 1, "prev_index": 0, "prev_term": 0, "entries": entries, "commit": 1}
+    assert node.handle_append_entries(msg)["match"] == 3
+    msg.update(prev_index=1, prev_term=1, entries=[[2, ["PUT", "c", "2"]]], term=2, commit=1)
+    assert node.handle_append_entries(msg)["match"] == 2  # replaces a conflicting suffix
+    node.stop()
+
+    node = RaftNode(2, [], store)
+    node.election_timeout = 60
+    assert node.log == [[1, ["PUT", "a", "1"]], [2, ["PUT", "c", "2"]]] and node.commit_index == 0
+    # Having acknowledged index 2, the node will not vote for a candidate without it
+    vote = {"term": 3, "candidate": 3, "last_log_index": 1, "last_log_term": 1}
+    assert not node.handle_request_vote(vote)["granted"]
+    node.stop()
+
+    # A leader's own entries are on disk before they count towards a majority
+    node = RaftNode(2, [], store)
+    node.start_election()
+    assert node.replicate_log(("PUT", "d", "3")) == 4
+    node.stop()
+    store.close()
+    store = KeyValueStore()
+    node = RaftNode(2, [], store)
+    assert [entry for _, entry in node.log[-2:]] == [list(raft.NOOP), ["PUT", "d", "3"]]
+    node.stop()
+    store.close()
+
+
+def test_follower_reads_never_see_uncommitted_writes():
+    store = KeyValueStore()
+    node = RaftNode(2, [], store)
+    node.election_timeout, node.replication_timeout = 60, 0.2
+    msg = {"term": 1, "leader": 1, "prev_index": 0, "prev_term": 0, "entries": [[1, ["PUT", "k", "v"]]], "commit": 0}
+    assert node.handle_append_entries(msg)["success"]
+    assert node.local_read_ok("stale-ok", 1) and store.read("k") is None
+    with pytest.raises(TimeoutError):
+        node._wait_applied(1)  # a read-index read waits for the commit, it does not read ahead of it
+    assert node.changes(0) == ([], 0)
+
+    node.replication_timeout = 5
+    reader = ThreadPoolExecutor(1).submit(node._wait_applied, 1)
+    msg.update(prev_index=1, prev_term=1, entries=[], commit=1)
+    assert node.handle_append_entries(msg)["success"]
+    reader.result()
+    assert store.read("k") == "v" and node.changes(0) == ([(1, "PUT", "k", "v")], 1)
+    node.stop()
+    store.close()
+
+
+def test_snapshot_and_log_compaction_stop_at_the_commit_index():
+    store = KeyValueStore()
+    node = RaftNode(2, [], store)
+    node.election_timeout, node.log_trailing_entries = 60, 0
+    entries = [[1, ["PUT", "a", "1"]], [1, ["PUT", "b", "1"]], [1, ["PUT", "c", "1"]]]
+    node.handle_append_entries({"term": 1, "leader": 1, "prev_index": 0, "prev_term": 0,
+                                "entries": entries, "commit": 1})
+    node.snapshotting = True
+    node._take_snapshot()
+    assert node.snapshot_index == node.log_start == 1 and len(node.log) == 2
+    with node.cond:
+        node.snapshot_index = 3  # even a snapshot claiming more never drops uncommitted entries
+        node.compact_log(3)
+    assert node.log_start == 1 and node.last_index() == 3
+    node.stop()
+    store.close()
+
+
+def test_vote_requires_an_up_to_date_log():
+    store = KeyValueStore()
+    node = RaftNode(1, [], store)
+    node.election_timeout = 60
+    node.log = [[1, ["PUT", "a", "1"]], [1, ["PUT", "b", "1"]]]
+
+    def vote(candidate, term, last_index, last_term):
+        return node.handle_request_vote({"term": term, "candidate": candidate,
+                                         "last_log_index": last_index, "last_log_term": last_term})
+
+    assert vote(2, 2, 1, 1) == {"term": 2, "granted": False}  # shorter log
+    assert vote(3, 2, 2, 1)["granted"]
+    assert not vote(2, 2, 5, 1)["granted"]  # already voted this term
+    assert vote(3, 2, 2, 1)["granted"]  # repeat request from the same candidate
+    assert vote(2, 3, 1, 2)["granted"]  # newer last term wins over length
+    node.stop()
+    store.close()
+
+
+def test_write_needs_a_majority():
+    store = KeyValueStore()
+    alone = RaftNode(1, [], store)
+    alone.become_leader()
+    assert alone.replicate_log(("PUT", "a", "1")) == alone.commit_index == 2
+
+    unreachable = RaftNode(2, [("127.0.0.1", 1), ("127.0.0.1", 2)], store)
+    unreachable.replication_timeout = 0.3
+    unreachable.become_leader()
+    with pytest.raises(TimeoutError):
+        unreachable.replicate_log(("PUT", "a", "2"))
+    assert unreachable.commit_index == 0
+    for node in (alone, unreachable):
+        node.stop()
+    store.close()
+
+
+def test_follower_log_matching():
+    store = KeyValueStore()
+    node = RaftNode(2, [], store)
+    node.election_timeout = 60
+
+    def append(prev_index, prev_term, entries, term=1, commit=0):
+        return node.handle_append_entries({"term": term, "leader": 1, "prev_index": prev_index,
+                                           "prev_term": prev_term, "entries": entries, "commit": commit})
+
+    entries = [[1, ["PUT", "a", "1"]], [1, ["PUT", "b", "1"]], [1, ["DEL", "a", None]]]
+    assert append(0, 0, entries, commit=1) == {"term": 1, "success": True, "match": 3}
+    assert store.read("a") == "1" and store.read("b") is None  # applied only up to the commit index
+    assert append(0, 0, entries[:2], commit=2)["success"]  # retransmission: nothing re-applied
+    assert len(node.log) == 3 and store.read("b") == "1" and store.read("a") == "1"
+    assert append(5, 1, [])["success"] is False  # gap: leader must back up
+    assert append(2, 1, [[2, ["BATCH", [["PUT", "c", "2"], ["PUT", "d", "2"]], None]]], term=2)["match"] == 3
+    assert [term for term, _ in node.log] == [1, 1, 2] and store.read("a") == "1"  # the DEL was replaced
+    assert store.read("d") is None  # appended, not yet committed
+    assert append(3, 2, [], term=2, commit=3)["success"] and store.read("d") == "2"
+    assert append(3, 2, [], term=1) == {"term": 2, "success": False, "match": 0}  # stale leader
+
+    # An uncommitted entry replaced by a new leader's never reaches the store
+    assert append(3, 2, [[2, ["PUT", "k", "uncommitted"]]], term=2, commit=3)["match"] == 4
+    assert append(3, 2, [[3, ["PUT", "other", "x"]]], term=3, commit=4)["match"] == 4
+    assert store.read("k") is None and store.read("other") == "x"
+    node.stop()
+    store.close()
@@ -0,0 +1,181 @@
+import asyncio
+import json
+import time
+import urllib.request
+
+from client import AsyncKVClient
+from server import Partitions, start_health_server, start_owner, start_server, start_worker
+from store.kv import KeyValueStore
+from store.raft import RaftNode
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def with_server(raft, body):
+    store = KeyValueStore()
+    raft.kvstore = store
+    server = await start_server(store, raft, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        return await body(port)
+    finally:
+        server.close()
+        await server.wait_closed()
+        store.close()
+
+
+def test_pipelined_commands_answer_in_order(local_raft):
+    async def body(port):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        commands = [f"PUT k{i} value {i}\n" for i in range(100)] + [f"READ k{i}\n" for i in range(100)]
+        writer.write("".join(commands).encode())
+        await writer.drain()
+        replies = [(await reader.readline()).decode().strip() for _ in commands]
+        writer.close()
+        return replies
+
+    replies = run(with_server(local_raft, body))
+    assert replies[:100] == ["OK"] * 100
+    assert replies[100:] == [f"value {i}" for i in range(100)]
+
+
+def test_many_idle_connections_and_errors(local_raft):
+    async def body(port):
+        conns = [await asyncio.open_connection("127.0.0.1", port) for _ in range(200)]
+        reader, writer = conns[-1]
+        writer.write(b"READ missing\nFROB x\nPUT onlykey\nPUT raw \xff\xfe\nREAD raw\n")
+        replies = [(await reader.readline()).strip() for _ in range(5)]
+        for _, w in conns:
+            w.close()
+        return replies
+
+    replies = run(with_server(local_raft, body))
+    assert replies[0] == b"NOT_FOUND"
+    assert replies[1].startswith(b"ERR unknown command")
+    assert replies[2].startswith(b"ERR wrong number of arguments")
+    assert replies[3:] == [b"OK", b"\xff\xfe"]  # bytes that are not UTF-8 round-trip
+
+
+def test_pipelined_range_is_not_overtaken_by_later_writes(local_raft, monkeypatch):
+    read_key_range = KeyValueStore.read_key_range
+
+    def slow_read_key_range(store, start, end):
+        time.sleep(0.2)  # a PUT sent after the RANGE would finish first if it did not wait
+        return read_key_range(store, start, end)
+
+    monkeypatch.setattr(KeyValueStore, "read_key_range", slow_read_key_range)
+
+    async def body(port):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"PUT a 1\nRANGE a z\nPUT m v\nREAD m\n")
+        replies = [(await reader.readline()).decode().strip() for _ in range(4)]
+        writer.close()
+        return replies
+
+    assert run(with_server(local_raft, body)) == ["OK", "{'a': '1'}", "OK", "v"]
+
+
+def test_follower_redirects_writes(local_raft):
+    async def body(port):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"PUT a 1\nREAD a\n")
+        replies = [(await reader.readline()).decode().strip() for _ in range(2)]
+        writer.close()
+        return replies
+
+    local_raft.state, local_raft.leader = "follower", 6001
+    assert run(with_server(local_raft, body)) == ["REDIRECT 6001", "NOT_FOUND"]
+
+
+def test_batchput_and_multiget_over_text(local_raft):
+    async def body(port):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"BATCHPUT a:1 b:x:y c:\nMULTIGET a b c d\nBATCHPUT __import__('os')\n")
+        replies = [(await reader.readline()).decode().strip() for _ in range(3)]
+        writer.close()
+        return replies
+
+    ok, multi, bad = run(with_server(local_raft, body))
+    assert ok == "OK"
+    assert multi == str({"a": "1", "b": "x:y", "c": ""})
+    assert bad.startswith("ERR")
+    assert local_raft.entries == [("BATCH", [("PUT", "a", "1"), ("PUT", "b", "x:y"), ("PUT", "c", "")], None)]
+
+
+def test_put_with_expiry_over_text(local_raft):
+    async def body(port):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"PUT s1 a b EX 30\nREAD s1\nPUT s2 v ex 0\nPUT s3 v EX soon\n")
+        replies = [(await reader.readline()).decode().strip() for _ in range(4)]
+        writer.close()
+        return replies
+
+    ok, value, zero, literal = run(with_server(local_raft, body))
+    assert (ok, value, literal) == ("OK", "a b", "OK")
+    assert zero.startswith("ERR expiry must be a positive")
+    op, key, (stored, expires_at) = local_raft.entries[0]
+    assert (op, key, stored) == ("PUTEX", "s1", "a b") and expires_at > time.time() * 1000 + 29000
+    assert local_raft.entries[1] == ("PUT", "s3", "v EX soon")
+
+
+def test_workers_share_the_port_and_forward_to_the_owner(local_raft):
+    async def scenario():
+        store = KeyValueStore()
+        local_raft.kvstore = store
+        owner = await start_owner(Partitions([(store, local_raft)]), "owner.sock")
+        first, first_link = await start_worker("127.0.0.1", 0, "owner.sock")
+        port = first.sockets[0].getsockname()[1]
+        second, second_link = await start_worker("127.0.0.1", port, "owner.sock")  # SO_REUSEPORT
+
+        client = AsyncKVClient([port], binary=True, host="127.0.0.1", partitions=1)
+        assert await asyncio.gather(*(client.put(f"k{i}", str(i)) for i in range(100))) == ["OK"] * 100
+        assert await client.multi_get(["k1", "k99", "nope"]) == {"k1": "1", "k99": "99"}
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"READMODE bogus\nPUT a 1\nREAD a\nDELETE a\nREAD a\n")
+        replies = [(await reader.readline()).decode().strip() for _ in range(5)]
+        writer.close()
+        await client.close()
+        for server in (first, second, owner):
+            server.close()
+            await server.wait_closed()
+        first_link.close()
+        second_link.close()
+        store.close()
+        return replies
+
+    replies = run(scenario())
+    assert replies[0].startswith("ERR unknown read mode")
+    assert replies[1:] == ["OK", "1", "OK", "NOT_FOUND"]
+
+
+def test_health_status_and_metrics_endpoints():
+    store = KeyValueStore()
+    node = RaftNode(7, [("127.0.0.1", 1)], store)
+    node.election_timeout = 60
+    node.become_leader()
+    store.put("a", "1")
+    store.read("a")
+    store.read("missing")
+    store.flush_to_sstable()
+    httpd = start_health_server(Partitions([(store, node)]), 7, http_port=0)
+    base = f"http://127.0.0.1:{httpd.server_address[1]}"
+    try:
+        health = json.loads(urllib.request.urlopen(base + "/health").read())
+        assert health == {"status": "ok", "port": 7, "role": "leader", "leader": 7, "redirect": None}
+        status = json.loads(urllib.request.urlopen(base + "/status").read())
+        assert status["partitions"][0]["followers"][0]["peer"] == "127.0.0.1:1"
+        assert status["partitions"][0]["followers"][0]["lag_entries"] == 1  # the leader's NOOP
+        text = urllib.request.urlopen(base + "/metrics").read().decode()
+    finally:
+        httpd.shutdown()
+        node.stop()
+        store.close()
+    samples = dict(line.rsplit(" ", 1) for line in text.splitlines() if not line.startswith("#"))
+    assert samples['kv_store_operations_total{op="reads",partition="0"}'] == "2"
+    assert samples['kv_store_duration_seconds_count{op="read",partition="0"}'] == "2"
+    assert samples['kv_store_duration_seconds_bucket{op="write",partition="0",le="+Inf"}'] == "1"
+    assert samples['kv_sstables{level="0",partition="0"}'] == "1"
+    assert samples['kv_raft_follower_lag_entries{partition="0",follower="127.0.0.1:1"}'] == "1"
+    assert "# TYPE kv_wal_duration_seconds histogram" in text and 'kv_cache_hit_ratio{' in text
@@ -0,0 +1,56 @@
+import os
+import threading
+
+from store.kv import KeyValueStore
+from store.snapshot import read_snapshot
+
+
+def test_snapshot_is_point_in_time_while_writes_continue():
+    kv = KeyValueStore(memtable_bytes=8192)
+    for i in range(300):
+        kv.put(f"key{i:04d}", f"v{i}")
+    kv.delete("key0005")
+
+    writer = threading.Thread(target=lambda: [kv.put(f"late{i}", "x") for i in range(200)])
+    writer.start()
+    path = kv.create_snapshot()
+    writer.join()
+
+    meta, items = read_snapshot(path)
+    data = dict(items)
+    assert meta["term"] == kv.current_term
+    assert data["key0299"] == "v299"
+    assert "key0005" not in data
+    assert len([k for k in data if k.startswith("key")]) == 299
+    assert kv.read("late199") == "x"
+
+
+def test_wal_size_triggers_incremental_snapshot():
+    kv = KeyValueStore(snapshot_wal_bytes=4096)
+    for i in range(500):
+        kv.put("hot", str(i))  # memtable stays tiny, the WAL does not
+    kv.flush_to_sstable()
+    assert kv.wal.active_bytes < 4096
+    assert kv.sstables
+    kv.close()
+    assert KeyValueStore().read("hot") == "499"
+
+
+def test_compressed_snapshot_and_store_reopened_without_compression():
+    doc = '{"id": 1, "items": ["apple", "banana", "cherry"], "note": "repeat"}' * 5
+    kv = KeyValueStore("packed", compression="lzma")
+    kv.batch_put([(f"doc{i:05d}", doc) for i in range(2000)])
+    kv.flush_to_sstable()
+    kv.put("tail", doc)
+    path = kv.create_snapshot()
+    kv.close()
+    meta, items = read_snapshot(path)
+    assert meta["compression"] == "lzma" and sum(1 for _ in items) == 2001
+    assert os.path.getsize(path) * 10 < 2000 * len(doc)
+
+    kv = KeyValueStore("packed")  # new data uncompressed, the old files stay readable
+    kv.put("new", "1")
+    kv.flush_to_sstable()
+    assert kv.read("doc01999") == doc and kv.read("tail") == doc and kv.read("new") == "1"
+    assert {table.codec for table in kv.sstables} == {0, 2}
+    kv.close()
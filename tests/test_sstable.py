@@ -0,0 +1,99 @@
+import os
+
+from store.sstable import SSTable, SSTableWriter
+
+
+def make_table(n=2000):
+    return SSTable({f"key{i:05d}": f"value{i}" for i in range(n)})
+
+
+def test_point_lookups_across_blocks():
+    table = make_table()
+    assert len(table.blocks) > 1
+    assert table.get("key00000") == "value0"
+    assert table.get("key01234") == "value1234"
+    assert table.get("key01999") == "value1999"
+    assert table.get("key02000") is None
+    assert table.get("a") is None
+
+
+def test_get_reads_at_most_one_block():
+    table = make_table()
+    reads = []
+    original = table._read_block
+    table._read_block = lambda i: reads.append(i) or original(i)
+    assert table.get("key01500") == "value1500"
+    assert len(reads) == 1
+    reads.clear()
+    misses = sum(table.get(f"missing{i}") is None for i in range(200))
+    assert misses == 200
+    assert len(reads) < 20  # bloom filter rejects nearly every miss
+
+
+def test_range_query_seeks_to_start_key():
+    table = make_table()
+    reads = []
+    original = table._read_block
+    table._read_block = lambda i: reads.append(i) or original(i)
+    result = table.range_query("key01500", "key01503")
+    assert result == {f"key0150{i}": f"value150{i}" for i in range(4)}
+    assert len(reads) <= 2
+
+
+def test_reopen_from_file_and_tombstones():
+    table = SSTable({"a": "1", "b": None, "c": "3"})
+    reopened = SSTable(filename=table.filename)
+    assert reopened.lookup("b") == (True, None)
+    assert reopened.lookup("z") == (False, None)
+    assert reopened.range_query("a", "z") == {"a": "1", "c": "3"}
+    assert (reopened.first_key, reopened.last_key, reopened.count) == ("a", "c", 3)
+
+
+def test_prefix_compressed_keys_and_block_compression():
+    items = [(f"customer:{i:08d}", '{"plan": "gold", "active": true}' * 10) for i in range(2000)]
+    SSTable.write("plain.db", items, len(items))
+    SSTable.write("zlib.db", items, len(items), compression="zlib")
+    plain, packed = SSTable(filename="plain.db"), SSTable(filename="zlib.db")
+    assert packed.file_size * 5 < plain.file_size
+    assert (plain.codec, packed.codec) == (0, 1)
+    for table in (plain, packed):
+        assert table.get("customer:00001234") == items[1234][1]
+        assert list(table.items("customer:00001998")) == items[1998:]
+    # Keys share their "customer:0000" prefix with the previous key: only the tail is stored
+    writer = SSTableWriter("keys.db")
+    for key, _ in items:
+        writer.add(key, "")
+    writer.finish()
+    assert writer.raw_bytes < sum(len(key) for key, _ in items)
+
+
+def test_previous_format_tables_are_still_read():
+    # A KVSST005 table: whole keys, no codec byte, footer without codec
+    import struct
+    from store.bloom import BloomFilter
+    block = b"".join(struct.pack("<IIB", len(k), len(v), 0) + k + v for k, v in [(b"a", b"1"), (b"b", b"2")])
+    bloom = BloomFilter.for_capacity(2)
+    bloom.add(b"a")
+    bloom.add(b"b")
+    bloom_bytes = bloom.to_bytes()
+    index = struct.pack("<I", 1) + struct.pack("<QII", 0, len(block), 1) + b"a" + struct.pack("<I", 1) + b"b"
+    footer = struct.pack("<QQQQQIQ8s", len(block) + len(bloom_bytes), len(index), len(block), len(bloom_bytes),
+                         2, 0, 1, b"KVSST005")
+    with open("old.db", "wb") as f:
+        f.write(block + bloom_bytes + index + footer)
+    table = SSTable(filename="old.db")
+    assert table.version == 5 and table.get("b") == "2" and table.range_query("a", "z") == {"a": "1", "b": "2"}
+
+
+def test_open_reads_only_the_footer_and_serves_blocks_from_the_map():
+    make_table(2000)
+    (filename,) = [name for name in os.listdir(".") if name.endswith(".db")]
+    table = SSTable(filename=filename)
+    assert (table.first_key, table.last_key, table.count) == ("key00000", "key01999", 2000)
+    assert table._index is None and table._bloom is None
+    assert table.get("zzz") is None and table._bloom is None  # outside the key range
+    assert table.get("key00500x") is None and table._index is None  # rejected by the bloom filter
+    assert isinstance(table.bloom.bits, memoryview)
+    assert table.get("key01234") == "value1234" and table._index is not None
+    assert isinstance(table._read_block(0), memoryview)  # uncompressed: a view of the mapped file
+    table.close()
@@ -1,4 +1,12 @@
+import json
+import os
+import time
+
 from store.kv import KeyValueStore
+from store.sstable import SSTable
+from store.ttl import now_ms
+from store.wal import MAGIC, encode_record
+
 
 def test_put_and_read():
     kv = KeyValueStore()
@@ -18,3 +26,159 @@ def test_batch_put():
     kv.batch_put([("k1", "v1"), ("k2", "v2")])
     assert kv.read("k1") == "v1"
     assert kv.read("k2") == "v2"
+
+
+def test_batch_write_is_one_wal_record_and_survives_restart():
+    kv = KeyValueStore()
+    kv.put("gone", "x")
+    kv.flush_to_sstable()
+    appends = kv.wal.stats["appends"]
+    kv.batch_write([("PUT", f"k{i}", str(i)) for i in range(100)] + [("DELETE", "gone", None)])
+    assert kv.wal.stats["appends"] == appends + 1
+    assert kv.multi_get(["k7", "gone", "k99", "nope"]) == {"k7": "7", "k99": "99"}
+    kv.close()
+    kv = KeyValueStore()
+    assert kv.read("k42") == "42" and kv.read("gone") is None
+    kv.close()
+
+
+def test_memtable_flushes_to_sstables():
+    kv = KeyValueStore(memtable_bytes=4096)
+    for i in range(500):
+        kv.put(f"key{i:04d}", f"value{i}")
+    kv.delete("key0007")
+    kv.flush_to_sstable()
+    assert kv.sstables
+    assert kv.memtable.size < 4096
+    assert kv.read("key0123") == "value123"
+    assert kv.read("key0007") is None
+    assert len(kv.read_key_range("key0000", "key0009")) == 9
+
+
+def test_recovery_from_sstables_and_wal():
+    kv = KeyValueStore(memtable_bytes=4096)
+    for i in range(300):
+        kv.put(f"key{i:04d}", f"value{i}")
+    kv.flush_to_sstable()
+    kv.put("tail", "from-wal")
+    kv.delete("key0001")
+    kv.close()
+
+    kv = KeyValueStore(memtable_bytes=4096)
+    assert kv.read("key0299") == "value299"
+    assert kv.read("tail") == "from-wal"
+    assert kv.read("key0001") is None
+
+
+def test_manifest_names_the_live_tables_and_unlisted_ones_are_dropped():
+    kv = KeyValueStore()
+    kv.compactor.stop()
+    for i in range(4):
+        kv.put("a", str(i))
+        kv.flush_to_sstable()
+    kv.close()
+    with open("MANIFEST") as f:
+        manifest = json.load(f)
+    assert manifest["levels"] == [[f"sstable_{i:06d}.db" for i in range(1, 5)]]
+    assert manifest["wal_checkpoint"] == 4
+    # The output of a compaction that crashed before the manifest named it
+    SSTable.write("sstable_000009.db", [("a", "orphan")], level=1, seq=4)
+
+    kv = KeyValueStore()
+    assert kv.read("a") == "3"
+    assert not os.path.exists("sstable_000009.db")
+    assert kv.next_sstable_id == 10
+    kv.compactor.stop()
+    kv.compact_sstables()
+    kv.close()
+    kv = KeyValueStore()
+    assert [t.level for t in kv.sstables] == [1] and kv.read("a") == "3"
+    assert sorted(os.listdir(".")) == ["MANIFEST", "sstable_000010.db", "wal.log"]
+    kv.close()
+
+
+def test_restart_skips_wal_segments_behind_the_checkpoint():
+    kv = KeyValueStore()
+    kv.put("k", "old")
+    kv.flush_to_sstable()
+    kv.put("k", "new")
+    kv.flush_to_sstable()
+    kv.close()
+    # A segment the flush covered but that was not deleted before a crash
+    with open("wal.log.000001", "wb") as f:
+        f.write(MAGIC + encode_record("PUT", "k", "old"))
+    kv = KeyValueStore()
+    assert kv.read("k") == "new"
+    kv.close()
+
+
+def test_row_cache_is_invalidated_by_writes():
+    kv = KeyValueStore(row_cache_bytes=1024 * 1024)
+    kv.put("a", "1")
+    kv.put("b", "2")
+    kv.flush_to_sstable()
+    assert kv.read("a") == "1" and kv.read("a") == "1"
+    assert kv.row_cache.stats["hits"] == 1
+    kv.put("a", "changed")
+    kv.flush_to_sstable()
+    assert kv.read("a") == "changed"
+    kv.delete("b")
+    kv.flush_to_sstable()
+    assert kv.read("b") is None
+    assert kv.cache_stats()["row_cache"]["entries"] == 1
+    kv.close()
+
+
+def test_read_cached_answers_from_memory_only():
+    kv = KeyValueStore(row_cache_bytes=1024 * 1024)
+    kv.put("a", "1")
+    kv.delete("gone")
+    assert kv.read_cached("a") == (True, "1") and kv.read_cached("gone") == (True, None)
+    kv.flush_to_sstable()
+    assert kv.read_cached("a") == (False, None)  # only in an SSTable now
+    assert kv.read("a") == "1" and kv.read_cached("a") == (True, "1")
+    assert kv.row_cache.stats["misses"] == 1 and kv.row_cache.stats["hits"] == 1
+    kv.close()
+
+
+def test_scan_merges_memtables_and_sstables_in_key_order():
+    kv = KeyValueStore(memtable_bytes=4096)
+    for i in range(300):
+        kv.put(f"key{i:04d}", f"old{i}")
+    kv.flush_to_sstable()
+    for i in range(0, 300, 3):
+        kv.put(f"key{i:04d}", f"new{i}")
+    kv.delete("key0001")
+    scan = kv.scan("key0000", "key0009")
+    assert next(scan) == ("key0000", "new0")
+    assert list(scan) == [("key0002", "old2"), ("key0003", "new3")] + [
+        (f"key{i:04d}", f"new{i}" if i % 3 == 0 else f"old{i}") for i in range(4, 10)]
+    assert sum(1 for _ in kv.scan()) == 299
+    kv.close()
+
+
+def test_expired_keys_read_as_deleted_and_are_purged_by_compaction():
+    kv = KeyValueStore(row_cache_bytes=1024 * 1024, expiry_compaction_delay=0)
+    kv.put("keep", "old")
+    kv.put("forever", "x")
+    kv.flush_to_sstable()
+    soon = now_ms() + 300
+    kv.batch_write([("PUTEX", "keep", ("session", soon)), ("PUTEX", "s0", ("v", soon))] +
+                   [("PUTEX", f"s{i}", ("v", now_ms() + 3600 * 1000)) for i in range(1, 5)])
+    kv.put("past", "v", ttl=1)
+    kv.compactor.stop()
+    kv.flush_to_sstable()
+    assert kv.read("keep") == "session" and kv.read("keep") == "session"  # second read from the row cache
+    assert kv.sstables[0].min_expires_at == soon and kv.sstables[0].expiring == 7
+    time.sleep(0.4)
+    assert kv.read("keep") is None and kv.read("s0") is None
+    assert kv.multi_get(["keep", "s0", "s1", "forever"]) == {"s1": "v", "forever": "x"}
+    assert [k for k, _ in kv.scan()] == ["forever", "past", "s1", "s2", "s3", "s4"]
+
+    kv.compact_sstables()
+    assert kv.compactor.stats["expiry_compactions"] == 1
+    rewritten, older = kv.sstables  # rewritten on its own; tombstones shadow the older table's "keep"
+    assert rewritten.expiring == 5 and rewritten.min_expires_at > soon
+    assert rewritten.lookup("s0") == (True, None) and older.lookup("keep") == (True, "old")
+    assert kv.read("keep") is None
+    kv.close()
@@ -0,0 +1,165 @@
+import errno
+import threading
+
+import os
+
+import pytest
+
+from store.kv import KeyValueStore
+from store.snapshot import read_snapshot_entries
+from store.ttl import now_ms
+from store.wal import WriteAheadLog, encode_batch, encode_record
+
+
+def test_append_and_replay():
+    wal = WriteAheadLog()
+    wal.append("PUT", "a", "1")
+    wal.append("DELETE", "a")
+    wal.append_state(3, 5001)
+    wal.close()
+    ops = list(WriteAheadLog().replay())
+    assert ops == [("PUT", "a", "1"), ("DELETE", "a", None), ("STATE", 3, 5001)]
+
+
+def test_group_commit_batches_concurrent_appends():
+    wal = WriteAheadLog(fsync_policy="interval", fsync_interval_ms=20)
+    threads = [threading.Thread(target=wal.append, args=("PUT", f"k{i}", "v")) for i in range(50)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert wal.stats["appends"] == 50
+    assert wal.stats["fsyncs"] == wal.stats["batches"] < 50
+    wal.close()
+
+
+def test_os_policy_never_fsyncs():
+    wal = WriteAheadLog(fsync_policy="os")
+    wal.append("PUT", "a", "1")
+    assert wal.stats["fsyncs"] == 0
+    assert wal.stats["appends"] == 1
+    wal.close()
+
+
+def test_values_with_separators_round_trip():
+    wal = WriteAheadLog()
+    wal.append("PUT", "a,b", "line1\nline2, with comma")
+    wal.append("PUT", "empty", "")
+    wal.close()
+    ops = list(WriteAheadLog().replay())
+    assert ops == [("PUT", "a,b", "line1\nline2, with comma"), ("PUT", "empty", "")]
+
+
+def test_replay_stops_at_torn_tail_and_truncates_it():
+    wal = WriteAheadLog()
+    wal.append("PUT", "a", "1")
+    wal.append("PUT", "b", "2")
+    wal.close()
+    good_size = os.path.getsize("wal.log")
+    with open("wal.log", "ab") as f:
+        f.write(encode_record("PUT", "c", "3")[:-2])
+
+    wal = WriteAheadLog()
+    assert list(wal.replay()) == [("PUT", "a", "1"), ("PUT", "b", "2")]
+    assert os.path.getsize("wal.log") == good_size
+    wal.append("PUT", "d", "4")
+    wal.close()
+    assert list(WriteAheadLog().replay())[-1] == ("PUT", "d", "4")
+
+
+class FullDisk:
+    """A WAL file handle whose writes get half way and then fail."""
+
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, data):
+        self.file.write(data[:len(data) // 2])
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+def test_failed_write_stops_the_wal_for_good():
+    kv = KeyValueStore()
+    kv.put("a", "1")
+    kv.wal.file = FullDisk(kv.wal.file)
+    with pytest.raises(IOError):
+        kv.put("b", "2")
+    kv.wal.file = kv.wal.file.file  # even once the disk has room again
+    with pytest.raises(IOError):
+        kv.put("c", "3")  # nothing is written after the torn record
+    with pytest.raises(IOError):
+        kv.read("b")  # the memtable holds a write that never became durable
+    assert kv.wal.stats["batches"] == 1
+    kv.close()
+    kv = KeyValueStore()
+    assert kv.read("a") == "1" and kv.read("b") is None and kv.read("c") is None
+    kv.close()
+
+
+def test_replay_stops_at_bad_crc():
+    wal = WriteAheadLog()
+    wal.append("PUT", "a", "1")
+    wal.append("PUT", "b", "2")
+    wal.close()
+    with open("wal.log", "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(b"X")
+    assert list(WriteAheadLog().replay()) == [("PUT", "a", "1")]
+
+
+def test_legacy_text_log_is_replayed():
+    with open("wal.log", "w") as f:
+        f.write("STATE,2,None\nPUT,a,1\nDELETE,a\n")
+    wal = WriteAheadLog()
+    wal.append("PUT", "b", "2")
+    wal.close()
+    ops = list(WriteAheadLog().replay())
+    assert ops == [("STATE", 2, None), ("PUT", "a", "1"), ("DELETE", "a", None), ("PUT", "b", "2")]
+
+
+def test_batch_is_one_record_replayed_whole_or_not_at_all():
+    wal = WriteAheadLog()
+    seq = wal.enqueue_batch([("PUT", "a", "1"), ("DELETE", "b", None), ("PUT", "c", "x y\n")])
+    wal.wait(seq)
+    assert wal.stats["appends"] == 1 and wal.stats["fsyncs"] == 1
+    wal.close()
+    with open("wal.log", "ab") as f:
+        f.write(encode_batch([("PUT", "d", "4"), ("PUT", "e", "5")])[:-3])
+    assert list(WriteAheadLog().replay()) == [("PUT", "a", "1"), ("DELETE", "b", None), ("PUT", "c", "x y\n")]
+
+
+def test_compressed_records_replay_alongside_plain_ones():
+    doc = '{"name": "customer", "tags": ["a", "b", "c"], "balance": 100}' * 20
+    wal = WriteAheadLog()
+    wal.append("PUT", "plain", doc)
+    wal.close()
+    wal = WriteAheadLog(compression="zlib")
+    wal.append("PUT", "packed", doc)
+    wal.append("PUT", "small", "x")  # under the threshold: stored as is
+    wal.wait(wal.enqueue_batch([("PUT", f"b{i}", doc) for i in range(10)]))
+    wal.close()
+    assert os.path.getsize("wal.log") < len(doc) * 2
+    ops = list(WriteAheadLog().replay())
+    assert ops[:3] == [("PUT", "plain", doc), ("PUT", "packed", doc), ("PUT", "small", "x")]
+    assert ops[3:] == [("PUT", f"b{i}", doc) for i in range(10)]
+    assert len(encode_record("PUT", "k", doc, compression=2)) < len(doc) // 5  # lzma
+
+
+def test_expiring_puts_keep_their_deadline_through_replay_and_snapshots():
+    kv = KeyValueStore()
+    kv.put("session", "abc", ttl=60)
+    kv.batch_write([("PUTEX", "gone", ("x", 1)), ("PUT", "plain", "y")])
+    kv.close()
+    ops = list(WriteAheadLog().replay())
+    (_, key, (value, expires_at)), expired, plain = ops
+    assert (key, value) == ("session", "abc") and 0 < expires_at - now_ms() <= 60000
+    assert expired == ("PUTEX", "gone", ("x", 1)) and plain == ("PUT", "plain", "y")
+
+    kv = KeyValueStore()
+    assert kv.read("session") == "abc" and kv.read("gone") is None
+    _, entries = read_snapshot_entries(kv.create_snapshot())
+    assert list(entries) == [("plain", "y", None), ("session", "abc", expires_at)]
+    kv.close()
@@ -5,6 +5,9 @@ PORT_BASE=6000
 NUM_NODES=3
 PYTHON="$VENV/bin/python3"
 LOG_FILE="watchdog.log"
+CHECK_INTERVAL=1   # seconds between health checks; a restart opens the MANIFEST tables and the WAL tail only
+STARTUP_GRACE=10   # seconds a restarted node gets to bring its health endpoint up
+declare -A RESTARTED_AT
 
 # Ensure Python virtual environment
 check_dependencies() {
@@ -39,20 +42,29 @@ monitor_cluster() {
         echo "=== WATCHDOG CHECK $(date) ===" >> "$LOG_FILE"
         for ((i=0; i<$NUM_NODES; i++)); do
             local port=$((PORT_BASE+i))
-            STATUS=$(curl -s "http://localhost:$port/health" || echo "")
+            STATUS=$(curl -s --max-time 1 "http://localhost:$((port + 100))/health" || echo "")
             ROLE=$(echo "$STATUS" | grep -o '"role":"[^"]*' | cut -d'"' -f4)
 
-            if [[ -z "$ROLE" ]]; then
+            if [[ -z "$ROLE" && $(( $(date +%s) - ${RESTARTED_AT[$port]:-0} )) -lt $STARTUP_GRACE ]]; then
+                echo "[$(date)] Node $port: ⏳ Starting..." >> "$LOG_FILE"
+            elif [[ -z "$ROLE" ]]; then
                 echo "[$(date)] Node $port: ❌ Down. Restarting..." >> "$LOG_FILE"
                 pkill -f "server.py --port $port" || true
+                # Wait for the old process to release its ports before starting the new one
+                for _ in {1..50}; do
+                    pgrep -f "server.py --port $port" > /dev/null || break
+                    sleep 0.1
+                done
+                pkill -9 -f "server.py --port $port" || true
                 peers=$(get_peers $port)
-                $PYTHON server.py --port $port --peers $peers > "node_$port.log" 2>&1 &
+                $PYTHON server.py --port $port --peers $peers --data-dir "data/node_$port" > "node_$port.log" 2>&1 &
+                RESTARTED_AT[$port]=$(date +%s)
                 echo "[$(date)] ✅ Node $port restarted successfully." >> "$LOG_FILE"
             else
                 echo "[$(date)] Node $port: ✅ Healthy ($ROLE)" >> "$LOG_FILE"
             fi
         done
-        sleep 5
+        sleep $CHECK_INTERVAL
     done
 }
 